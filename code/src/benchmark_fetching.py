@@ -0,0 +1,97 @@
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import data_extraction_functions as extract
+
+"""
+Benchmark of the concurrent download of mun/dept. contracts against a local fake SECOP server
+with artificial latency
+Run from code/src: python benchmark_fetching.py [latency_seconds] [n_mun]
+"""
+
+
+def fake_secop_handler(latency, n_rows, fail_every):
+    """
+    Request handler of a fake SECOP API: answers every query with n_rows contracts after latency seconds
+    Every fail_every-th request answers 503 (0 for never), to exercise the retries
+    """
+    counter = {'requests': 0}
+    lock = threading.Lock()
+
+    class FakeSecopHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+
+        def do_GET(self):
+            params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            with lock:
+                counter['requests'] += 1
+                fail = fail_every and counter['requests'] % fail_every == 0
+            time.sleep(latency)
+            if fail:
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            rows = [{'uid': str(i),
+                     'nombre_de_la_entidad': params.get('nombre_de_la_entidad', ''),
+                     'estado_del_proceso': 'Liquidado',
+                     'anno_firma_del_contrato': '2015',
+                     'cuantia_proceso': '1000000',
+                     'detalle_del_objeto_a_contratar': 'MANTENIMIENTO DE LA VIA ' + str(i)}
+                    for i in range(n_rows)]
+            body = json.dumps(rows).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return FakeSecopHandler, counter
+
+
+def run_benchmark(latency=0.2, n_mun=32, n_rows=200, workers_list=(1, 2, 4, 8, 16), fail_every=0):
+    """
+    Times the download of n_mun mun/dept. with several concurrency limits
+
+    Returns
+    -------
+    list
+        dict per concurrency limit with the wall-clock seconds and the number of requests made
+    """
+    handler, counter = fake_secop_handler(latency, n_rows, fail_every)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    extract.SECOP_URL = 'http://127.0.0.1:' + str(server.server_port) + '/resource/xvdy-vvsk.json'
+    list_mun = ['MUNICIPIO ' + str(i) for i in range(n_mun)]
+
+    results = []
+    try:
+        for workers in workers_list:
+            extract.configure_session(pool_size=max(workers_list), backoff_factor=0.05)
+            counter['requests'] = 0
+            start = time.perf_counter()
+            n_contracts = sum(len(df) for _, df in extract.iter_mun_contracts(list_mun, workers=workers))
+            seconds = time.perf_counter() - start
+            assert n_contracts == n_mun * n_rows
+            results.append({'workers': workers,
+                            'seconds': seconds,
+                            'mun_per_second': n_mun / seconds,
+                            'requests': counter['requests']})
+    finally:
+        server.shutdown()
+    return results
+
+
+if __name__ == '__main__':
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.2
+    n_mun = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    for result in run_benchmark(latency, n_mun, fail_every=7):
+        print(json.dumps(result))
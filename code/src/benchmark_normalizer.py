@@ -0,0 +1,75 @@
+import re
+import sys
+import timeit
+
+import pandas as pd
+import unidecode
+from nltk.corpus import stopwords
+
+import data_cleaning_functions as clean
+
+"""
+Micro-benchmark of the description normalizer against the original standarize_obj
+Run from code/src: python benchmark_normalizer.py [sample_csv] [repeat]
+"""
+
+
+def standarize_obj_legacy(string_obj):
+    """ Original standardization of the description (stopwords and regexes rebuilt on every call)"""
+    cachedStopWords = stopwords.words("spanish")
+    cachedStopWords = [x.upper() for x in cachedStopWords]
+    clean_str = str(string_obj).upper()
+    clean_str = ' '.join([word for word in clean_str.split() if word not in cachedStopWords])
+    clean_str = unidecode.unidecode(clean_str)
+    clean_str = re.sub(r'[^\w\s]', '', clean_str)
+    clean_str = re.sub(' +', ' ', clean_str)
+    return clean_str
+
+
+def load_descriptions(sample_csv):
+    """Gets all the descriptions (entity and mun/dept.) in the chain sample"""
+    df_sample = pd.read_csv(sample_csv)
+    return pd.concat([df_sample['detalle_del_objeto_a_contratar'],
+                      df_sample['detalle_del_objeto_a_contratar_mun']], ignore_index=True)
+
+
+def run_benchmark(descriptions, repeat=200):
+    """
+    Times the original and the new normalizer over the same descriptions
+
+    Parameters
+    ----------
+    descriptions : series
+        descriptions of the contracts
+    repeat : int
+        Number of times each description is normalized (as in the loop of contracting_chain)
+
+    Returns
+    -------
+    dict
+        seconds spent by each implementation
+    """
+    descriptions = pd.concat([descriptions] * repeat, ignore_index=True)
+
+    expected = [standarize_obj_legacy(item) for item in descriptions]
+    assert clean.DescriptionNormalizer().normalize_series(descriptions).tolist() == expected
+
+    # Without cache: only the precompiled stopwords/regexes
+    normalizer_cold = clean.DescriptionNormalizer(cache_size=0)
+    normalizer_warm = clean.DescriptionNormalizer()
+    return {
+        'n_descriptions': len(descriptions),
+        'legacy': timeit.timeit(lambda: [standarize_obj_legacy(item) for item in descriptions], number=1),
+        'normalizer_no_cache': timeit.timeit(lambda: [normalizer_cold(item) for item in descriptions], number=1),
+        'normalizer_cache': timeit.timeit(lambda: [normalizer_warm(item) for item in descriptions], number=1),
+        'normalize_series': timeit.timeit(
+            lambda: clean.DescriptionNormalizer().normalize_series(descriptions), number=1),
+    }
+
+
+if __name__ == '__main__':
+    sample_csv = sys.argv[1] if len(sys.argv) > 1 else '../results/contracting_chain_sample.csv'
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    results = run_benchmark(load_descriptions(sample_csv), repeat)
+    for key, value in results.items():
+        print(key + ': ' + str(value))
@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+
+"""
+Cold-start check of the pipeline modules: each import is timed in a fresh interpreter, with the network
+disabled (any connection raises) and checking that the heavy modules are not loaded until they are needed
+Exits with status 1 if the median import time is over the budget or a check fails
+Run from code/src: python benchmark_startup.py [budget_seconds] [repeat]
+"""
+
+PIPELINE_MODULES = ['data_cleaning_functions', 'data_extraction_functions', 'string_similarity_functions',
+                    'string_similarity', 'extraction', 'preprocessing', 'gazetteer', 'secop_cache', 'checkpoint',
+                    'chain_sinks', 'instrumentation', 'incremental', 'contracts_warehouse',
+                    'chain_graph', 'dashboard_extract']
+# Modules loaded only on first use (downloads, stopwords, sparse matrices, top-n kernel)
+LAZY_MODULES = ['nltk', 'sklearn', 'scipy', 'sparse_dot_topn', 'requests']
+
+IMPORT_SCRIPT = '''
+import json, socket, sys, time
+
+def no_network(*args, **kwargs):
+    raise RuntimeError('network access at import time')
+
+socket.socket.connect = no_network
+socket.create_connection = no_network
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {lazy!r} if m in sys.modules]}}))
+'''
+
+
+def time_imports(modules=PIPELINE_MODULES, lazy_modules=LAZY_MODULES):
+    """
+    Imports the modules in a fresh interpreter
+
+    Returns
+    -------
+    dict
+        seconds of the imports and lazy modules loaded by them
+    """
+    script = IMPORT_SCRIPT.format(modules=list(modules), lazy=list(lazy_modules))
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError('Import failed:\n' + result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_check(budget=1.0, repeat=5):
+    """
+    Times the cold import of the pipeline modules repeat times
+
+    Parameters
+    ----------
+    budget : float
+        Max. median seconds of the imports
+    repeat : int
+        Number of fresh interpreters
+
+    Returns
+    -------
+    dict
+        median and max. seconds, lazy modules loaded, and ok (True if within budget and no lazy module loaded)
+    """
+    runs = [time_imports() for _ in range(repeat)]
+    seconds = sorted(run['seconds'] for run in runs)
+    loaded = sorted({module for run in runs for module in run['loaded']})
+    median = seconds[len(seconds) // 2]
+    return {'median_seconds': median, 'max_seconds': seconds[-1], 'budget_seconds': budget,
+            'lazy_modules_loaded': loaded, 'ok': median <= budget and not loaded}
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    check = run_check(budget, repeat)
+    print(json.dumps(check, indent=1))
+    sys.exit(0 if check['ok'] else 1)
@@ -0,0 +1,168 @@
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import data_cleaning_functions as clean
+import preprocessing
+import string_similarity
+import string_similarity_functions as ss
+import synthetic_secop as syn
+from secop_cache import ContractCache
+
+"""
+Benchmark suite of the pipeline over synthetic SECOP data (see synthetic_secop), without network
+Times preprocessing_data, standarize_obj, tf_idf, awesome_cossim_top and contracting_chain end-to-end,
+and writes the results as JSON to compare throughput across versions
+Run from code/src: python benchmark_suite.py --n-mun 50 --contracts-per-mun 200 --output benchmark.json
+"""
+
+
+def time_call(func, repeat=3):
+    """Runs func repeat times, returns its result and the seconds of each run"""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    return result, seconds
+
+
+def summarize(seconds, items, unit):
+    """Min./median seconds of the runs and throughput (items per second of the fastest run)"""
+    return {'runs': len(seconds),
+            'min_seconds': min(seconds),
+            'median_seconds': float(np.median(seconds)),
+            'items': items,
+            'unit': unit,
+            'items_per_second': items / min(seconds) if min(seconds) > 0 else None}
+
+
+def git_version():
+    """Commit of the code benchmarked (None outside a git repository)"""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(n_mun=50, contracts_per_mun=200, entity_per_mun=3, n_entities=1, description_length=None, repeat=3,
+              workers=1, topn_workers=1, seed=0):
+    """
+    Generates synthetic data and times each stage of the pipeline
+
+    Parameters
+    ----------
+    n_mun : int
+        Number of municipalities
+    contracts_per_mun : int
+        Number of contracts issued by each municipality
+    entity_per_mun : int
+        Number of contracts issued by each entity to each municipality
+    n_entities : int
+        Number of public entities (matched in the same run)
+    description_length : tuple
+        (min, max) number of words of the descriptions (None for the lengths of the seed data)
+    repeat : int
+        Number of runs of each benchmark (the fastest one is used for the throughput)
+    workers : int
+        Number of processes of contracting_chain
+    topn_workers : int
+        Number of threads of awesome_cossim_top
+    seed : int
+        seed of the synthetic data
+
+    Returns
+    -------
+    dict
+        configuration, environment and results of each benchmark
+    """
+    data = syn.generate_data(n_mun=n_mun, contracts_per_mun=contracts_per_mun, entity_per_mun=entity_per_mun,
+                             n_entities=n_entities, description_length=description_length, seed=seed)
+    results = {}
+
+    # Preprocessing: cleaning, filter and standardization of the names of the entity contracts
+    (df_entity, names_mun), seconds = time_call(
+        lambda: preprocessing.preprocessing_data(data['entity'].copy(), data['names'].copy()), repeat)
+    results['preprocessing_data'] = summarize(seconds, len(data['entity']), 'contracts')
+    standardized = df_entity['nom_raz_soc_stand'].isin(list(data['mun'])).mean()
+    results['preprocessing_data']['names_standardized'] = float(standardized)
+
+    # Normalization of the descriptions (one by one, as a fresh normalizer each run)
+    descriptions = df_entity['detalle_del_objeto_a_contratar'].tolist()
+    for df_mun in data['mun'].values():
+        descriptions.extend(df_mun['detalle_del_objeto_a_contratar'].tolist())
+
+    def normalize():
+        clean.get_obj_normalizer().cache_clear()
+        return [clean.standarize_obj(item) for item in descriptions]
+
+    normalized, seconds = time_call(normalize, repeat)
+    results['standarize_obj'] = summarize(seconds, len(descriptions), 'descriptions')
+
+    # tf-idf of all the descriptions
+    tf_idf_matrix, seconds = time_call(lambda: ss.tf_idf(normalized), repeat)
+    results['tf_idf'] = summarize(seconds, len(normalized), 'descriptions')
+
+    # Top-n of all the entity contracts against all the mun/dept. contracts
+    n_entity = len(df_entity)
+    entity_matrix, mun_matrix = tf_idf_matrix[:n_entity], tf_idf_matrix[n_entity:]
+    matches, seconds = time_call(
+        lambda: ss.awesome_cossim_top(entity_matrix, mun_matrix.transpose(), 3, workers=topn_workers), repeat)
+    results['awesome_cossim_top'] = summarize(seconds, n_entity, 'entity contracts')
+    results['awesome_cossim_top']['mun_contracts'] = mun_matrix.shape[0]
+    results['awesome_cossim_top']['workers'] = topn_workers
+
+    # End-to-end chain, mun/dept. contracts read from an offline cache
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = ContractCache(cache_dir, offline=True)
+        syn.fill_cache(cache, data['mun'])
+        chain, seconds = time_call(
+            lambda: string_similarity.contracting_chain(names_mun, 3, df_entity, cache=cache, workers=workers),
+            repeat)
+    results['contracting_chain'] = summarize(seconds, n_entity, 'entity contracts')
+    results['contracting_chain']['pairs'] = len(chain)
+    results['contracting_chain']['workers'] = workers
+
+    return {'version': git_version(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {'n_mun': n_mun, 'contracts_per_mun': contracts_per_mun, 'entity_per_mun': entity_per_mun,
+                       'n_entities': n_entities, 'description_length': description_length, 'repeat': repeat,
+                       'workers': workers, 'topn_workers': topn_workers, 'seed': seed},
+            'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the pipeline over synthetic SECOP data')
+    parser.add_argument('--n-mun', type=int, default=50)
+    parser.add_argument('--contracts-per-mun', type=int, default=200)
+    parser.add_argument('--entity-per-mun', type=int, default=3)
+    parser.add_argument('--n-entities', type=int, default=1)
+    parser.add_argument('--description-length', type=int, nargs=2, default=None, metavar=('MIN', 'MAX'))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--topn-workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='JSON file with the results (printed if not given)')
+    args = parser.parse_args()
+
+    report = run_suite(n_mun=args.n_mun, contracts_per_mun=args.contracts_per_mun,
+                       entity_per_mun=args.entity_per_mun, n_entities=args.n_entities,
+                       description_length=tuple(args.description_length) if args.description_length else None,
+                       repeat=args.repeat, workers=args.workers, topn_workers=args.topn_workers,
+                       seed=args.seed)
+    if args.output is None:
+        print(json.dumps(report, ensure_ascii=False, indent=1))
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        for name, result in report['results'].items():
+            print(name + ': ' + str(round(result['items_per_second'] or 0, 1)) + ' ' + result['unit'] + '/s')
@@ -0,0 +1,202 @@
+import pandas as pd
+
+import data_cleaning_functions as clean
+import data_extraction_functions as extract
+import gazetteer as gaz
+import instrumentation as instr
+import string_similarity
+
+"""
+Multi-level contracting chain: entity -> mun/dept. -> mun/dept. -> ... down to the third-party contractors
+Hop 1 is the chain of contracting_chain. The contracts matched at a hop whose contractor is a public entity
+(a mun/dept., standardized with the gazetteer) are the frontier of the next hop: they are matched against the
+contracts issued by that entity.
+Each entity of the graph is downloaded, cleaned and vectorized once, however many paths reach it, and each
+contract is expanded once (cycles stop), so the cost grows with the entities visited, not with the paths.
+The chain is an edge list: one row per pair of contracts (as contracting_chain) with its hop.
+"""
+
+
+class GraphNode:
+    """
+    Contracts issued by an entity of the graph, cleaned, normalized and vectorized once
+
+    Parameters
+    ----------
+    contracts : dataframe
+        contracts issued by the entity (cleaned)
+    descriptions : list
+        normalized descriptions of the contracts
+    matrix : sparse matrix
+        tf-idf representation of the descriptions
+    """
+
+    def __init__(self, contracts, descriptions, matrix):
+        self.contracts = contracts
+        self.descriptions = descriptions
+        self.matrix = matrix
+        self.years = pd.to_numeric(contracts['anno_firma_del_contrato']).to_numpy(dtype=float)
+
+    @classmethod
+    def build(cls, contracts, encoder):
+        """Cleans, normalizes and vectorizes the contracts (None if there are none to evaluate)"""
+        contracts = clean.df_cleaning(contracts)
+        if contracts.empty:
+            return None
+        descriptions = clean.get_obj_normalizer().normalize_series(contracts['detalle_del_objeto_a_contratar'])
+        descriptions = descriptions.tolist()
+        return cls(contracts, descriptions, encoder.transform(descriptions))
+
+    def take(self, positions):
+        """Node with the contracts in the positions given"""
+        return GraphNode(self.contracts.take(positions).reset_index(drop=True),
+                         [self.descriptions[pos] for pos in positions], self.matrix[positions])
+
+
+def contracting_chain_graph(list_mun, n_contracts, entity_contracts, gazetteer, depth=2, cache=None,
+                            fetch_workers=4, columns=None, n_rare=None, encoder=None, sink=None,
+                            keep_invalid=False):
+    """
+    Gets the contracting chain of one or more public entities down to depth hops
+
+    Parameters
+    ----------
+    list_mun : list
+        list with the names of municipalities/departments to evaluate at the first hop
+    n_contracts: int
+        Max. number of contracts matched to each contract
+    entity_contracts: dataframe
+        contracts issued by the public entities, standardized (result of preprocessing_data)
+    gazetteer: dict
+        gazetteer of names of mun/dept. (see gazetteer.load_gazetteer), to standardize the contractors of
+        the next hops. Names not seen before are added to it (save it with gazetteer.save_gazetteer)
+    depth: int
+        Max. number of hops (1 for the chain of contracting_chain)
+    cache: ContractCache
+        local cache of SECOP queries, or a ContractWarehouse (None to always query the API)
+    fetch_workers: int
+        Max. number of entities downloaded concurrently
+    columns: list
+        columns of the contracts to download, e.g. extract.SECOP_COLUMNS (None for all the columns)
+    n_rare: int
+        If given, only contracts sharing one of the n_rare rarest ngrams of a contract are scored
+    encoder: TrigramEncoder
+        tf-idf encoder shared by all the hops (None to fit one with the contracts of the first hop, see
+        string_similarity.fit_encoder)
+    sink: ChainSink
+        If given, the edges of each entity are written to it instead of returned. The caller closes it
+    keep_invalid: bool
+        If True, pairs with score under the threshold are also kept (valid = False); only valid pairs
+        are expanded
+
+    Returns
+    -------
+    dataframe
+        edge list: hop, then the columns of contracting_chain (contract of the issuer, contract of the
+        contractor with suffix '_mun', score and valid). None if written to sink
+    """
+    entity_contracts = clean.df_cleaning(entity_contracts)
+    threshold = 0.8
+    lower_bound = 0 if keep_invalid else threshold
+    if encoder is None:
+        encoder = string_similarity.fit_encoder(list_mun, entity_contracts, cache=cache, fetch_workers=fetch_workers,
+                                                columns=columns)
+
+    # Frontier of the first hop: entity contracts issued to the mun/dept. evaluated
+    entity_contracts = entity_contracts.loc[entity_contracts['nom_raz_soc_stand'].isin(list_mun)]
+    frontier = GraphNode.build(entity_contracts, encoder)
+    nodes = {}
+    expanded_uids = set()
+    chain_list = []
+
+    for hop in range(1, depth + 1):
+        if frontier is None:
+            break
+        # Contracts already expanded (reached by another path) are not expanded again
+        keep = ~frontier.contracts['uid'].isin(expanded_uids) & ~frontier.contracts['uid'].duplicated()
+        frontier = frontier.take(keep.to_numpy().nonzero()[0])
+        if frontier.contracts.empty:
+            break
+        expanded_uids.update(frontier.contracts['uid'])
+
+        # Entities contracted by the frontier (at the first hop, in the order of list_mun)
+        target_rows = string_similarity.entity_rows_by_mun(frontier.contracts)
+        targets = [item for item in list_mun if item in target_rows] if hop == 1 else list(target_rows)
+        new_targets = [item for item in targets if item not in nodes]
+        with instr.stage('chain_hop', rows_in=len(frontier.contracts), entities=len(targets),
+                         new_entities=len(new_targets)) as stage:
+            children = []
+            # Entities reached for the first time are downloaded (the next ones while the current one is
+            # evaluated), entities reached before are evaluated with their contracts of the previous hops
+            for item, contracts in extract.iter_mun_contracts(new_targets, workers=fetch_workers, cache=cache,
+                                                              columns=columns):
+                with instr.stage('graph_node', item, rows_in=len(contracts)):
+                    nodes[item] = GraphNode.build(contracts, encoder) if not contracts.empty else None
+                children.append(expand_node(item, nodes[item], frontier.take(target_rows[item]), hop, n_contracts,
+                                            n_rare, lower_bound, threshold, sink, chain_list))
+            for item in targets:
+                if item not in new_targets:
+                    children.append(expand_node(item, nodes[item], frontier.take(target_rows[item]), hop,
+                                                n_contracts, n_rare, lower_bound, threshold, sink, chain_list))
+            frontier = next_frontier([child for child in children if child is not None], gazetteer)
+            stage.add(rows_out=0 if frontier is None else len(frontier.contracts))
+
+    if sink is not None:
+        return None
+    if not chain_list:
+        return pd.DataFrame()
+    return pd.concat(chain_list, ignore_index=True, sort=False)
+
+
+def expand_node(name, node, parents, hop, n_contracts, n_rare, lower_bound, threshold, sink, chain_list):
+    """
+    Matches the contracts issued to an entity (parents) against the contracts issued by it (node)
+
+    Returns
+    -------
+    GraphNode
+        contracts of the entity matched by a valid pair (None if there are none)
+    """
+    if node is None:
+        return None
+    with instr.stage('expand_node', name, rows_in=len(parents.contracts)) as stage:
+        matches_sparse = string_similarity.score_contracts(parents.descriptions, parents.matrix, parents.years,
+                                                           node.descriptions, node.matrix, node.years, n_contracts,
+                                                           n_rare, lower_bound)
+        edges = string_similarity.build_chain_mun(parents.contracts, node.contracts, matches_sparse, threshold)
+        edges.insert(0, 'hop', hop)
+        stage.add(rows_out=len(edges))
+        if sink is not None:
+            sink.write(edges)
+        elif not edges.empty:
+            chain_list.append(edges)
+
+        matches_sparse = matches_sparse.tocoo()
+        matched = sorted(set(matches_sparse.col[matches_sparse.data > threshold]))
+        if not matched:
+            return None
+        return node.take(matched)
+
+
+def next_frontier(children, gazetteer):
+    """
+    Contracts matched at a hop whose contractor is a public entity (mun/dept.), with the standardized name
+    of the contractor in nom_raz_soc_stand (None if there are none)
+    """
+    from scipy.sparse import vstack
+
+    if not children:
+        return None
+    frontier = GraphNode(pd.concat([child.contracts for child in children], ignore_index=True, sort=False),
+                         [item for child in children for item in child.descriptions],
+                         vstack([child.matrix for child in children]).tocsr())
+    # Same filter and standardization of contractor names as preprocessing_data
+    contracts, names = clean.df_filter_entity(frontier.contracts)
+    if contracts.empty:
+        return None
+    names_standard, _ = gaz.standardize_names(gazetteer, names)
+    frontier = frontier.take(contracts.index.to_numpy())
+    frontier.contracts['nom_raz_soc_stand'] = names_standard
+    # A contract issued by an entity to itself is not followed
+    issuers = frontier.contracts['nombre_de_la_entidad'].astype(str).to_numpy()
+    return frontier.take((issuers != frontier.contracts['nom_raz_soc_stand'].to_numpy()).nonzero()[0])
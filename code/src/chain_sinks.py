@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import warnings
+
+import pandas as pd
+
+"""
+Incremental writers of the contracting chain
+contracting_chain writes the chain of each mun/dept. as soon as it is evaluated, so the whole chain is never
+held in memory. All the sinks share the same interface: write(chunk) for each mun/dept. and close() at the end
+(or use them in a with statement). The columns of the first chunk are the columns of the output: later chunks
+are aligned to them. The contracts of every mun/dept. are downloaded with the same columns (see
+extract.align_columns), so no column is expected to appear later; if one does, it is dropped with a warning.
+"""
+
+
+class ChainSink:
+    """Base class of the sinks: aligns the chunks to the columns of the first one and counts the rows"""
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = None
+        self.rows = 0
+
+    def write(self, chunk):
+        """Appends the pairs of contracts of one mun/dept."""
+        if chunk is None or chunk.empty:
+            return
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+        extra = [col for col in chunk.columns if col not in self.columns]
+        if extra:
+            warnings.warn('Columns not in the output ' + str(self.path) + ', dropped: ' + ', '.join(extra))
+        chunk = chunk.reindex(columns=self.columns)
+        # Categories may differ between mun/dept.: written as plain values
+        for col in chunk.select_dtypes('category').columns:
+            chunk[col] = chunk[col].astype(object)
+        self._write(chunk)
+        self.rows += len(chunk)
+
+    def _write(self, chunk):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvSink(ChainSink):
+    """
+    Writes the chain to a CSV file (header written with the first chunk)
+    The first column is a row number without header, as the index written by to_csv before the sinks (the
+    dashboard reads it as F1 / Unnamed: 0)
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._file = open(path, 'w', encoding='utf-8', newline='')
+
+    def _write(self, chunk):
+        chunk = chunk.set_axis(pd.RangeIndex(self.rows, self.rows + len(chunk)), axis=0)
+        chunk.to_csv(self._file, header=self.rows == 0)
+
+    def close(self):
+        if not self._file.closed:
+            if self.rows == 0 and self.columns is not None:
+                pd.DataFrame(columns=self.columns).to_csv(self._file)
+            self._file.close()
+
+
+class ParquetSink(ChainSink):
+    """Writes the chain to a Parquet file, one row group per chunk (schema of the first chunk)"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._writer = None
+        self._schema = None
+        self._string_columns = []
+
+    def _write(self, chunk):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._writer is None:
+            # Columns with no value in the first chunk (e.g. fields added by extract.align_columns) are
+            # written as strings
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            empty = chunk.columns[chunk.isna().all().to_numpy()]
+            fields = [pa.field(field.name, pa.string()) if field.name in empty else field for field in table.schema]
+            self._string_columns = [field.name for field in fields if pa.types.is_string(field.type)]
+            self._schema = pa.schema(fields)
+            self._writer = pq.ParquetWriter(self.path, self._schema)
+        # Values of the string columns are written as text, whatever their type in this chunk
+        for col in self._string_columns:
+            values = chunk[col]
+            chunk[col] = values.where(values.isna(), values.astype(str))
+        table = pa.Table.from_pandas(chunk, schema=self._schema, preserve_index=False)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class SqliteSink(ChainSink):
+    """Writes the chain to a table of a SQLite database (the table is replaced by the first chunk)"""
+
+    def __init__(self, path, table='contracting_chain'):
+        super().__init__(path)
+        self.table = table
+        self._con = sqlite3.connect(path)
+
+    def _write(self, chunk):
+        chunk.to_sql(self.table, self._con, if_exists='replace' if self.rows == 0 else 'append', index=False)
+        self._con.commit()
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+
+class TeeSink(ChainSink):
+    """Writes the chain to several sinks (e.g. the CSV and the dashboard extract)"""
+
+    def __init__(self, *sinks):
+        super().__init__(None)
+        self.sinks = sinks
+
+    def write(self, chunk):
+        for sink in self.sinks:
+            sink.write(chunk)
+        if chunk is not None:
+            self.rows += len(chunk)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+SINKS = {'.csv': CsvSink, '.parquet': ParquetSink, '.sqlite': SqliteSink, '.db': SqliteSink}
+
+
+def open_sink(path):
+    """
+    Opens the sink matching the extension of the output file
+
+    Parameters
+    ----------
+    path : str
+        output file: .csv, .parquet, .sqlite or .db
+
+    Returns
+    -------
+    ChainSink
+        sink writing to the file
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in SINKS:
+        raise ValueError('Output format not supported: ' + path + ' (' + ', '.join(SINKS) + ')')
+    return SINKS[extension](path)
@@ -0,0 +1,81 @@
+import json
+import os
+import sys
+import tempfile
+
+import pandas as pd
+
+import data_extraction_functions as extract
+from contracts_warehouse import ContractWarehouse, field_name
+
+"""
+Check of the local warehouse of SECOP I contracts (contracts_warehouse) loaded from a CSV with the headers of the
+export of datos.gov.co: every header is mapped to its API field name, and the contracts returned by
+extract_mun_contracts have exactly the columns of the API (extract.SECOP_ALL_COLUMNS)
+Exits with status 1 if a check fails
+Run from code/src: python check_contracts_warehouse.py
+"""
+
+# Headers of the CSV export of SECOP I, in the order of extract.SECOP_ALL_COLUMNS
+EXPORT_HEADERS = ['UID', 'Anno Cargue SECOP', 'Anno Firma del Contrato', 'Nivel Entidad', 'Orden Entidad',
+                  'Nombre de la Entidad', 'NIT de la Entidad', 'Código de la Entidad', 'ID Tipo de Proceso',
+                  'Tipo de Proceso', 'Estado del Proceso', 'Causal de Otras Formas de Contratacion Directa',
+                  'ID Regimen de Contratacion', 'Regimen de Contratacion', 'ID Objeto a Contratar',
+                  'Objeto a Contratar', 'Detalle del Objeto a Contratar', 'Tipo de Contrato', 'Municipio Obtencion',
+                  'Municipio Entrega', 'Municipios Ejecucion', 'Fecha de Cargue en el SECOP',
+                  'Numero de Constancia', 'Numero de Proceso', 'Numero del Contrato', 'Cuantia Proceso', 'ID Grupo',
+                  'Nombre Grupo', 'ID Familia', 'Nombre Familia', 'ID Clase', 'Nombre Clase', 'ID Ajudicacion',
+                  'Tipo Identifi del Contratista', 'Identificacion del Contratista', 'Nom Raz Social Contratista',
+                  'Dpto y Muni Contratista', 'Tipo Doc Representante Legal', 'Identific del Represen Legal',
+                  'Nombre del Represen Legal', 'Fecha de Firma del Contrato', 'Fecha Ini Ejec Contrato',
+                  'Plazo de Ejec del Contrato', 'Rango de Ejec del Contrato', 'Tiempo Adiciones en Dias',
+                  'Tiempo Adiciones en Meses', 'Fecha Fin Ejec Contrato', 'Compromiso Presupuestal',
+                  'Cuantia Contrato', 'Valor Total de Adiciones', 'Valor Contrato con Adiciones',
+                  'Objeto del Contrato a la Firma', 'ID Origen de los Recursos', 'Origen de los Recursos',
+                  'Codigo BPIN', 'Proponentes Seleccionados', 'Calificacion Definitiva', 'ID Sub Unidad Ejecutora',
+                  'Nombre Sub Unidad Ejecutora', 'Ruta Proceso en SECOP I', 'Moneda', 'EsPostConflicto',
+                  'Marcacion Adiciones', 'Posicion Rubro', 'Nombre Rubro', 'Valor Rubro', 'Sexo RepLegal Entidad',
+                  'Pilar Acuerdo Paz', 'Punto Acuerdo Paz', 'Municipio Entidad', 'Departamento Entidad']
+MUN_NAME = 'HUILA - ALCALDÍA MUNICIPIO DE NEIVA'
+
+
+def run_check():
+    """
+    Loads a small export into a temporary warehouse and queries it as the pipeline does
+
+    Returns
+    -------
+    dict
+        result of each check (True if passed), headers mapped to a wrong field, and ok
+    """
+    checks = {}
+    names = [field_name(header) for header in EXPORT_HEADERS]
+    wrong = {header: name for header, name, column in zip(EXPORT_HEADERS, names, extract.SECOP_ALL_COLUMNS)
+             if name != column}
+    checks['field_names'] = not wrong
+
+    rows = pd.DataFrame([['x'] * len(EXPORT_HEADERS)] * 3, columns=EXPORT_HEADERS)
+    rows['UID'] = ['1', '2', '3']
+    rows['Nombre de la Entidad'] = MUN_NAME
+    rows['Anno Firma del Contrato'] = '2015'
+    rows['Cuantia Proceso'] = '1000000'
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'SECOP_I.csv')
+        rows.to_csv(csv_path, index=False)
+        warehouse = ContractWarehouse(os.path.join(tmp_dir, 'secop.sqlite'))
+        checks['load'] = warehouse.load_csv(csv_path) == 3
+        df = extract.extract_mun_contracts(MUN_NAME, cache=warehouse)
+        checks['columns'] = list(df.columns) == extract.SECOP_ALL_COLUMNS and len(df) == 3
+        checks['values'] = bool(df['c_digo_de_la_entidad'].eq('x').all()
+                                and df['objeto_del_contrato_a_la'].eq('x').all())
+        warehouse.connection().close()
+
+    checks['ok'] = all(checks.values())
+    checks['wrong_field_names'] = wrong
+    return checks
+
+
+if __name__ == '__main__':
+    check = run_check()
+    print(json.dumps(check, indent=1, ensure_ascii=False))
+    sys.exit(0 if check['ok'] else 1)
@@ -0,0 +1,95 @@
+import json
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+import incremental
+import preprocessing
+import string_similarity
+import synthetic_secop as syn
+from secop_cache import ContractCache
+
+"""
+Check of the incremental update of the contracting chain (incremental.update_chain) on synthetic data served by an
+offline cache: after a first update (day 1) the contracts of day 2 add entity and mun/dept. contracts and upload
+again some contracts already evaluated with a new description. Each update must give the same chain as
+contracting_chain run on the same data from scratch, and an update without new contracts must not change it
+Exits with status 1 if a check fails
+Run from code/src: python check_incremental.py
+"""
+
+KEY_COLUMNS = ['uid', 'uid_mun']
+
+
+def same_chain(chain_df, expected_df):
+    """True if both chains have the same pairs of contracts (in the same order), scores and validity"""
+    columns = [col for col in KEY_COLUMNS + ['valid'] if col in expected_df.columns]
+    chain_df = chain_df.reset_index(drop=True)
+    expected_df = expected_df.reset_index(drop=True)
+    if len(chain_df) != len(expected_df) or not chain_df[columns].equals(expected_df[columns]):
+        return False
+    return bool(np.allclose(chain_df['score'], expected_df['score']))
+
+
+def run_check(n_contracts=3, seed=4):
+    """
+    Builds the chain of day 1, updates it with the contracts of day 2 (twice) and compares each chain with a
+    full rebuild
+
+    Returns
+    -------
+    dict
+        result of each check (True if passed), number of rows of the chains, and ok
+    """
+    data = syn.generate_data(n_mun=12, contracts_per_mun=120, n_entities=2, seed=seed)
+    rng = np.random.default_rng(seed)
+    entity_2, names = preprocessing.preprocessing_data(data['entity'], data['names'].copy())
+    mun_2 = {mun_name: df_mun.copy() for mun_name, df_mun in data['mun'].items()}
+    # Day 1: about 80% of the contracts
+    entity_1 = entity_2.loc[rng.random(len(entity_2)) < 0.8]
+    mun_1 = {mun_name: df_mun.loc[rng.random(len(df_mun)) < 0.8] for mun_name, df_mun in mun_2.items()}
+    # Day 2: all the contracts, one contract of day 1 of each mun/dept. uploaded again with a new description
+    for mun_name, df_mun in mun_2.items():
+        i = df_mun.index[df_mun['uid'].isin(mun_1[mun_name]['uid'])][0]
+        df_mun.loc[i, 'detalle_del_objeto_a_contratar'] += ' OBRAS'
+        df_mun.loc[i, 'fecha_de_cargue_en_el_secop'] = '2019-01-01T00:00:00.000'
+
+    checks = {}
+    rows = {}
+    cache_dir = tempfile.mkdtemp()
+    state_dir = tempfile.mkdtemp()
+    shutil.rmtree(state_dir)
+    try:
+        cache = ContractCache(cache_dir, offline=True)
+        syn.fill_cache(cache, mun_1)
+        # The encoder is kept in the state directory, so the full rebuilds use the same one
+        encoder = string_similarity.fit_encoder(names, entity_2, cache=cache)
+
+        chain_1 = incremental.update_chain(names, n_contracts, entity_1, state_dir, cache=cache, encoder=encoder)
+        full_1 = string_similarity.contracting_chain(names, n_contracts, entity_1, cache=cache, encoder=encoder)
+        checks['day_1'] = same_chain(chain_1, full_1)
+
+        syn.fill_cache(cache, mun_2)
+        chain_2 = incremental.update_chain(names, n_contracts, entity_2, state_dir, cache=cache)
+        full_2 = string_similarity.contracting_chain(names, n_contracts, entity_2, cache=cache, encoder=encoder)
+        checks['day_2'] = same_chain(chain_2, full_2)
+        # The contracts of day 2 change the chain, so the comparison is not trivial
+        checks['day_2_changed'] = not same_chain(chain_2, chain_1)
+
+        chain_3 = incremental.update_chain(names, n_contracts, entity_2, state_dir, cache=cache)
+        checks['no_changes'] = same_chain(chain_3, full_2)
+        rows = {'day_1': len(chain_1), 'day_2': len(chain_2)}
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        shutil.rmtree(state_dir, ignore_errors=True)
+    checks['ok'] = all(checks.values())
+    checks['rows'] = rows
+    return checks
+
+
+if __name__ == '__main__':
+    check = run_check()
+    print(json.dumps(check, indent=1))
+    sys.exit(0 if check['ok'] else 1)
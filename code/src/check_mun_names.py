@@ -0,0 +1,75 @@
+import json
+import sys
+
+import pandas as pd
+
+import data_cleaning_functions as clean
+
+"""
+Check of the standardization of names of mun/dept. (standardize_mun_names) against the expected names of the
+known special cases: special cases of MUN_SPECIAL_CASES/DEPTO_SPECIAL_CASES, accents restored from the official
+names, departments matched as whole words (the rightmost one) and municipalities without department
+Exits with status 1 if a name differs from the expected one
+Run from code/src: python check_mun_names.py
+"""
+
+# Official names of the mun/dept. of the cases (as in the DIVIPOLA dataset, before df_cleaning_names)
+OFFICIAL_NAMES = [('Antioquia', 'Caldas'),
+                  ('Antioquia', 'Caucasia'),
+                  ('Bolívar', 'El Carmen de Bolívar'),
+                  ('Boyacá', 'Susacon'),
+                  ('Caldas', 'Manizales'),
+                  ('Cauca', 'Santander de Quilichao'),
+                  ('Cundinamarca', 'Fusagasugá'),
+                  ('Huila', 'Neiva'),
+                  ('Nariño', 'Ipiales'),
+                  ('Santander', 'Bucaramanga'),
+                  ('Santander', 'Málaga'),
+                  ('Valle del Cauca', 'El Cerrito'),
+                  ('Valle del Cauca', 'Palmira')]
+
+# Name in SECOP -> expected standardized name
+MUN_NAMES_CASES = [
+    ('MUNICIPIO DEL CARMEN DE BOLIVAR', 'BOLÍVAR - ALCALDÍA MUNICIPIO DE CARMEN DE BOLÍVAR'),
+    ('MUNICIPIO DE EL CARMEN DE BOLIVAR', 'BOLÍVAR - ALCALDÍA MUNICIPIO DE CARMEN DE BOLÍVAR'),
+    ('MUNICIPIO DE SUSACON', 'BOYACÁ - ALCALDÍA MUNICIPIO DE SUSACÓN'),
+    ('MUNICIPIO EL CERRITO', 'VALLE DEL CAUCA - ALCALDÍA MUNICIPIO DE EL CERRITO'),
+    ('MUNICIPIO DE FUSAGASUGA (C/MARCA)', 'CUNDINAMARCA - ALCALDÍA MUNICIPIO DE FUSAGASUGÁ'),
+    ('MUNICIPIO DE SANTANDER DE QUILICHAO CAUCA', 'CAUCA - ALCALDÍA MUNICIPIO DE SANTANDER DE QUILICHAO'),
+    ('MUNICIPIO DE CAUCASIA', 'ANTIOQUIA - ALCALDÍA MUNICIPIO DE CAUCASIA'),
+    ('MUNICIPIO DE CAUCASIA ANTIOQUIA', 'ANTIOQUIA - ALCALDÍA MUNICIPIO DE CAUCASIA'),
+    ('MUNICIPIO DE CALDAS ANTIOQUIA', 'ANTIOQUIA - ALCALDÍA MUNICIPIO DE CALDAS'),
+    ('MUNICIPIO DE MALAGA SANTANDER', 'SANTANDER - ALCALDÍA MUNICIPIO DE MÁLAGA'),
+    ('MUNICIPIO DE IPIALES NARIÑO', 'NARIÑO - ALCALDÍA MUNICIPIO DE IPIALES'),
+    ('MUNICIPIO DE PALMIRA - VALLE DEL CAUCA', 'VALLE DEL CAUCA - ALCALDÍA MUNICIPIO DE PALMIRA'),
+    ('MUNICIPIO DE NEIVA', 'HUILA - ALCALDÍA MUNICIPIO DE NEIVA'),
+    ('MUNICIPIO DE MANIZALES', 'CALDAS - ALCALDÍA MUNICIPIO DE MANIZALES'),
+    ('GOBERNACION DEPARTAMENTO DEL CAUCA', 'CAUCA - GOBERNACIÓN'),
+    ('GOBERNACION DEPARTAMENTO DE CALDAS', 'CALDAS - GOBERNACIÓN'),
+    ('DEPARTAMENTO DE BOYACA', 'BOYACÁ - GOBERNACIÓN'),
+]
+
+
+def run_check(cases=MUN_NAMES_CASES):
+    """
+    Standardizes the names of the cases with the official names of OFFICIAL_NAMES
+
+    Returns
+    -------
+    dict
+        number of cases, names that differ from the expected ones (name in SECOP -> expected and result),
+        and ok (True if there are none)
+    """
+    df_names = pd.DataFrame(OFFICIAL_NAMES, columns=['departamento', 'municipio'])
+    df_names = clean.df_cleaning_names(df_names)
+    raw_names = [raw for raw, _ in cases]
+    standardized = clean.standardize_mun_names(raw_names, df_names)
+    failed = {raw: {'expected': expected, 'result': result}
+              for (raw, expected), result in zip(cases, standardized) if result != expected}
+    return {'cases': len(cases), 'failed': failed, 'ok': not failed}
+
+
+if __name__ == '__main__':
+    check = run_check()
+    print(json.dumps(check, indent=1, ensure_ascii=False))
+    sys.exit(0 if check['ok'] else 1)
@@ -0,0 +1,139 @@
+import json
+import re
+import sys
+import tempfile
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import data_extraction_functions as extract
+import secop_cache
+from secop_cache import CacheMissError, ContractCache
+
+"""
+Check of the local cache of SECOP queries (secop_cache) against a local stub of the SECOP API
+Covers a full download, a fresh hit (no request), the incremental refresh of a stale query ($where on the upload
+date, rows replaced by uid), an offline hit and an offline miss (CacheMissError)
+Exits with status 1 if a check fails
+Run from code/src: python check_secop_cache.py
+"""
+
+ENTITY_NAME = 'HUILA - ALCALDÍA MUNICIPIO DE NEIVA'
+# SoQL $where of an incremental refresh, as written by secop_cache.incremental_params
+WHERE_PATTERN = re.compile(secop_cache.DATE_COLUMN + r" > '([^']*)'")
+
+
+def stub_secop_handler(rows):
+    """
+    Request handler of a stub SECOP API over the rows given: filters by column = value, by the upload date
+    of an incremental $where and pages with $limit/$offset. The parameters of each request are recorded
+    """
+    requests = []
+
+    class StubSecopHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+
+        def do_GET(self):
+            params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            requests.append(params)
+            selected = [row for row in rows
+                        if all(row.get(k) == v for k, v in params.items() if not k.startswith('$'))]
+            where = WHERE_PATTERN.search(params.get('$where', ''))
+            if where:
+                selected = [row for row in selected if row[secop_cache.DATE_COLUMN] > where.group(1)]
+            offset = int(params.get('$offset', 0))
+            selected = selected[offset:offset + int(params.get('$limit', len(selected)))]
+            body = json.dumps(selected).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return StubSecopHandler, requests
+
+
+def contract(uid, date, description):
+    """Row of the stub API"""
+    return {'uid': uid,
+            'nombre_de_la_entidad': ENTITY_NAME,
+            'estado_del_proceso': 'Liquidado',
+            'anno_firma_del_contrato': date[:4],
+            'cuantia_proceso': '1000000',
+            'detalle_del_objeto_a_contratar': description,
+            secop_cache.DATE_COLUMN: date}
+
+
+def run_check():
+    """
+    Runs the queries of extract_mun_contracts through a ContractCache against the stub API
+
+    Returns
+    -------
+    dict
+        result of each check (True if passed), and ok (True if all of them passed)
+    """
+    rows = [contract('1', '2015-01-10T00:00:00.000', 'MANTENIMIENTO DE LA VIA 1'),
+            contract('2', '2015-02-10T00:00:00.000', 'MANTENIMIENTO DE LA VIA 2'),
+            contract('3', '2015-03-10T00:00:00.000', 'MANTENIMIENTO DE LA VIA 3')]
+    handler, requests = stub_secop_handler(rows)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:' + str(server.server_port) + '/resource/xvdy-vvsk.json'
+    params = extract.query_params({'nombre_de_la_entidad': ENTITY_NAME})
+    fetch = partial(extract.fetch_secop_df, page_size=2)
+
+    checks = {}
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ContractCache(cache_dir, ttl_hours=24)
+
+            # Full download: every page, no $where
+            df = cache.get_contracts(url, ENTITY_NAME, params, fetch)
+            checks['full_fetch'] = (sorted(df['uid']) == ['1', '2', '3'] and len(requests) == 2
+                                    and not any('$where' in request for request in requests))
+
+            # Fresh hit: no request
+            n_requests = len(requests)
+            df = cache.get_contracts(url, ENTITY_NAME, params, fetch)
+            checks['fresh_hit'] = len(df) == 3 and len(requests) == n_requests
+
+            # Stale query: only rows uploaded after the last cached one, a contract uploaded again is replaced
+            rows[0] = contract('1', '2015-04-10T00:00:00.000', 'MANTENIMIENTO DE LA VIA 1 ADICION')
+            rows.append(contract('4', '2015-05-10T00:00:00.000', 'MANTENIMIENTO DE LA VIA 4'))
+            cache.ttl_hours = 0
+            n_requests = len(requests)
+            df = cache.get_contracts(url, ENTITY_NAME, params, fetch)
+            wheres = [WHERE_PATTERN.search(request.get('$where', '')) for request in requests[n_requests:]]
+            descriptions = dict(zip(df['uid'], df['detalle_del_objeto_a_contratar']))
+            checks['stale_refresh'] = (len(wheres) > 0 and all(where is not None for where in wheres)
+                                       and all(where.group(1) == '2015-03-10T00:00:00.000' for where in wheres)
+                                       and sorted(df['uid']) == ['1', '2', '3', '4']
+                                       and descriptions['1'] == 'MANTENIMIENTO DE LA VIA 1 ADICION')
+
+            # Offline: cached query returned even if stale, query not cached raises CacheMissError
+            offline = ContractCache(cache_dir, ttl_hours=0, offline=True)
+            n_requests = len(requests)
+            df = offline.get_contracts(url, ENTITY_NAME, params, fetch)
+            checks['offline_hit'] = len(df) == 4 and len(requests) == n_requests
+            try:
+                offline.get_contracts(url, 'SANTANDER - ALCALDÍA MUNICIPIO DE BUCARAMANGA',
+                                      extract.query_params({'nombre_de_la_entidad': 'BUCARAMANGA'}), fetch)
+                checks['offline_miss'] = False
+            except CacheMissError:
+                checks['offline_miss'] = len(requests) == n_requests
+    finally:
+        server.shutdown()
+    checks['ok'] = all(checks.values())
+    return checks
+
+
+if __name__ == '__main__':
+    check = run_check()
+    print(json.dumps(check, indent=1))
+    sys.exit(0 if check['ok'] else 1)
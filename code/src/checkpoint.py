@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+import pandas as pd
+import unidecode
+
+"""
+Checkpoints of contracting_chain runs
+The chain of each mun/dept. is written to its own Parquet file (parts/) as soon as it is evaluated, and a manifest
+records the mun/dept. completed, skipped (no contracts to evaluate) and failed (with the error).
+A run restarted with the same checkpoint directory only evaluates the mun/dept. not completed/skipped, if it
+has the same options (see run_options) and the previous run was not completed; otherwise the run starts over.
+"""
+
+CHECKPOINT_VERSION = 2
+MANIFEST_FILE = 'manifest.json'
+PARTS_DIR = 'parts'
+
+
+def load_manifest(checkpoint_dir):
+    """Reads the manifest of the checkpoint directory (empty manifest if it does not exist)"""
+    os.makedirs(os.path.join(checkpoint_dir, PARTS_DIR), exist_ok=True)
+    path = os.path.join(checkpoint_dir, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == CHECKPOINT_VERSION:
+            return manifest
+    return {'version': CHECKPOINT_VERSION, 'municipalities': {}}
+
+
+def save_manifest(checkpoint_dir, manifest):
+    """Writes the manifest (to a temporary file first, so a crash never leaves it half written)"""
+    path = os.path.join(checkpoint_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def fingerprint(values):
+    """Hash of a set of values (e.g. uids of the entity contracts), independent of their order"""
+    digest = hashlib.sha1('\n'.join(sorted(str(value) for value in values)).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def run_options(n_contracts, threshold, n_rare, keep_invalid, entity_contracts, encoder):
+    """Options of a run that change its chain: parts built with other options are not reused"""
+    return {'n_contracts': n_contracts,
+            'threshold': threshold,
+            'n_rare': n_rare,
+            'keep_invalid': keep_invalid,
+            'entities': fingerprint(entity_contracts['uid']),
+            'encoder': None if encoder is None else encoder.fingerprint()}
+
+
+def resume_manifest(checkpoint_dir, options):
+    """
+    Manifest of a run with the options given: the manifest of the checkpoint directory if its run was
+    interrupted with the same options, a new one otherwise (run completed, or other options)
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        checkpoint directory
+    options : dict
+        options of the run (see run_options)
+
+    Returns
+    -------
+    dict
+        manifest of the run, with the options (written to the directory)
+    """
+    manifest = load_manifest(checkpoint_dir)
+    # A manifest without options (written before they were recorded) is not resumed either
+    other_options = manifest['municipalities'] and manifest.get('options') != options
+    if manifest.get('completed_at') or other_options:
+        print("Checkpoint: previous run " + ('completed' if manifest.get('completed_at') else 'with other options')
+              + ", starting over")
+        manifest = {'version': CHECKPOINT_VERSION, 'municipalities': {}}
+    manifest['options'] = options
+    save_manifest(checkpoint_dir, manifest)
+    return manifest
+
+
+def is_resumable(checkpoint_dir):
+    """True if the checkpoint directory has a run that was interrupted (not completed)"""
+    if not os.path.exists(os.path.join(checkpoint_dir, MANIFEST_FILE)):
+        return False
+    manifest = load_manifest(checkpoint_dir)
+    return 'options' in manifest and not manifest.get('completed_at')
+
+
+def complete_run(checkpoint_dir, manifest):
+    """Marks the run as completed if no mun/dept. failed (a failed mun/dept. is retried by the next run)"""
+    if summary(manifest)['failed'] == 0:
+        manifest['completed_at'] = datetime.now(timezone.utc).isoformat()
+        save_manifest(checkpoint_dir, manifest)
+
+
+def finished_mun(manifest):
+    """Names of the mun/dept. already completed or skipped"""
+    return {mun_name for mun_name, entry in manifest['municipalities'].items()
+            if entry['status'] in ('completed', 'skipped')}
+
+
+def part_file(mun_name, parts_dir=PARTS_DIR):
+    """Relative path of the chain file of a mun/dept.: readable name + hash"""
+    digest = hashlib.sha1(mun_name.encode('utf-8')).hexdigest()[:10]
+    slug = re.sub(r'\W+', '_', unidecode.unidecode(mun_name)).strip('_')[:60]
+    return os.path.join(parts_dir, slug + '-' + digest + '.parquet')
+
+
+def record_mun(checkpoint_dir, manifest, mun_name, chain_mun_df, error=None):
+    """
+    Writes the chain of a mun/dept. and records its status in the manifest
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        checkpoint directory
+    manifest : dict
+        manifest of the run (updated)
+    mun_name : str
+        name of the mun/dept.
+    chain_mun_df : dataframe
+        chain of the mun/dept. (None if there were no contracts to evaluate)
+    error : Exception
+        error raised while evaluating the mun/dept. (None if no error)
+    """
+    entry = {'finished_at': datetime.now(timezone.utc).isoformat()}
+    if error is not None:
+        entry.update(status='failed', error=type(error).__name__ + ': ' + str(error))
+    elif chain_mun_df is None:
+        entry.update(status='skipped')
+    else:
+        path = part_file(mun_name)
+        full_path = os.path.join(checkpoint_dir, path)
+        chain_mun_df.to_parquet(full_path + '.tmp', index=False)
+        os.replace(full_path + '.tmp', full_path)
+        entry.update(status='completed', file=path, rows=len(chain_mun_df))
+    manifest['municipalities'][mun_name] = entry
+    save_manifest(checkpoint_dir, manifest)
+
+
+def iter_chain(checkpoint_dir, manifest, list_mun):
+    """
+    Reads the chain of the mun/dept. completed, one mun/dept. at a time
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        checkpoint directory
+    manifest : dict
+        manifest of the run
+    list_mun : list
+        names of the mun/dept. to read (in this order)
+
+    Yields
+    ------
+    dataframe
+        chain of a mun/dept. completed
+    """
+    for mun_name in list_mun:
+        entry = manifest['municipalities'].get(mun_name)
+        if entry is None or entry['status'] != 'completed' or entry['rows'] == 0:
+            continue
+        yield pd.read_parquet(os.path.join(checkpoint_dir, entry['file']))
+
+
+def read_chain(checkpoint_dir, manifest, list_mun):
+    """Reads the chain of all the mun/dept. completed (see iter_chain)"""
+    chain_list = list(iter_chain(checkpoint_dir, manifest, list_mun))
+    if not chain_list:
+        return pd.DataFrame()
+    return pd.concat(chain_list, ignore_index=True, sort=False)
+
+
+def summary(manifest):
+    """Number of mun/dept. per status"""
+    statuses = [entry['status'] for entry in manifest['municipalities'].values()]
+    return {status: statuses.count(status) for status in ('completed', 'skipped', 'failed')}
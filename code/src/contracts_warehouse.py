@@ -0,0 +1,217 @@
+import re
+import sqlite3
+import sys
+import threading
+
+import pandas as pd
+import unidecode
+
+import data_cleaning_functions as clean
+import data_extraction_functions as extract
+
+"""
+Local SQLite warehouse of SECOP I contracts, to run the pipeline without the API
+A full export of SECOP I (CSV from datos.gov.co) is loaded once, with indexes on entity name, contractor name,
+status and signing year. The warehouse answers the queries of extract_entity_contracts/extract_mun_contracts
+in place of the API: pass it as the cache of the pipeline.
+
+    warehouse = ContractWarehouse('secop.sqlite')
+    warehouse.load_csv('SECOP_I.csv')
+    string_similarity.contracting_chain(list_mun, 3, df_entity, cache=warehouse)
+
+With clean=True, the filters of df_cleaning (status, amount and signing year) run as indexed predicates of the
+queries, and the frames returned are already cleaned.
+Load from the command line: python contracts_warehouse.py SECOP_I.csv secop.sqlite
+"""
+
+TABLE = 'contracts'
+# Indexed columns: lookups of the extraction functions and predicates of df_cleaning
+INDEXES = {'entity': ['nombre_de_la_entidad', 'estado_del_proceso', 'anno_firma_del_contrato'],
+           'contractor': ['nom_raz_social_contratista'],
+           'status': ['estado_del_proceso'],
+           'year': ['anno_firma_del_contrato']}
+NUMERIC_COLUMNS = {'anno_firma_del_contrato': 'INTEGER', 'cuantia_proceso': 'REAL'}
+# SoQL parameters that do not filter rows
+IGNORED_PARAMS = ['$limit', '$offset', '$order']
+
+
+def field_name(header):
+    """
+    API field name of a column of the CSV export (e.g. 'Anno Firma del Contrato' -> 'anno_firma_del_contrato')
+    Headers are matched to the fields of SECOP I (extract.SECOP_ALL_COLUMNS) as the API names them: accented
+    letters replaced by '_' ('Código de la Entidad' -> 'c_digo_de_la_entidad') and long names truncated
+    ('Objeto del Contrato a la Firma' -> 'objeto_del_contrato_a_la')
+    """
+    header = str(header).lower()
+    # Name without accents, and name with accented letters replaced as the API does
+    names = [re.sub(r'[^a-z0-9]+', '_', unidecode.unidecode(header)).strip('_'),
+             re.sub(r'[^a-z0-9]+', '_', header).strip('_')]
+    for name in names:
+        if name in extract.SECOP_ALL_COLUMNS:
+            return name
+    for name in names:
+        truncated = [column for column in extract.SECOP_ALL_COLUMNS if name.startswith(column + '_')]
+        if truncated:
+            return max(truncated, key=len)
+    return names[0]
+
+
+class ContractWarehouse:
+    """
+    SQLite database with the contracts of SECOP I (one row per uid)
+
+    Parameters
+    ----------
+    path : str
+        SQLite database file (created by load_csv)
+    clean : bool
+        If True, queries only return the contracts kept by df_cleaning (filtered in SQLite), already cleaned
+    """
+
+    def __init__(self, path, clean=False):
+        self.path = path
+        self.clean = clean
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Connections are not sent to worker processes: each one opens its own
+        return {'path': self.path, 'clean': self.clean}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['clean'])
+
+    def connection(self):
+        """Connection of the current thread (SQLite connections are not shared between threads)"""
+        if getattr(self._local, 'con', None) is None:
+            self._local.con = sqlite3.connect(self.path)
+        return self._local.con
+
+    def columns(self):
+        """Columns of the contracts table"""
+        return [row[1] for row in self.connection().execute('PRAGMA table_info(' + TABLE + ')')]
+
+    def load_csv(self, csv_path, chunksize=200000, columns=None):
+        """
+        Loads an export of SECOP I; contracts already in the warehouse (same uid) are replaced
+
+        Parameters
+        ----------
+        csv_path : str
+            CSV file downloaded from datos.gov.co (headers as in the export or as API field names)
+        chunksize : int
+            Rows read and inserted at a time
+        columns : list
+            columns to keep, e.g. extract.SECOP_COLUMNS (None for all the columns)
+
+        Returns
+        -------
+        int
+            number of rows read
+        """
+        con = self.connection()
+        con.execute('PRAGMA journal_mode = OFF')
+        con.execute('PRAGMA synchronous = OFF')
+        header = pd.read_csv(csv_path, nrows=0).columns
+        names = {col: field_name(col) for col in header}
+        if columns is not None:
+            names = {col: name for col, name in names.items() if name in columns}
+        table_columns = self.columns()
+        if not table_columns:
+            table_columns = list(dict.fromkeys(names.values()))
+            definition = ', '.join('"' + col + '" ' + NUMERIC_COLUMNS.get(col, 'TEXT')
+                                   + (' PRIMARY KEY' if col == 'uid' else '') for col in table_columns)
+            con.execute('CREATE TABLE ' + TABLE + ' (' + definition + ')')
+
+        n_rows = 0
+        for chunk in pd.read_csv(csv_path, dtype=str, usecols=list(names), chunksize=chunksize):
+            chunk.columns = [names[col] for col in chunk.columns]
+            chunk = chunk.loc[:, ~chunk.columns.duplicated()].reindex(columns=table_columns)
+            for col in NUMERIC_COLUMNS:
+                if col in chunk.columns:
+                    chunk[col] = pd.to_numeric(chunk[col], errors='coerce')
+            rows = chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None)
+            con.executemany('INSERT OR REPLACE INTO ' + TABLE + ' VALUES (' + ', '.join('?' * len(table_columns))
+                            + ')', rows)
+            n_rows += len(chunk)
+        self.create_indexes()
+        con.commit()
+        return n_rows
+
+    def create_indexes(self):
+        """Creates the indexes of the lookups (after the bulk load, which is faster without them)"""
+        table_columns = self.columns()
+        con = self.connection()
+        for name, index_columns in INDEXES.items():
+            if all(col in table_columns for col in index_columns):
+                con.execute('CREATE INDEX IF NOT EXISTS idx_' + name + ' ON ' + TABLE + ' ('
+                            + ', '.join('"' + col + '"' for col in index_columns) + ')')
+        con.execute('ANALYZE')
+
+    def query(self, filters, columns=None):
+        """
+        Gets the contracts matching all the filters (column = value)
+
+        Parameters
+        ----------
+        filters : dict
+            column -> value, e.g. {'nombre_de_la_entidad': mun_name}
+        columns : list
+            columns to return (None for all the columns)
+
+        Returns
+        -------
+        dataframe
+            contracts, with typed columns (cleaned if the warehouse has clean=True)
+        """
+        table_columns = self.columns()
+        if not table_columns:
+            raise LookupError('No contracts in ' + self.path + ': load an export of SECOP I with load_csv')
+        if columns is None:
+            columns = table_columns
+        select = ', '.join('"' + col + '"' for col in columns if col in table_columns)
+        where = ['"' + col + '" = ?' for col in filters]
+        values = list(filters.values())
+        if self.clean:
+            where += ['estado_del_proceso IN (' + ', '.join('?' * len(clean.CLEAN_STATES)) + ')',
+                      'cuantia_proceso >= 0', 'anno_firma_del_contrato >= 2012']
+            values += clean.CLEAN_STATES
+        sql = 'SELECT ' + select + ' FROM ' + TABLE + (' WHERE ' + ' AND '.join(where) if where else '')
+        df = extract.typed_chunk(pd.read_sql_query(sql, self.connection(), params=values))
+        if self.clean:
+            # Rows already filtered: df_cleaning only sets the dtypes
+            df = clean.df_cleaning(df)
+        return df
+
+    def get_contracts(self, url, entity_name, params, fetch=None):
+        """
+        Answers a SECOP query of the extraction functions (same interface as ContractCache.get_contracts)
+
+        Parameters
+        ----------
+        url : str
+            url of the SECOP dataset (only SECOP I is in the warehouse)
+        entity_name : str
+            name of the entity queried
+        params : dict
+            SoQL parameters of the query: column filters and $select
+        fetch : function
+            not used, the API is never queried
+
+        Returns
+        -------
+        dataframe
+            rows of the query
+        """
+        if url != extract.SECOP_URL:
+            raise ValueError('Dataset not in the warehouse: ' + url)
+        filters = {k: v for k, v in params.items() if not k.startswith('$')}
+        unsupported = [k for k in params if k.startswith('$') and k != '$select' and k not in IGNORED_PARAMS]
+        if unsupported:
+            raise ValueError('SoQL parameters not supported by the warehouse: ' + ', '.join(unsupported))
+        columns = params['$select'].split(',') if params.get('$select') else None
+        return self.query(filters, columns)
+
+
+if __name__ == '__main__':
+    warehouse = ContractWarehouse(sys.argv[2] if len(sys.argv) > 2 else 'secop.sqlite')
+    print('Rows loaded: ' + str(warehouse.load_csv(sys.argv[1])))
@@ -0,0 +1,205 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import chain_sinks
+
+"""
+Compact extract of the contracting chain for the dashboard (code/dashboard)
+Instead of the chain CSV, which repeats every column of both contracts in each pair, the extract is a directory
+of Parquet files:
+ - dim_entity, dim_mun, dim_contractor: names of the public entities, mun/dept. (with department, municipality
+   and level, as computed by the dashboard) and contractors of the mun/dept. contracts, one row per id
+ - fact_pairs: one row per pair, with the ids of the dimensions, contract ids, years, amounts, score and valid
+ - rollup_department, rollup_mun, rollup_year, rollup_contractor: pairs, contracts, amounts and mean score per
+   entity and department/mun/dept./signing year/contractor (amounts of a contract are counted once)
+It is written alongside the chain (DashboardSink, with a TeeSink) or built from a chain file:
+python dashboard_extract.py contracting_chain.csv dashboard_extract
+"""
+
+# Columns of the chain kept in the dimensions
+DIMENSIONS = {'entity': 'nombre_de_la_entidad',
+              'mun': 'nom_raz_soc_stand',
+              'contractor': 'nom_raz_social_contratista_mun'}
+# Columns of the chain kept in the fact table, with their types
+FACT_COLUMNS = {'hop': 'int8',
+                'uid': 'string',
+                'uid_mun': 'string',
+                'anno_firma_del_contrato': 'Int16',
+                'anno_firma_del_contrato_mun': 'Int16',
+                'cuantia_proceso': 'float64',
+                'cuantia_contrato': 'float64',
+                'cuantia_proceso_mun': 'float64',
+                'cuantia_contrato_mun': 'float64',
+                'score': 'float32',
+                'valid': 'bool'}
+# Keys of the rollups (besides the entity)
+ROLLUPS = {'department': 'departamento',
+           'mun': 'mun_id',
+           'year': 'anno_firma_del_contrato',
+           'contractor': 'contractor_id'}
+COMPRESSION = 'zstd'
+
+
+def encode(values, mapping):
+    """Ids of the values in mapping (new values are added with the next ids)"""
+    values = values.fillna('').astype(str)
+    for value in values.unique():
+        if value not in mapping:
+            mapping[value] = len(mapping)
+    return values.map(mapping).to_numpy(dtype=np.int32)
+
+
+def fact_chunk(chunk, dims):
+    """
+    Rows of the fact table of a chunk of the chain
+
+    Parameters
+    ----------
+    chunk : dataframe
+        pairs of contracts (chain of contracting_chain or edges of contracting_chain_graph)
+    dims : dict
+        dimension -> mapping name -> id (updated with the new names)
+
+    Returns
+    -------
+    dataframe
+        ids of the dimensions and FACT_COLUMNS, typed
+    """
+    facts = pd.DataFrame({name + '_id': encode(chunk[col], dims[name]) if col in chunk.columns
+                          else encode(pd.Series('', index=chunk.index), dims[name])
+                          for name, col in DIMENSIONS.items()})
+    for col, dtype in FACT_COLUMNS.items():
+        if col not in chunk.columns:
+            values = pd.Series(1 if col == 'hop' else None, index=chunk.index)
+        else:
+            values = chunk[col]
+        if dtype == 'string':
+            facts[col] = values.astype(str).to_numpy()
+        elif dtype == 'bool':
+            facts[col] = values.astype(str).str.lower().isin(['true', '1']).to_numpy()
+        else:
+            facts[col] = pd.to_numeric(values, errors='coerce').to_numpy()
+    return facts.astype(FACT_COLUMNS)
+
+
+def dim_mun(names):
+    """Dimension of mun/dept.: department, municipality and level, as the calculations of the dashboard"""
+    names = pd.Series(names, dtype=object)
+    parts = names.str.split(' - ', n=1)
+    department = parts.str[0].str.strip().str.capitalize()
+    second = parts.str[1].fillna('')
+    municipality = second.str.split('ALCALDÍA MUNICIPIO DE ').str[-1].str.strip().str.capitalize()
+    is_gob = second.str.contains('GOBERNACI')
+    return pd.DataFrame({'mun_id': np.arange(len(names), dtype=np.int32),
+                         'nom_raz_soc_stand': names,
+                         'departamento': department,
+                         'municipio': municipality.where(~is_gob, None),
+                         'nivel': np.where(is_gob, 'Gobernación', 'Municipios')})
+
+
+def rollup(facts, key):
+    """Pairs, contracts, amounts (each contract counted once) and mean score per entity and key"""
+    keys = ['entity_id', key]
+    groups = facts.groupby(keys, observed=True, dropna=False)
+    df = groups.agg(pairs=('uid', 'size'), valid_pairs=('valid', 'sum'), mean_score=('score', 'mean'),
+                    entity_contracts=('uid', 'nunique'), mun_contracts=('uid_mun', 'nunique'))
+    entity_amounts = facts.drop_duplicates(keys + ['uid']).groupby(keys, observed=True, dropna=False)[
+        ['cuantia_proceso', 'cuantia_contrato']].sum()
+    mun_amounts = facts.drop_duplicates(keys + ['uid_mun']).groupby(keys, observed=True, dropna=False)[
+        ['cuantia_proceso_mun', 'cuantia_contrato_mun']].sum()
+    return df.join(entity_amounts).join(mun_amounts).reset_index()
+
+
+def write_extract(out_dir, facts, dims):
+    """
+    Writes the dimensions, fact table and rollups to out_dir
+
+    Parameters
+    ----------
+    out_dir : str
+        directory of the extract
+    facts : dataframe
+        fact table (concatenation of fact_chunk)
+    dims : dict
+        dimension -> mapping name -> id
+
+    Returns
+    -------
+    dict
+        name of each file -> number of rows
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    tables = {'dim_entity': pd.DataFrame({'entity_id': np.arange(len(dims['entity']), dtype=np.int32),
+                                          DIMENSIONS['entity']: list(dims['entity'])}),
+              'dim_mun': dim_mun(list(dims['mun'])),
+              'dim_contractor': pd.DataFrame({'contractor_id': np.arange(len(dims['contractor']), dtype=np.int32),
+                                              DIMENSIONS['contractor']: list(dims['contractor'])}),
+              'fact_pairs': facts}
+
+    facts = facts.assign(departamento=pd.Categorical(
+        tables['dim_mun']['departamento'].to_numpy()[facts['mun_id'].to_numpy()]))
+    for name, key in ROLLUPS.items():
+        tables['rollup_' + name] = rollup(facts, key)
+
+    for name, df in tables.items():
+        path = os.path.join(out_dir, name + '.parquet')
+        df.to_parquet(path + '.tmp', index=False, compression=COMPRESSION)
+        os.replace(path + '.tmp', path)
+    return {name: len(df) for name, df in tables.items()}
+
+
+class DashboardSink(chain_sinks.ChainSink):
+    """
+    Writes the dashboard extract of the chain (see write_extract) to a directory
+    The fact table is built chunk by chunk (typed, with ids instead of names), files are written on close
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.dims = {name: {} for name in DIMENSIONS}
+        self._facts = []
+
+    def _write(self, chunk):
+        self._facts.append(fact_chunk(chunk, self.dims))
+
+    def close(self):
+        if self._facts is None:
+            return
+        if self._facts:
+            facts = pd.concat(self._facts, ignore_index=True)
+        else:
+            facts = fact_chunk(pd.DataFrame(), self.dims)
+        write_extract(self.path, facts, self.dims)
+        self._facts = None
+
+
+def build_extract(chain_path, out_dir, chunksize=100000):
+    """
+    Builds the dashboard extract of a chain file written by a sink (.csv or .parquet)
+
+    Returns
+    -------
+    int
+        number of pairs
+    """
+    columns = list(DIMENSIONS.values()) + list(FACT_COLUMNS)
+    if chain_path.lower().endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(chain_path)
+        columns = [col for col in columns if col in parquet_file.schema.names]
+        chunks = (batch.to_pandas() for batch in parquet_file.iter_batches(chunksize, columns=columns))
+    else:
+        chunks = pd.read_csv(chain_path, usecols=lambda col: col in columns, dtype={'uid': str, 'uid_mun': str},
+                             chunksize=chunksize)
+    with DashboardSink(out_dir) as sink:
+        for chunk in chunks:
+            sink.write(chunk)
+    return sink.rows
+
+
+if __name__ == '__main__':
+    n_pairs = build_extract(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'dashboard_extract')
+    print('Pairs in the extract: ' + str(n_pairs))
@@ -1,25 +1,118 @@
+import os
 import pandas as pd
 import re
-from nltk.corpus import stopwords
-import nltk
+from functools import lru_cache
 import unidecode
 import unicodedata
 
-nltk.download('punkt')
-nltk.download('stopwords')
+# Local copy of the nltk stopwords: worker processes read it instead of importing nltk
+STOPWORDS_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'contracting_chain')
+
+
+@lru_cache(maxsize=None)
+def load_stopwords(language='spanish'):
+    """
+    Stopwords of the nltk corpus, loaded on first use (nothing is imported or downloaded at import time)
+    Read from the local copy in STOPWORDS_CACHE_DIR if it exists; otherwise from nltk (downloaded only if the
+    corpus is not installed) and saved to the local copy
+
+    Parameters
+    ----------
+    language : str
+        language of the stopwords
+
+    Returns
+    -------
+    list
+        stopwords (lowercase, as in nltk)
+    """
+    path = os.path.join(STOPWORDS_CACHE_DIR, 'stopwords_' + language + '.txt')
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return f.read().split()
+
+    import nltk
+    from nltk.corpus import stopwords
+    try:
+        words = stopwords.words(language)
+    except LookupError:
+        nltk.download('stopwords', quiet=True)
+        words = stopwords.words(language)
+
+    try:
+        os.makedirs(STOPWORDS_CACHE_DIR, exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(words))
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass  # read-only home: nltk is used again next time
+    return words
+
+
+# States of the process of the contracts kept by df_cleaning
+CLEAN_STATES = ['Liquidado', 'Terminado Sin Liquidar', 'Celebrado', 'Adjudicado', 'Convocado']
+# Flag (in DataFrame.attrs, kept by slices of the frame) of the frames already cleaned by df_cleaning
+CLEANED_ATTR = 'secop_cleaned'
 
 
 def df_cleaning(df_secop):
-    """ CLeans df of contracts in SECOP """
+    """
+    CLeans df of contracts in SECOP
+    Keeps the contracts in the states allowed, with amount >= 0 and signed since 2012 (a single mask, the
+    rows are copied once), with compact dtypes: categorical state, int16 signing year and string descriptions
+    A frame already cleaned (or a slice of it) is not filtered again, only given a new index: the flag set
+    by df_cleaning is trusted if the dtypes and values it sets still hold (see is_cleaned)
+
+    Parameters
+    ----------
+    df_secop : dataframe
+        contracts as returned by the API (raw or with typed columns)
 
-    sorter = ['Liquidado', 'Terminado Sin Liquidar', 'Celebrado', 'Adjudicado', 'Convocado']
-    df_secop = df_secop[df_secop['estado_del_proceso'].isin(sorter)]
-    df_secop[['cuantia_proceso']] = df_secop[['cuantia_proceso']].apply(pd.to_numeric)
-    df_secop[['anno_firma_del_contrato']] = df_secop[['anno_firma_del_contrato']].apply(pd.to_numeric)
-    df_secop = df_secop.loc[df_secop['cuantia_proceso'] >= 0]
-    df_secop = df_secop.loc[df_secop['anno_firma_del_contrato'] >= 2012]
-    df_secop = df_secop.reset_index(drop=True)
-    return df_secop
+    Returns
+    -------
+    dataframe
+        contracts kept, with a new index
+    """
+    if is_cleaned(df_secop):
+        if isinstance(df_secop.index, pd.RangeIndex) and df_secop.index.start == 0 and df_secop.index.step == 1:
+            return df_secop
+        df_clean = df_secop.copy(deep=False)
+        df_clean.index = pd.RangeIndex(len(df_clean))
+        return df_clean
+
+    amount = pd.to_numeric(df_secop['cuantia_proceso'])
+    year = pd.to_numeric(df_secop['anno_firma_del_contrato'])
+    mask = (df_secop['estado_del_proceso'].isin(CLEAN_STATES).to_numpy() & (amount >= 0).to_numpy()
+            & (year >= 2012).to_numpy())
+    rows = mask.nonzero()[0]
+
+    df_clean = df_secop.take(rows)
+    df_clean.index = pd.RangeIndex(len(df_clean))
+    df_clean['estado_del_proceso'] = pd.Categorical(df_clean['estado_del_proceso'].astype(object),
+                                                    categories=CLEAN_STATES)
+    df_clean['cuantia_proceso'] = amount.to_numpy()[rows]
+    df_clean['anno_firma_del_contrato'] = year.to_numpy()[rows].astype('int16')
+    if 'detalle_del_objeto_a_contratar' in df_clean.columns:
+        df_clean['detalle_del_objeto_a_contratar'] = df_clean['detalle_del_objeto_a_contratar'].astype(
+            'string[pyarrow]')
+    df_clean.attrs[CLEANED_ATTR] = True
+    return df_clean
+
+
+def is_cleaned(df_secop):
+    """
+    True if the frame has the flag of df_cleaning and still satisfies it: the flag is kept by attrs through
+    astype, reindex, concat or Parquet, so the dtypes and filters of df_cleaning are checked as well (no copy)
+    """
+    if not df_secop.attrs.get(CLEANED_ATTR):
+        return False
+    if not {'estado_del_proceso', 'cuantia_proceso', 'anno_firma_del_contrato'} <= set(df_secop.columns):
+        return False
+    status, year = df_secop['estado_del_proceso'], df_secop['anno_firma_del_contrato']
+    if not (isinstance(status.dtype, pd.CategoricalDtype) and list(status.cat.categories) == CLEAN_STATES
+            and year.dtype == 'int16'):
+        return False
+    return bool(status.notna().all() and (year >= 2012).all() and (df_secop['cuantia_proceso'] >= 0).all())
 
 
 def df_filter_entity(df_entity):
@@ -48,6 +141,60 @@ def df_filter_entity(df_entity):
     return df_entity_filtered, clean_mun_dept
 
 
+# Special cases of names of municipalities in SECOP, applied in order by standarize_mun
+MUN_SPECIAL_CASES = [
+    ('DEPARTAMENTO DE|DEPARTAEMNTO DE| EN EL DEPARTAMENTO DE | EN EL DEPARTAMENTO DEL', ' - '),
+    ('MUNICIPIO DEL CARMEN DE BOLIVAR', 'MUNICIPIO DE CARMEN DE BOLIVAR'),
+    ('MUNICIPIO DE EL CARMEN DE BOLIVAR', 'MUNICIPIO DE CARMEN DE BOLIVAR'),
+    ('SANTIAGO DE CALI', 'CALI'),
+    ('SAN JOSE DE CUCUTA', 'CUCUTA'),
+    ('MUNICIPIO EL CERRITO', 'MUNICIPIO DE EL CERRITO'),
+    ('LE RETEN', 'EL RETEN'),
+    ('PROVIDENCIA Y SANTA CATALINA ISLAS', 'PROVIDENCIA Y SANTA CATALINA'),
+    ('SAN JUAN BAUTISTA DE GUACARI', 'GUACARI'),
+    ('SUSACON', 'SUSACÓN'),
+    ('(C/MARCA)', ' - CUNDINAMARCA '),
+]
+# Special cases of names of departments in SECOP, applied in order by standarize_depto
+DEPTO_SPECIAL_CASES = [
+    ('GOBERNACION', ''),
+    ('DEPARTAMENTO DEL', 'DEPARTAMENTO DE'),
+    ('DEPARTAMENTO DE', 'GOBERNACIÓN -'),
+]
+# Special cases of the official names of municipalities/departments, applied in order by df_cleaning_names
+NAMES_SPECIAL_CASES = {
+    'municipio': [
+        ('EL CARMEN DE BOLÍVAR', 'CARMEN DE BOLÍVAR'),
+        ('EL CARMEN DE VIBORAL', 'CARMEN DE VIBORAL'),
+        ('PROVIDENCIA', 'PROVIDENCIA Y SANTA CATALINA'),
+        ('ESPINAL', 'EL ESPINAL'),
+        ('ITAGUI', 'ITAGÜÍ'),
+        ('TOLÚ VIEJO', 'TOLUVIEJO'),
+        ('TIMBIQUÍ', 'TIMBIQUI'),
+        ('CHIPATÁ', 'CHIPATA'),
+        ('SUSACON', 'SUSACÓN'),
+        ('TIMBÍO', 'TIMBIO'),
+        ('CURITÍ', 'CURITI'),
+    ],
+    'departamento': [
+        ('ARCHIPIÉLAGO DE SAN ANDRÉS, PROVIDENCIA Y SANTA CATALINA', 'SAN ANDRÉS PROVIDENCIA Y SANTA CATALINA'),
+    ],
+}
+
+
+def _compile_cases(special_cases):
+    return [(re.compile(pattern), repl) for pattern, repl in special_cases]
+
+
+_mun_cases = _compile_cases(MUN_SPECIAL_CASES)
+_depto_cases = _compile_cases(DEPTO_SPECIAL_CASES)
+_names_cases = {col: _compile_cases(cases) for col, cases in NAMES_SPECIAL_CASES.items()}
+_dot_regex = re.compile(r'\.')
+_spaces_regex = re.compile(' +')
+_parenthesis_regex = re.compile('[(){}<>]')
+_dash_regex = re.compile('(^.*)(-)(.*$)')
+
+
 # Taken from: https://stackoverflow.com/questions/14153364/reorder-string-using-regular-expressions
 def standarize_mun(mun):
     """
@@ -58,28 +205,16 @@ def standarize_mun(mun):
     # Special cases
     if "MUNICIPIO DE" not in mun:
         nmun = re.sub('MUNICIPIO', 'MUNICIPIO DE', nmun)
-    nmun = re.sub('DEPARTAMENTO DE|DEPARTAEMNTO DE| EN EL DEPARTAMENTO DE | EN EL DEPARTAMENTO DEL', ' - ', nmun)
-    nmun = re.sub('MUNICIPIO DEL CARMEN DE BOLIVAR', 'MUNICIPIO DE CARMEN DE BOLIVAR', nmun)
-    nmun = re.sub('MUNICIPIO DE EL CARMEN DE BOLIVAR', 'MUNICIPIO DE CARMEN DE BOLIVAR', nmun)
-    nmun = re.sub('MUNICIPIO DEL CARMEN DE BOLIVAR', 'MUNICIPIO DE CARMEN DE BOLIVAR', nmun)
-    nmun = re.sub('MUNICIPIO DE EL CARMEN DE BOLIVAR', 'MUNICIPIO DE CARMEN DE BOLIVAR', nmun)
-    nmun = re.sub('SANTIAGO DE CALI', 'CALI', nmun)
-    nmun = re.sub('SAN JOSE DE CUCUTA', 'CUCUTA', nmun)
-    nmun = re.sub('MUNICIPIO EL CERRITO', 'MUNICIPIO DE EL CERRITO', nmun)
-    nmun = re.sub('LE RETEN', 'EL RETEN', nmun)
-    nmun = re.sub('PROVIDENCIA Y SANTA CATALINA ISLAS', 'PROVIDENCIA Y SANTA CATALINA', nmun)
-    nmun = re.sub('SAN JUAN BAUTISTA DE GUACARI', 'GUACARI', nmun)
-    nmun = re.sub('SUSACON', 'SUSACÓN', nmun)
-    nmun = re.sub('(C/MARCA)', ' - CUNDINAMARCA ', nmun)
+    for pattern, repl in _mun_cases:
+        nmun = pattern.sub(repl, nmun)
 
     # Regexp cleaning
-    nmun = re.sub('\.', '', nmun)
-    nmun = re.sub(' +', ' ', nmun)
-    nmun = re.sub('[(){}<>]', '', nmun)  # Parentesis
-    r = re.compile('(^.*)(-)(.*$)')
-    nmun = r.sub(r'\3' + ' - ALCALDÍA ' + r'\1', nmun)
+    nmun = _dot_regex.sub('', nmun)
+    nmun = _spaces_regex.sub(' ', nmun)
+    nmun = _parenthesis_regex.sub('', nmun)  # Parentesis
+    nmun = _dash_regex.sub(r'\3' + ' - ALCALDÍA ' + r'\1', nmun)
     nmun = nmun.lstrip()  # Remove spaces before beginning
-    nmun = re.sub('\.', '', nmun)
+    nmun = _spaces_regex.sub(' ', nmun)
     return nmun
 
 
@@ -89,19 +224,17 @@ def standarize_depto(depto):
     Includes several special cases
     """
     # Special cases
-    ndepto = re.sub('GOBERNACION', '', depto)
-    ndepto = re.sub('DEPARTAMENTO DEL', 'DEPARTAMENTO DE', ndepto)
-    ndepto = re.sub('DEPARTAMENTO DE', 'GOBERNACIÓN -', ndepto)
+    ndepto = depto
+    for pattern, repl in _depto_cases:
+        ndepto = pattern.sub(repl, ndepto)
 
     # Regexp cleaning
-    ndepto = re.sub('\.', '', ndepto)
-    ndepto = re.sub(' +', ' ', ndepto)
-    ndepto = re.sub('[(){}<>]', '', ndepto)  # Parentesis
-    r = re.compile('(^.*)(-)(.*$)')
-    ndepto = r.sub(r'\3' + ' - ' + r'\1', ndepto)
+    ndepto = _dot_regex.sub('', ndepto)
+    ndepto = _spaces_regex.sub(' ', ndepto)
+    ndepto = _parenthesis_regex.sub('', ndepto)  # Parentesis
+    ndepto = _dash_regex.sub(r'\3' + ' - ' + r'\1', ndepto)
     ndepto = ndepto.lstrip()  # Remove spaces before beginning
-    ndepto = re.sub('\.', '', ndepto)
-    ndepto = re.sub(' +', ' ', ndepto)
+    ndepto = _spaces_regex.sub(' ', ndepto)
     return ndepto
 
 
@@ -110,22 +243,89 @@ def strip_accents(s):
                    if not unicodedata.name(c).endswith('ACCENT'))
 
 
+class DescriptionNormalizer:
+    """
+    Standardizes descriptions of the contracts
+    Stopwords and regexes are loaded once, and results are cached by raw description
+
+    Parameters
+    ----------
+    cache_size : int
+        Max. number of descriptions kept in the cache (None for no limit)
+    """
+
+    non_word_regex = re.compile(r'[^\w\s]')
+    spaces_regex = re.compile(' +')
+
+    def __init__(self, cache_size=2 ** 18):
+        self.stopwords = frozenset(x.upper() for x in load_stopwords("spanish"))
+        self._normalize_cached = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _normalize(self, clean_str):
+        clean_str = clean_str.upper()
+        clean_str = ' '.join([word for word in clean_str.split() if word not in self.stopwords])
+        clean_str = unidecode.unidecode(clean_str)
+        clean_str = self.non_word_regex.sub('', clean_str)
+        clean_str = self.spaces_regex.sub(' ', clean_str)
+        return clean_str
+
+    def __call__(self, string_obj):
+        return self._normalize_cached(str(string_obj))
+
+    def normalize_series(self, descriptions):
+        """
+        Standardizes a series of descriptions, each distinct description only once
+
+        Parameters
+        ----------
+        descriptions : series
+            descriptions of the contracts
+
+        Returns
+        -------
+        series
+            standardized descriptions, with the same index
+        """
+        if isinstance(descriptions.dtype, pd.StringDtype):
+            # Missing descriptions as in object columns (str(nan))
+            descriptions = descriptions.fillna('nan')
+        descriptions = descriptions.astype(str)
+        uniques = pd.unique(descriptions)
+        mapping = dict(zip(uniques, map(self._normalize_cached, uniques)))
+        return descriptions.map(mapping)
+
+    def cache_clear(self):
+        """Forgets the descriptions already standardized"""
+        self._normalize_cached.cache_clear()
+
+
+_obj_normalizer = None
+
+
+def get_obj_normalizer():
+    """Returns the normalizer of descriptions shared by the whole process"""
+    global _obj_normalizer
+    if _obj_normalizer is None:
+        _obj_normalizer = DescriptionNormalizer()
+    return _obj_normalizer
+
+
 def standarize_obj(string_obj):
     """ Standardize description of the contract"""
-    cachedStopWords = stopwords.words("spanish")
-    cachedStopWords = [x.upper() for x in cachedStopWords]
-    clean_str = str(string_obj).upper()
-    clean_str = ' '.join([word for word in clean_str.split() if word not in cachedStopWords])
-    clean_str = unidecode.unidecode(clean_str)
-    clean_str = re.sub(r'[^\w\s]', '', clean_str)
-    clean_str = re.sub(' +', ' ', clean_str)
-    return clean_str
+    return get_obj_normalizer()(string_obj)
 
 
 # Taken from: https://stackoverflow.com/questions/5541745/get-rid-of-stopwords-and-punctuation
 def remove_stopwords(sentence, language):
     """Removes stopwords"""
-    return [token for token in nltk.word_tokenize(sentence) if token.lower() not in stopwords.words(language)]
+    import nltk
+    try:
+        tokens = nltk.word_tokenize(sentence)
+    except LookupError:
+        nltk.download('punkt', quiet=True)
+        tokens = nltk.word_tokenize(sentence)
+    language_stopwords = set(load_stopwords(language))
+    return [token for token in tokens if token.lower() not in language_stopwords]
 
 
 def df_cleaning_names(df_names):
@@ -136,28 +336,73 @@ def df_cleaning_names(df_names):
     df_names['departamento'] = df_names['departamento'].str.upper()
     df_names['municipio'] = df_names['municipio'].str.upper()
     # Particular cases
-    df_names['municipio'] = [re.sub('EL CARMEN DE BOLÍVAR', 'CARMEN DE BOLÍVAR', item) for item in
-                             df_names['municipio']]
-    df_names['municipio'] = [re.sub('EL CARMEN DE VIBORAL', 'CARMEN DE VIBORAL', item) for item in
-                             df_names['municipio']]
-    df_names['municipio'] = [re.sub('PROVIDENCIA', 'PROVIDENCIA Y SANTA CATALINA', item) for item in
-                             df_names['municipio']]
-    df_names['municipio'] = [re.sub('ESPINAL', 'EL ESPINAL', item) for item in df_names['municipio']]
-    df_names['municipio'] = [re.sub('ITAGUI', 'ITAGÜÍ', item) for item in df_names['municipio']]
-    df_names['municipio'] = [re.sub('TOLÚ VIEJO', 'TOLUVIEJO', item) for item in df_names['municipio']]
-    df_names['municipio'] = [re.sub('TIMBIQUÍ', 'TIMBIQUI', item) for item in df_names['municipio']]
-    df_names['municipio'] = [re.sub('CHIPATÁ', 'CHIPATA', item) for item in df_names['municipio']]
-    df_names['municipio'] = [re.sub('SUSACON', 'SUSACÓN', item) for item in df_names['municipio']]
-    df_names['municipio'] = [re.sub('TIMBÍO', 'TIMBIO', item) for item in df_names['municipio']]
-    df_names['municipio'] = [re.sub('CURITÍ', 'CURITI', item) for item in df_names['municipio']]
-    df_names['departamento'] = [
-        re.sub('ARCHIPIÉLAGO DE SAN ANDRÉS, PROVIDENCIA Y SANTA CATALINA', 'SAN ANDRÉS PROVIDENCIA Y SANTA CATALINA',
-               item) for item in df_names['departamento']]
+    for col, cases in _names_cases.items():
+        names = df_names[col].tolist()
+        for pattern, repl in cases:
+            names = [pattern.sub(repl, item) for item in names]
+        df_names[col] = names
 
     return df_names
 
 
-def standardize_accents_mun(df_names, names_mun_standard):
+def _names_regex(names):
+    """Regex matching any of the names as whole words, longest names first"""
+    names = sorted(set(names), key=len, reverse=True)
+    return re.compile(r'(?<!\w)(' + '|'.join(re.escape(name) for name in names) + r')(?!\w)')
+
+
+class MunNamesIndex:
+    """
+    Lookup structures over the official names of municipalities/departments
+    Built once, they standardize each contractor name with a couple of regex scans and dict lookups
+
+    Parameters
+    ----------
+    df_names
+        df with the official names for municipalities and departments (cleaned with df_cleaning_names)
+    """
+
+    def __init__(self, df_names):
+        depts = df_names['departamento'].tolist()
+        muns = df_names['municipio'].tolist()
+
+        # Name without accents -> official name (municipalities after departments, as they were applied)
+        self.accents = {}
+        for name in depts + muns:
+            self.accents[strip_accents(name)] = name
+        self.accents_regex = _names_regex(self.accents)
+
+        # Official department names, to find the department in the name of a municipality
+        self.depts_regex = _names_regex(depts)
+
+        # Municipality -> department
+        self.mun_dept = dict(zip(muns, depts))
+
+    def standardize_accents(self, name):
+        """Replaces every name without accents of a mun/dept. by its official name"""
+        return self.accents_regex.sub(lambda match: self.accents[match.group(0)], name)
+
+    def standardize_format(self, name):
+        """Formats the name as 'DEPARTMENT - ALCALDÍA MUNICIPIO DE MUNICIPALITY'"""
+        if '-' in name:  # If it already has format
+            return name.rstrip()
+
+        # 1. Municipalities with department name: department at the end of the name
+        item = name.lstrip()
+        if 'CARMEN DE BOLÍVAR' not in item:
+            depts_found = list(self.depts_regex.finditer(item))
+            if depts_found:
+                idx = depts_found[-1].start()
+                return standarize_mun(item[:idx] + " - " + item[idx:]).rstrip()
+
+        # 2. Municipalities without department name
+        string = name.replace("MUNICIPIO DE ", "").lstrip()
+        if string in self.mun_dept:
+            name = self.mun_dept[string] + ' - ' 'ALCALDÍA MUNICIPIO DE ' + string
+        return name.rstrip()
+
+
+def standardize_accents_mun(df_names, names_mun_standard, names_index=None):
     """
     Standardize accents of mun/dept with official names
 
@@ -167,57 +412,59 @@ def standardize_accents_mun(df_names, names_mun_standard):
         df with the official names for municipalities and departments
     names_mun_standard
         list with standardized names of mun/dept.
+    names_index
+        MunNamesIndex of df_names (built if None)
     Returns
     -------
-    dataframe
-        df with contracts issued from the public entity to any mun/dept.
+    list
+        names of mun/dept. with the accents of the official names
     """
-    dept_t = list(set(df_names['departamento'].tolist()))  # Accent
-    dept_st = [strip_accents(item) for item in df_names]  # No accent
-    mun_t = list(set(df_names['municipio'].tolist()))  # CON TILDES
-    mun_st = [strip_accents(item) for item in df_names]  # SIN TILDES
+    if names_index is None:
+        names_index = MunNamesIndex(df_names)
+    return [names_index.standardize_accents(item) for item in names_mun_standard]
 
-    # Standardization accents of departments
-    for contd, dept in enumerate(dept_st):
-        for i, item in enumerate(names_mun_standard):
-            if dept in item:
-                names_mun_standard[i] = re.sub(dept, dept_t[contd], item)
 
-    # Standardization accents municipalities
-    for contm, mun in enumerate(mun_st):
-        for i, item in enumerate(names_mun_standard):
-            if mun in item:
-                names_mun_standard[i] = re.sub(mun, mun_t[contm], item)
+def standardize_format_mun(df_names, names_mun_standard, names_index=None):
+    """Standardize format of mun/dept names"""
+    if names_index is None:
+        names_index = MunNamesIndex(df_names)
+    return [names_index.standardize_format(item) for item in names_mun_standard]
 
-    return names_mun_standard
 
+def standardize_mun_names(names_mun_list, df_names, names_index=None):
+    """
+    Standardizes names of mun/dept. (contractors of the public entity) to the official names
 
-def standardize_format_mun(df_names, names_mun_standard):
-    """Standardize format of mun/dept names"""
-    # 1. Municipalities with department name
-    deptos_t = list(set(df_names['departamento'].tolist()))  # Accent
-    for i, item in enumerate(names_mun_standard):
-        for contd, depto in enumerate(deptos_t):
-            if '-' in item: break  # If it already has format
-            item = item.lstrip()
-            if 'CARMEN DE BOLÍVAR' in item: continue
-            if depto in item:
-                my_str = item
-                substr = depto
-                inserttxt = " - "
-                idx = my_str.index(substr)
-                names_mun_standard[i] = my_str[:idx] + inserttxt + my_str[idx:]
-                names_mun_standard[i] = standarize_mun(names_mun_standard[i])
-
-    # 2. Municipalities without department name
-    for i, item in enumerate(names_mun_standard):
-        if '-' in item: continue
-        string = names_mun_standard[i].replace("MUNICIPIO DE ", "")  # remove the 8 from the string borders
-        string = string.lstrip()
-        for contm, mun in enumerate(df_names['municipio']):
-            if mun == string:
-                names_mun_standard[i] = df_names['departamento'][contm] + ' - ' 'ALCALDÍA MUNICIPIO DE ' + string
-
-    names_mun_standard = [re.sub(r'\s+$', '', item) for item in names_mun_standard]
-
-    return names_mun_standard
\ No newline at end of file
+    Parameters
+    -------
+    names_mun_list
+        list with names of mun/dept. as they appear in SECOP
+    df_names
+        df with the official names for municipalities and departments (cleaned with df_cleaning_names)
+    names_index
+        MunNamesIndex of df_names (built if None)
+    Returns
+    -------
+    list
+        standardized names, as 'DEPARTMENT - ALCALDÍA MUNICIPIO DE MUNICIPALITY' or 'DEPARTMENT - GOBERNACIÓN'
+    """
+    # First standardization: names of mun/dept. with contracts with the entity
+    names_mun_list = [strip_accents(item) for item in names_mun_list]
+    names_mun_standard = []
+    for item in names_mun_list:
+        if 'MUNICIPIO' in item:
+            names_mun_standard.append(standarize_mun(item))
+        else:
+            names_mun_standard.append(standarize_depto(item))
+
+    # Lookup structures over the official names, built once
+    if names_index is None:
+        names_index = MunNamesIndex(df_names)
+
+    # Second standardization: accent standardization without accents with official names
+    names_mun_standard = standardize_accents_mun(df_names, names_mun_standard, names_index)
+
+    # Third standardization: format standardization to ensure a right joining
+    names_mun_standard = standardize_format_mun(df_names, names_mun_standard, names_index)
+
+    return names_mun_standard
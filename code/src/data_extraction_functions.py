@@ -1,33 +1,270 @@
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
 import pandas as pd
 
+import instrumentation as instr
+
+# SECOP I contracts and DIVIPOLA names datasets
+SECOP_URL = 'https://www.datos.gov.co/resource/xvdy-vvsk.json'
+NAMES_URL = 'https://www.datos.gov.co/resource/p95u-vi7k.json'
+
+# Rows per request when paging through a query
+PAGE_SIZE = 50000
+# Columns of SECOP used by the pipeline (cleaning, standardization, matching, cache and chain output)
+SECOP_COLUMNS = ['uid', 'anno_firma_del_contrato', 'nombre_de_la_entidad', 'estado_del_proceso',
+                 'causal_de_otras_formas_de', 'detalle_del_objeto_a_contratar', 'fecha_de_cargue_en_el_secop',
+                 'numero_del_contrato', 'cuantia_proceso', 'nom_raz_social_contratista',
+                 'identificacion_del_contratista', 'fecha_de_firma_del_contrato', 'cuantia_contrato',
+                 'valor_contrato_con_adiciones', 'municipio_entidad', 'departamento_entidad']
+# All the fields of SECOP I, in the order of the dataset. The API leaves out the fields with no value in the
+# rows returned: frames are aligned to them so every mun/dept. has the same columns
+SECOP_ALL_COLUMNS = ['uid', 'anno_cargue_secop', 'anno_firma_del_contrato', 'nivel_entidad', 'orden_entidad',
+                     'nombre_de_la_entidad', 'nit_de_la_entidad', 'c_digo_de_la_entidad', 'id_tipo_de_proceso',
+                     'tipo_de_proceso', 'estado_del_proceso', 'causal_de_otras_formas_de',
+                     'id_regimen_de_contratacion', 'regimen_de_contratacion', 'id_objeto_a_contratar',
+                     'objeto_a_contratar', 'detalle_del_objeto_a_contratar', 'tipo_de_contrato',
+                     'municipio_obtencion', 'municipio_entrega', 'municipios_ejecucion',
+                     'fecha_de_cargue_en_el_secop', 'numero_de_constancia', 'numero_de_proceso',
+                     'numero_del_contrato', 'cuantia_proceso', 'id_grupo', 'nombre_grupo', 'id_familia',
+                     'nombre_familia', 'id_clase', 'nombre_clase', 'id_ajudicacion',
+                     'tipo_identifi_del_contratista', 'identificacion_del_contratista',
+                     'nom_raz_social_contratista', 'dpto_y_muni_contratista', 'tipo_doc_representante_legal',
+                     'identific_del_represen_legal', 'nombre_del_represen_legal', 'fecha_de_firma_del_contrato',
+                     'fecha_ini_ejec_contrato', 'plazo_de_ejec_del_contrato', 'rango_de_ejec_del_contrato',
+                     'tiempo_adiciones_en_dias', 'tiempo_adiciones_en_meses', 'fecha_fin_ejec_contrato',
+                     'compromiso_presupuestal', 'cuantia_contrato', 'valor_total_de_adiciones',
+                     'valor_contrato_con_adiciones', 'objeto_del_contrato_a_la', 'id_origen_de_los_recursos',
+                     'origen_de_los_recursos', 'codigo_bpin', 'proponentes_seleccionados',
+                     'calificacion_definitiva', 'id_sub_unidad_ejecutora', 'nombre_sub_unidad_ejecutora',
+                     'ruta_proceso_en_secop_i', 'moneda', 'espostconflicto', 'marcacion_adiciones',
+                     'posicion_rubro', 'nombre_rubro', 'valor_rubro', 'sexo_replegal_entidad', 'pilar_acuerdo_paz',
+                     'punto_acuerdo_paz', 'municipio_entidad', 'departamento_entidad']
 
-def extract_entity_contracts(entity_name):
+# Shared HTTP session: keep-alive connection pool and retries with backoff on 429/5xx
+_session = None
+_timeout = (10, 600)  # (connect, read) seconds
+
+
+def configure_session(pool_size=32, retries=5, backoff_factor=1, timeout=(10, 600)):
     """
-        Gets dataframe of all contracts issued by the municipality/department to a third party contractor
+        Creates the HTTP session shared by all the requests to the API
+
+        Parameters
+        ----------
+        pool_size : int
+            Max. number of connections kept alive (should be >= number of concurrent downloads)
+        retries : int
+            Max. number of retries of a request (connection errors, 429 and 5xx responses)
+        backoff_factor : float
+            Retries wait backoff_factor * 2 ** (retry - 1) seconds (or the Retry-After of the response)
+        timeout : tuple
+            (connect, read) timeout of each request in seconds
+
+        Returns
+        -------
+        Session
+            shared session
+    """
+    # requests is imported on first use: workers reading from cache never load it
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    global _session, _timeout
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'], respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    _session = session
+    _timeout = timeout
+    return session
+
+
+def get_session():
+    """Gets the HTTP session shared by all the requests to the API"""
+    if _session is None:
+        configure_session()
+    return _session
+
+
+def get_secop_df(url, params):
+    """
+        Gets dataframe with the result of a query to the API of datos.gov.co
+
+        Parameters
+        ----------
+        url : string
+            url of the dataset
+        params : dict
+            SoQL parameters of the query
+
+        Returns
+        -------
+        dataframe
+            rows of the query
+    """
+    r_api = get_session().get(url, params=params, timeout=_timeout)
+    r_api.raise_for_status()
+    instr.count(bytes=len(r_api.content), requests=1)
+    d_api = r_api.json()  # To .json
+    df_api = pd.DataFrame(d_api)  # To df
+    return df_api
+
+
+def typed_chunk(df):
+    """
+        Converts the columns used by the pipeline to compact dtypes (the API returns every value as string)
+
+        Parameters
+        ----------
+        df : dataframe
+            rows of a SECOP query
+
+        Returns
+        -------
+        dataframe
+            same rows, with status as categorical and signing year/amount as numbers
+    """
+    if 'estado_del_proceso' in df.columns:
+        df['estado_del_proceso'] = df['estado_del_proceso'].astype('category')
+    if 'anno_firma_del_contrato' in df.columns:
+        df['anno_firma_del_contrato'] = pd.to_numeric(df['anno_firma_del_contrato'], errors='coerce',
+                                                      downcast='float')
+    if 'cuantia_proceso' in df.columns:
+        df['cuantia_proceso'] = pd.to_numeric(df['cuantia_proceso'], errors='coerce')
+    return df
+
+
+def iter_secop_pages(url, params, page_size=PAGE_SIZE):
+    """
+        Pages through a query to the API of datos.gov.co ($limit/$offset over a stable $order)
+
+        Parameters
+        ----------
+        url : string
+            url of the dataset
+        params : dict
+            SoQL parameters of the query (without $limit/$offset)
+        page_size : int
+            Max. number of rows per request
+
+        Yields
+        ------
+        dataframe
+            rows of a page, with typed columns
+    """
+    params = dict(params)
+    params.setdefault('$order', ':id')
+    offset = 0
+    while True:
+        page_params = dict(params)
+        page_params['$limit'] = page_size
+        page_params['$offset'] = offset
+        df_page = get_secop_df(url, page_params)
+        if df_page.empty:
+            break
+        yield typed_chunk(df_page)
+        if len(df_page) < page_size:
+            break
+        offset = offset + page_size
+
+
+def fetch_secop_df(url, params, page_size=PAGE_SIZE):
+    """
+        Gets dataframe with all the rows of a query, requested page by page
+        Memory is not bounded by page_size: the typed pages are kept until they are concatenated, so the peak is
+        about twice the typed rows of the query (the JSON of only one page is held at a time). To process a
+        query with memory bounded by page_size, consume iter_secop_pages instead
+
+        Parameters
+        ----------
+        url : string
+            url of the dataset
+        params : dict
+            SoQL parameters of the query (without $limit/$offset)
+        page_size : int
+            Max. number of rows per request
+
+        Returns
+        -------
+        dataframe
+            rows of the query, with typed columns
+    """
+    chunks = list(iter_secop_pages(url, params, page_size))
+    if not chunks:
+        return pd.DataFrame()
+    return typed_chunk(pd.concat(chunks, ignore_index=True, sort=False))
+
+
+def query_params(params, columns=None):
+    """Adds the $select of the columns to the SoQL parameters (None for all the columns)"""
+    if columns is not None:
+        params['$select'] = ','.join(columns)
+    return params
+
+
+def align_columns(df, columns=None):
+    """
+        Aligns the columns of a query to the columns requested, so that every entity and mun/dept. has the same
+        columns (the API leaves out the fields with no value in the rows returned)
+
+        Parameters
+        ----------
+        df : dataframe
+            rows of a SECOP query
+        columns : list
+            columns requested (None for all the columns: SECOP_ALL_COLUMNS)
+
+        Returns
+        -------
+        dataframe
+            columns requested in their order (missing ones empty), then any other column of df
+    """
+    columns = list(SECOP_ALL_COLUMNS if columns is None else columns)
+    columns += [col for col in df.columns if col not in columns]
+    if list(df.columns) == columns:
+        return df
+    return df.reindex(columns=columns)
+
+
+def extract_entity_contracts(entity_name, cache=None, columns=None, page_size=PAGE_SIZE):
+    """
+        Gets dataframe of all the interadministrative contracts issued by a public entity
 
         Parameters
         ----------
         entity_name : string
             name of public entity to evaluate
+        cache : ContractCache
+            local cache of SECOP queries, or a ContractWarehouse to query a local export (None to always
+            query the API)
+        columns : list
+            columns to download, e.g. SECOP_COLUMNS (None for all the columns)
+        page_size : int
+            Max. number of rows per request
 
         Returns
         -------
         dataframe
-            all contracts issued by the municipality/department to a third party contractor
+            interadministrative contracts issued by the public entity (columns aligned, see align_columns)
     """
-    entity_name = 'INSTITUTO NACIONAL DE VÍAS (INVIAS)'
-    url_secop = 'https://www.datos.gov.co/resource/xvdy-vvsk.json'
-    p_entity = {'nombre_de_la_entidad': entity_name,
-                '$limit': '10000',
-                'causal_de_otras_formas_de': 'Contratos Interadministrativos (Literal C)'}
-    r_entity = requests.get(url_secop, params=p_entity)
-    d_entity = r_entity.json()  # To .json
-    df_entity = pd.DataFrame(d_entity)  # To df
-    return df_entity
+    url_secop = SECOP_URL
+    p_entity = query_params({'nombre_de_la_entidad': entity_name,
+                             'causal_de_otras_formas_de': 'Contratos Interadministrativos (Literal C)'}, columns)
+    fetch = partial(fetch_secop_df, page_size=page_size)
+    if cache is not None:
+        df_entity = cache.get_contracts(url_secop, entity_name, p_entity, fetch)
+    else:
+        df_entity = fetch(url_secop, p_entity)
+    return align_columns(df_entity, columns)
 
 
-def extract_mun_contracts(mun_name):
+def extract_mun_contracts(mun_name, cache=None, columns=None, page_size=PAGE_SIZE):
     """
         Gets dataframe of all contracts issued by the municipality/department to a third party contractor
 
@@ -35,28 +272,84 @@ def extract_mun_contracts(mun_name):
         ----------
         mun_name : string
             name of municipalities/department to evaluate
+        cache : ContractCache
+            local cache of SECOP queries, or a ContractWarehouse to query a local export (None to always
+            query the API)
+        columns : list
+            columns to download, e.g. SECOP_COLUMNS (None for all the columns)
+        page_size : int
+            Max. number of rows per request
 
         Returns
         -------
         dataframe
-            all contracts issued by the municipality/department to a third party contractor
+            all contracts issued by the municipality/department to a third party contractor (columns
+            aligned, see align_columns)
     """
     # Getting df of all contracts issued by the municipality/department to a third party contractor
-    url_secop = 'https://www.datos.gov.co/resource/xvdy-vvsk.json'
-    p_api = {'nombre_de_la_entidad': mun_name, '$limit': 1000000}
-    r_api = requests.get(url_secop, params=p_api)
-    d_api = r_api.json()  # To .json
-    df_api = pd.DataFrame(d_api)  # To df
-    return df_api
+    url_secop = SECOP_URL
+    p_api = query_params({'nombre_de_la_entidad': mun_name}, columns)
+    fetch = partial(fetch_secop_df, page_size=page_size)
+    with instr.stage('extract_mun_contracts', mun_name) as stage:
+        if cache is not None:
+            df_api = cache.get_contracts(url_secop, mun_name, p_api, fetch)
+        else:
+            df_api = fetch(url_secop, p_api)
+        stage.add(rows_out=len(df_api))
+    return align_columns(df_api, columns)
+
+
+def iter_mun_contracts(list_mun, workers=4, cache=None, columns=None, return_exceptions=False):
+    """
+        Gets the contracts of several municipalities/departments, downloading the next ones concurrently
+        while the current one is processed
+
+        Parameters
+        ----------
+        list_mun : list
+            names of municipalities/departments to evaluate
+        workers : int
+            Max. number of concurrent downloads
+        cache : ContractCache
+            local cache of SECOP queries, or a ContractWarehouse to query a local export (None to always
+            query the API)
+        columns : list
+            columns to download, e.g. SECOP_COLUMNS (None for all the columns)
+        return_exceptions : bool
+            If True, the error of a failed download is yielded instead of the dataframe (instead of raised)
+
+        Yields
+        ------
+        string
+            name of the municipality/department (same order as list_mun)
+        dataframe
+            all contracts issued by the municipality/department to a third party contractor
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        names = iter(list_mun)
+        pending = deque((mun_name, executor.submit(extract_mun_contracts, mun_name, cache=cache, columns=columns))
+                        for mun_name in islice(names, workers))
+        try:
+            while pending:
+                mun_name, future = pending.popleft()
+                for next_name in islice(names, 1):
+                    pending.append((next_name, executor.submit(extract_mun_contracts, next_name, cache=cache,
+                                                                 columns=columns)))
+                error = future.exception()
+                if error is not None and return_exceptions:
+                    yield mun_name, error
+                else:
+                    yield mun_name, future.result()
+        finally:
+            # Consumer stopped early: do not start the remaining downloads
+            for _, future in pending:
+                future.cancel()
 
 
 def extract_mun_names():
     """Gets dataframe with all the municipalities and departments in Colombia"""
-    url_mun = 'https://www.datos.gov.co/resource/p95u-vi7k.json'
+    url_mun = NAMES_URL
     p_mun = {'$limit': 2000}
-    r_mun = requests.get(url_mun, params=p_mun)
-    d_mun = r_mun.json()  # To .json
-    # To df
-    df_mun = pd.DataFrame(d_mun)
+    df_mun = get_secop_df(url_mun, p_mun)
 
     return df_mun
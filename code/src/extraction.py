@@ -1,18 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pandas as pd
+
 import data_extraction_functions as extract
+import instrumentation as instr
+
+# Public entity evaluated by default
+ENTITY_NAMES = ['INSTITUTO NACIONAL DE VÍAS (INVIAS)']
 
 
-def extracting_data():
+def extracting_data(cache=None, columns=None, names=True, entity_names=None, workers=4):
     """
-    Gets the public entity contracting dataframe and the official names of municipalities/departments in Colombia
+    Gets the contracting dataframe of the public entities and the official names of municipalities/departments
+    in Colombia
+
+    Parameters
+    ----------
+    cache : ContractCache
+        local cache of SECOP queries (None to always query the API)
+    columns : list
+        columns of the contracts to download, e.g. extract.SECOP_COLUMNS (None for all the columns)
+    names : bool
+        If False, the official names are not downloaded (e.g. they are already in the gazetteer)
+    entity_names : list
+        names of the public entities in SECOP (None for ENTITY_NAMES)
+    workers : int
+        Max. number of entities downloaded concurrently
 
     Returns
     -------
     df_entity_raw: dataframe
-        public entity contracts issued since 2012
+        contracts issued by the public entities (the entity of each contract in nombre_de_la_entidad)
     df_names_raw: dataframe
-        official names of municipalities/departments in Colombia
+        official names of municipalities/departments in Colombia (None if names is False)
     """
-    df_entity_raw = extract.extract_entity_contracts('INSTITUTO NACIONAL DE VÍAS (INVIAS)')
-    df_names_raw = extract.extract_mun_names()
+    if entity_names is None:
+        entity_names = ENTITY_NAMES
+    with instr.stage('extracting_data') as stage:
+        extract_entity = partial(_extract_entity_contracts, cache=cache, columns=columns)
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(entity_names)))) as executor:
+            entity_frames = [df for df in executor.map(extract_entity, entity_names) if not df.empty]
+        df_entity_raw = pd.concat(entity_frames, ignore_index=True, sort=False) if entity_frames \
+            else pd.DataFrame()
+        df_names_raw = None
+        if names:
+            with instr.stage('extract_mun_names') as names_stage:
+                df_names_raw = extract.extract_mun_names()
+                names_stage.add(rows_out=len(df_names_raw))
+        stage.add(rows_out=len(df_entity_raw))
 
     return df_entity_raw, df_names_raw
+
+
+def _extract_entity_contracts(entity_name, cache, columns):
+    with instr.stage('extract_entity_contracts') as stage:
+        df_entity = extract.extract_entity_contracts(entity_name, cache=cache, columns=columns)
+        stage.add(rows_out=len(df_entity))
+    return df_entity
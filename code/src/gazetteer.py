@@ -0,0 +1,136 @@
+import json
+import os
+from datetime import datetime, timezone
+
+import pandas as pd
+
+import data_cleaning_functions as clean
+
+"""
+Gazetteer of names of municipalities/departments
+Versioned JSON file with the cleaned official names, the special cases used to standardize them and
+the standardized name of every contractor name seen in previous runs
+"""
+
+GAZETTEER_VERSION = 2
+# Days after which the official names are downloaded again and compared with the ones in the gazetteer
+NAMES_MAX_AGE_DAYS = 30
+
+
+def special_cases():
+    """Special cases of the standardization (a gazetteer built with other special cases is rebuilt)"""
+    return json.loads(json.dumps({'mun': clean.MUN_SPECIAL_CASES,
+                                  'depto': clean.DEPTO_SPECIAL_CASES,
+                                  'names': clean.NAMES_SPECIAL_CASES}))
+
+
+def new_gazetteer(df_names_raw):
+    """
+    Builds an empty gazetteer (without contractor names)
+
+    Parameters
+    ----------
+    df_names_raw : dataframe
+        official names of municipality/department
+
+    Returns
+    -------
+    dict
+        gazetteer
+    """
+    df_names = clean.df_cleaning_names(df_names_raw[['departamento', 'municipio']].copy())
+    return {'version': GAZETTEER_VERSION,
+            'special_cases': special_cases(),
+            'names': df_names.to_dict('list'),
+            'names_checked_at': datetime.now(timezone.utc).isoformat(),
+            'mapping': {}}
+
+
+def read_gazetteer(path):
+    """Reads the gazetteer if it exists and was built by this version with the same special cases (else None)"""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        gazetteer = json.load(f)
+    if gazetteer.get('version') != GAZETTEER_VERSION or gazetteer.get('special_cases') != special_cases():
+        return None
+    return gazetteer
+
+
+def is_current(path, max_age_days=NAMES_MAX_AGE_DAYS):
+    """
+    True if the gazetteer can be loaded without the official names: it exists, was built by this version
+    with the same special cases, and its official names were checked less than max_age_days ago
+    """
+    gazetteer = read_gazetteer(path)
+    if gazetteer is None or not gazetteer.get('names_checked_at'):
+        return False
+    checked_at = datetime.fromisoformat(gazetteer['names_checked_at'])
+    return (datetime.now(timezone.utc) - checked_at).total_seconds() < max_age_days * 24 * 3600
+
+
+def load_gazetteer(path, df_names_raw=None):
+    """
+    Reads the gazetteer
+    It is rebuilt if it does not exist, if it was built by another version or with other special cases,
+    or if the official names given are not the ones in the gazetteer (if they are, they are marked as checked)
+
+    Parameters
+    ----------
+    path : str
+        file of the gazetteer
+    df_names_raw : dataframe
+        official names of municipality/department (None to trust the names in the gazetteer)
+
+    Returns
+    -------
+    dict
+        gazetteer
+    """
+    gazetteer = read_gazetteer(path)
+    if gazetteer is not None:
+        if df_names_raw is None:
+            return gazetteer
+        rebuilt = new_gazetteer(df_names_raw)
+        if rebuilt['names'] == gazetteer['names']:
+            gazetteer['names_checked_at'] = rebuilt['names_checked_at']
+            return gazetteer
+
+    if df_names_raw is None:
+        raise ValueError('Official names of municipalities/departments needed to build the gazetteer ' + path
+                         + ' (check it with is_current before skipping their download)')
+    return new_gazetteer(df_names_raw)
+
+
+def standardize_names(gazetteer, names_mun_list):
+    """
+    Standardizes names of mun/dept. with the gazetteer
+    Names not in the gazetteer are standardized with the official names and added to it
+
+    Parameters
+    ----------
+    gazetteer : dict
+        gazetteer (result of load_gazetteer)
+    names_mun_list : list
+        names of mun/dept. as they appear in SECOP
+
+    Returns
+    -------
+    list
+        standardized names
+    int
+        number of names added to the gazetteer
+    """
+    mapping = gazetteer['mapping']
+    new_names = list(dict.fromkeys(item for item in names_mun_list if item not in mapping))
+    if new_names:
+        df_names = pd.DataFrame(gazetteer['names'])
+        mapping.update(zip(new_names, clean.standardize_mun_names(new_names, df_names)))
+    return [mapping[item] for item in names_mun_list], len(new_names)
+
+
+def save_gazetteer(path, gazetteer):
+    """Writes the gazetteer (to a temporary file first, so a crash never leaves it half written)"""
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(gazetteer, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
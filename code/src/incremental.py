@@ -0,0 +1,281 @@
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import checkpoint
+import instrumentation as instr
+import secop_cache
+import string_similarity
+import string_similarity_functions as ss
+import data_extraction_functions as extract
+import data_cleaning_functions as clean
+
+"""
+Incremental update of the contracting chain (e.g. a nightly refresh)
+The state directory keeps the chain of each mun/dept. (as a checkpoint, see checkpoint) and the contracts
+already evaluated in it (uid and upload date). Each update only scores:
+ - new (or re-uploaded) entity contracts against all the eligible mun/dept. contracts
+ - the other entity contracts against the new mun/dept. contracts only
+and merges the result with the previous chain of the mun/dept. (top n_contracts per entity contract).
+Entity contracts whose matches were re-uploaded or removed are scored again against all the contracts.
+The first update (empty state directory) builds the whole chain. Downloads are incremental through the cache.
+
+    with chain_sinks.open_sink('contracting_chain.csv') as sink:
+        incremental.update_chain(list_mun, 3, df_entity, 'chain_state', cache=cache, sink=sink)
+"""
+
+SEEN_DIR = 'seen'
+ENCODER_FILE = 'encoder.npz'
+
+
+def contract_keys(df, suffix=''):
+    """Key of each contract: uid and upload date (a contract uploaded again has a new key)"""
+    keys = df['uid' + suffix].astype(str)
+    date_col = secop_cache.DATE_COLUMN + suffix
+    if date_col in df.columns:
+        keys = keys + '|' + df[date_col].astype(str)
+    return keys.to_numpy(dtype=object)
+
+
+def update_chain(list_mun, n_contracts, entity_contracts, state_dir, cache=None, fetch_workers=4, columns=None,
+                 n_rare=None, encoder=None, sink=None, keep_invalid=False):
+    """
+    Updates the contracting chain of the previous run with the contracts uploaded since then
+
+    Parameters
+    ----------
+    list_mun : list
+        list with the names of municipalities/departments to evaluate
+    n_contracts: int
+        Max. number of contracts for the chain
+    entity_contracts: dataframe
+        Dataframe with issued contracts from one or more public entities (all of them, not only the new ones)
+    state_dir: str
+        directory with the chain and state of the previous runs (created in the first run)
+    cache: ContractCache
+        local cache of SECOP queries (None to always query the API)
+    fetch_workers: int
+        Max. number of mun/dept. downloaded concurrently
+    columns: list
+        columns of the mun/dept. contracts to download, e.g. extract.SECOP_COLUMNS (None for all the columns)
+    n_rare: int
+        If given, only mun/dept. contracts sharing one of the n_rare rarest ngrams of an entity contract
+        are scored (see contracting_chain)
+    encoder: TrigramEncoder
+        tf-idf encoder of the first run (None to fit one with fit_encoder, without the mun/dept. that fail
+        to download). It is saved in state_dir and reused by the next updates, so scores of old and new
+        pairs are comparable
+    sink: ChainSink
+        If given, the whole chain is written to it instead of returned. The caller closes it
+    keep_invalid: bool
+        If True, pairs with score under the threshold are also kept (valid = False)
+
+    Returns
+    -------
+    dataframe
+        whole contracting chain after the update (None if written to sink)
+    """
+    entity_contracts = clean.df_cleaning(entity_contracts)
+    threshold = 0.8
+    options = {'n_contracts': n_contracts, 'threshold': threshold, 'n_rare': n_rare, 'keep_invalid': keep_invalid}
+
+    state = checkpoint.load_manifest(state_dir)
+    if state.get('options', options) != options:
+        raise ValueError('Options of the chain differ from the ones of ' + state_dir + ': ' + str(state['options'])
+                         + ' (remove the directory to rebuild the chain)')
+    state['options'] = options
+    os.makedirs(os.path.join(state_dir, SEEN_DIR), exist_ok=True)
+
+    encoder_path = os.path.join(state_dir, ENCODER_FILE)
+    if os.path.exists(encoder_path):
+        encoder = ss.TrigramEncoder.load(encoder_path)
+    else:
+        if encoder is None:
+            # A mun/dept. that fails to download is skipped here and recorded as failed below, as in any
+            # later update (retried by the next run)
+            encoder = string_similarity.fit_encoder(list_mun, entity_contracts, cache=cache,
+                                                    fetch_workers=fetch_workers, columns=columns)
+        encoder.save(encoder_path)
+
+    chain_options = {'n_contracts': n_contracts, 'threshold': threshold, 'n_rare': n_rare, 'encoder': encoder,
+                     'keep_invalid': keep_invalid}
+    entity_rows = string_similarity.entity_rows_by_mun(entity_contracts)
+    mun_contracts_iter = extract.iter_mun_contracts(list_mun, workers=fetch_workers, cache=cache, columns=columns,
+                                                    return_exceptions=True)
+    for i, (item, mun_contracts) in enumerate(mun_contracts_iter):
+        if i % 10 == 0:
+            print("Iteration # " + str(i) + ";     Mun/Dept Name: " + str(item))
+        entry = state['municipalities'].get(item, {})
+        entity_contracts_mun = entity_contracts.take(entity_rows.get(item, []))
+        try:
+            if isinstance(mun_contracts, Exception):
+                raise mun_contracts
+            chain_old, seen_old = read_mun_state(state_dir, entry)
+            chain_mun_df, seen, changed = update_chain_mun(item, mun_contracts, entity_contracts_mun, chain_old,
+                                                           seen_old, **chain_options)
+        except Exception as error:
+            # The chain of the previous run is kept, the mun/dept. is evaluated again in the next update
+            entry = dict(entry, error=type(error).__name__ + ': ' + str(error),
+                         failed_at=datetime.now(timezone.utc).isoformat())
+            entry.setdefault('status', 'failed')
+            state['municipalities'][item] = entry
+            checkpoint.save_manifest(state_dir, state)
+            continue
+        status = 'skipped' if chain_mun_df is None else 'completed'
+        if changed or 'error' in entry or entry.get('status') != status:
+            with instr.stage('write_chain', item):
+                record_mun_state(state_dir, state, item, chain_mun_df, seen, mun_contracts, entity_contracts_mun)
+
+    print("State: " + str(checkpoint.summary(state)))
+    chain_list = checkpoint.iter_chain(state_dir, state, list_mun)
+    if sink is not None:
+        for chain_mun_df in chain_list:
+            sink.write(chain_mun_df)
+        return None
+    chain_list = list(chain_list)
+    if not chain_list:
+        return pd.DataFrame()
+    return pd.concat(chain_list, ignore_index=True, sort=False)
+
+
+def read_mun_state(state_dir, entry):
+    """Chain (None if there is none) and keys of the contracts evaluated in the previous run of a mun/dept."""
+    chain_old = None
+    if entry.get('status') == 'completed':
+        chain_old = pd.read_parquet(os.path.join(state_dir, entry['file']))
+    if entry.get('seen'):
+        seen_old = pd.read_parquet(os.path.join(state_dir, entry['seen']))
+    else:
+        seen_old = pd.DataFrame({'side': pd.Series(dtype=object), 'key': pd.Series(dtype=object)})
+    return chain_old, seen_old
+
+
+def record_mun_state(state_dir, state, mun_name, chain_mun_df, seen, mun_contracts, entity_contracts_mun):
+    """
+    Writes the chain and the contracts evaluated of a mun/dept., and records them in the state
+    The chain is written first: if the update stops before the state is saved, the next one evaluates
+    again the contracts of the mun/dept. not recorded as seen
+    """
+    checkpoint.record_mun(state_dir, state, mun_name, chain_mun_df)
+    path = checkpoint.part_file(mun_name, SEEN_DIR)
+    full_path = os.path.join(state_dir, path)
+    seen.to_parquet(full_path + '.tmp', index=False)
+    os.replace(full_path + '.tmp', full_path)
+
+    # Last upload dates seen, per entity and for the mun/dept.
+    entity_dates = {}
+    if secop_cache.DATE_COLUMN in entity_contracts_mun.columns:
+        entity_dates = entity_contracts_mun.groupby('nombre_de_la_entidad', observed=True)[
+            secop_cache.DATE_COLUMN].max().astype(str).to_dict()
+    state['municipalities'][mun_name].update(seen=path, max_date_mun=secop_cache.max_date(mun_contracts),
+                                             max_date_entity=entity_dates,
+                                             entity_contracts=int((seen['side'] == 'entity').sum()),
+                                             mun_contracts=int((seen['side'] == 'mun').sum()))
+    checkpoint.save_manifest(state_dir, state)
+
+
+def update_chain_mun(mun_name, mun_contracts, entity_contracts_mun, chain_old, seen_old, n_contracts, threshold,
+                     n_rare=None, encoder=None, keep_invalid=False):
+    """
+    Updates the contracting chain of a mun/dept. with its new contracts and the new entity contracts
+
+    Parameters
+    ----------
+    mun_name : str
+        name of the municipality/department (standardized)
+    mun_contracts: dataframe
+        contracts issued by the mun/dept. (raw, all of them)
+    entity_contracts_mun: dataframe
+        contracts issued by the public entities to the mun/dept. (cleaned, all of them)
+    chain_old: dataframe
+        chain of the mun/dept. of the previous run (None if there is none)
+    seen_old: dataframe
+        contracts evaluated in the previous run: side ('entity' or 'mun') and key (see contract_keys)
+    n_contracts: int
+        Max. number of mun/dept. contracts matched to each entity contract
+    threshold: float
+        Min. score (exclusive) for a pair of contracts to be valid
+    n_rare: int
+        Number of rarest ngrams used to shortlist mun/dept. contracts (None to score all of them)
+    encoder: TrigramEncoder
+        tf-idf encoder of the first run
+    keep_invalid: bool
+        If True, pairs with score under the threshold are also returned
+
+    Returns
+    -------
+    dataframe
+        chain of the mun/dept. (same pairs as chain_mun over all the contracts), None if there is nothing
+        to evaluate
+    dataframe
+        contracts evaluated (side and key)
+    bool
+        False if there is nothing new since the previous run (chain_old is returned)
+    """
+    with instr.stage('update_chain_mun', mun_name, rows_in=len(mun_contracts)) as stage:
+        mun_contracts = clean.df_cleaning(mun_contracts)
+        entity_keys = contract_keys(entity_contracts_mun)
+        mun_keys = contract_keys(mun_contracts) if not mun_contracts.empty else np.zeros(0, dtype=object)
+        seen = pd.DataFrame({'side': ['entity'] * len(entity_keys) + ['mun'] * len(mun_keys),
+                             'key': np.concatenate([entity_keys, mun_keys])})
+        if mun_contracts.empty:
+            # No contracts for the mun/dept. in SECOP (in the states allowed)
+            return None, seen, chain_old is not None
+
+        new_entity = ~np.isin(entity_keys, seen_old.loc[seen_old['side'] == 'entity', 'key'].to_numpy())
+        new_mun = ~np.isin(mun_keys, seen_old.loc[seen_old['side'] == 'mun', 'key'].to_numpy())
+
+        # Pairs of the previous run with a mun/dept. contract re-uploaded or removed: their entity contracts
+        # are scored again against all the mun/dept. contracts
+        if chain_old is None:
+            chain_old = build_empty_chain(entity_contracts_mun, mun_contracts)
+        old_entity_keys = contract_keys(chain_old)
+        stale = ~np.isin(contract_keys(chain_old, '_mun'), mun_keys[~new_mun])
+        redo = new_entity | np.isin(entity_keys, old_entity_keys[stale])
+        chain_keep = chain_old.loc[np.isin(old_entity_keys, entity_keys[~redo])]
+        stage.add(new_entity=int(new_entity.sum()), new_mun=int(new_mun.sum()), redo_entity=int(redo.sum()))
+        if not redo.any() and not new_mun.any() and len(chain_keep) == len(chain_old):
+            return chain_old, seen, False
+
+        chain_list = [chain_keep]
+        lower_bound = 0 if keep_invalid else threshold
+        if redo.any():
+            entity_redo = entity_contracts_mun.loc[redo]
+            matches_sparse = string_similarity.match_mun_contracts(entity_redo, mun_contracts, n_contracts, n_rare,
+                                                                   encoder, lower_bound)
+            chain_list.append(string_similarity.build_chain_mun(entity_redo, mun_contracts, matches_sparse,
+                                                                threshold))
+        if new_mun.any() and not redo.all():
+            entity_keep, mun_new = entity_contracts_mun.loc[~redo], mun_contracts.loc[new_mun]
+            matches_sparse = string_similarity.match_mun_contracts(entity_keep, mun_new, n_contracts, n_rare,
+                                                                   encoder, lower_bound)
+            chain_list.append(string_similarity.build_chain_mun(entity_keep, mun_new, matches_sparse, threshold))
+
+        with instr.stage('chain_merge'):
+            chain_mun_df = merge_chain(chain_list, entity_keys, n_contracts)
+        stage.add(rows_out=len(chain_mun_df))
+        return chain_mun_df, seen, True
+
+
+def build_empty_chain(entity_contracts_mun, mun_contracts):
+    """Chain without pairs, with the columns of build_chain_mun"""
+    from scipy.sparse import csr_matrix
+
+    return string_similarity.build_chain_mun(entity_contracts_mun, mun_contracts,
+                                             csr_matrix((len(entity_contracts_mun), len(mun_contracts))), 0)
+
+
+def merge_chain(chain_list, entity_keys, n_contracts):
+    """
+    Keeps the n_contracts pairs with highest score of each entity contract, in the order of chain_mun
+    (entity contracts in the order of entity_keys, then highest score first)
+    """
+    chain_list = [chain for chain in chain_list if not chain.empty] or chain_list[:1]
+    chain = pd.concat(chain_list, ignore_index=True, sort=False)
+    entity_pos = pd.Index(entity_keys).get_indexer(contract_keys(chain))
+    order = np.lexsort((-chain['score'].to_numpy(), entity_pos))
+    chain = chain.take(order).reset_index(drop=True)
+    rank = chain.groupby(entity_pos[order], sort=False).cumcount().to_numpy()
+    return chain.loc[rank < n_contracts].reset_index(drop=True)
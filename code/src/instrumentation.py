@@ -0,0 +1,236 @@
+import cProfile
+import json
+import threading
+import time
+from datetime import datetime, timezone
+
+"""
+Instrumentation of contracting chain runs
+Each stage of the pipeline (downloads, cleaning, standardization, normalization, tf-idf, top-n, chain assembly)
+records its wall time and counters (calls, rows in/out, bytes downloaded...), in total and per mun/dept.
+Disabled by default (stages cost nothing): call enable() at the start of the run and report() at the end.
+
+    instrumentation.enable()
+    ...
+    instrumentation.report('run_report.json')
+
+To find where the time goes inside a stage, wrap the run with profile('run.prof') (cProfile, or pyinstrument
+if installed: profile('run.html', tool='pyinstrument')).
+"""
+
+_stats = None
+_local = threading.local()
+
+
+class RunStats:
+    """Counters of a run, per stage and per mun/dept. and stage"""
+
+    def __init__(self):
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.municipalities = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, mun_name, counters):
+        """Adds the counters of a stage (and of its mun/dept., if any)"""
+        with self._lock:
+            _add_counters(self.stages.setdefault(name, {}), counters)
+            if mun_name is not None:
+                mun_stages = self.municipalities.setdefault(mun_name, {})
+                _add_counters(mun_stages.setdefault(name, {}), counters)
+
+    def merge(self, snapshot):
+        """Adds the counters collected by another process (see collect)"""
+        for name, counters in snapshot['stages'].items():
+            self.add(name, None, counters)
+        with self._lock:
+            for mun_name, mun_stages in snapshot['municipalities'].items():
+                for name, counters in mun_stages.items():
+                    _add_counters(self.municipalities.setdefault(mun_name, {}).setdefault(name, {}), counters)
+
+
+def _add_counters(total, counters):
+    for key, value in counters.items():
+        total[key] = total.get(key, 0) + value
+
+
+class Stage:
+    """Stage being timed (context manager), counters are added with add()"""
+
+    def __init__(self, name, mun_name, counters):
+        self.name = name
+        self.mun_name = mun_name
+        self.counters = counters
+
+    def add(self, **counters):
+        _add_counters(self.counters, counters)
+
+    def __enter__(self):
+        _stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.counters['seconds'] = self.counters.get('seconds', 0) + time.perf_counter() - self.start
+        _stack().pop()
+        if _stats is not None:
+            _stats.add(self.name, self.mun_name, self.counters)
+
+
+class _NullStage:
+    """Stage when instrumentation is disabled: does nothing"""
+
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def _stack():
+    """Stages open in the current thread (innermost last)"""
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def enable():
+    """Starts recording (resets the counters of previous runs)"""
+    global _stats
+    _stats = RunStats()
+    return _stats
+
+
+def disable():
+    """Stops recording"""
+    global _stats
+    _stats = None
+
+
+def is_enabled():
+    return _stats is not None
+
+
+def stage(name, mun_name=None, **counters):
+    """
+    Times a stage of the pipeline
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+    mun_name : str
+        mun/dept. evaluated (None to use the one of the enclosing stage, if any)
+    counters : int
+        initial counters, e.g. rows_in=len(df)
+
+    Returns
+    -------
+    Stage
+        context manager; more counters are added with stage.add(rows_out=...)
+    """
+    if _stats is None:
+        return _NULL_STAGE
+    stack = _stack()
+    if mun_name is None and stack:
+        mun_name = stack[-1].mun_name
+    counters['calls'] = 1
+    return Stage(name, mun_name, counters)
+
+
+def count(**counters):
+    """Adds counters (e.g. bytes downloaded) to all the stages open in the current thread"""
+    if _stats is None:
+        return
+    for open_stage in _stack():
+        open_stage.add(**counters)
+
+
+def collect():
+    """Counters recorded by this process since the last call (to send them to the main process)"""
+    if _stats is None:
+        return None
+    snapshot = {'stages': _stats.stages, 'municipalities': _stats.municipalities}
+    _stats.stages, _stats.municipalities = {}, {}
+    return snapshot
+
+
+def merge(snapshot):
+    """Adds counters recorded by a worker process (result of collect in the worker)"""
+    if _stats is not None and snapshot is not None:
+        _stats.merge(snapshot)
+
+
+def report(path=None):
+    """
+    Aggregate and per mun/dept. figures of the run
+    Seconds of stages run in worker processes/threads are added up, so they can exceed the wall time
+
+    Parameters
+    ----------
+    path : str
+        JSON file to write the report to (None to only return it)
+
+    Returns
+    -------
+    dict
+        started_at, wall_seconds, stages (counters per stage) and municipalities (counters per mun/dept.
+        and stage)
+    """
+    if _stats is None:
+        return None
+    with _stats._lock:
+        run_report = {'started_at': _stats.started_at,
+                      'wall_seconds': time.perf_counter() - _stats.start,
+                      'stages': {name: dict(counters) for name, counters in _stats.stages.items()},
+                      'municipalities': {mun_name: {name: dict(counters) for name, counters in mun_stages.items()}
+                                         for mun_name, mun_stages in _stats.municipalities.items()}}
+    if path is not None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(run_report, f, ensure_ascii=False, indent=1)
+    return run_report
+
+
+class profile:
+    """
+    Profiles the code inside a with statement
+
+    Parameters
+    ----------
+    path : str
+        output file: pstats file for cProfile (read with pstats/snakeviz), html for pyinstrument
+    tool : str
+        'cprofile' or 'pyinstrument' (optional dependency)
+    """
+
+    def __init__(self, path, tool='cprofile'):
+        if tool not in ('cprofile', 'pyinstrument'):
+            raise ValueError('Profiler not supported: ' + tool)
+        self.path = path
+        self.tool = tool
+
+    def __enter__(self):
+        if self.tool == 'pyinstrument':
+            from pyinstrument import Profiler
+            self.profiler = Profiler()
+            self.profiler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.tool == 'pyinstrument':
+            self.profiler.stop()
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(self.profiler.output_html())
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path)
@@ -1,23 +1,78 @@
+import os
+
+import chain_sinks
+import checkpoint
+import dashboard_extract
 import extraction
+import gazetteer as gaz
+import incremental
+import instrumentation
 import preprocessing
 import string_similarity
+from contracts_warehouse import ContractWarehouse
+from secop_cache import ContractCache
+from string_similarity_functions import TrigramEncoder
 
 """
 The following code executes the contracting chain script and returns 
-a CSV with the contracting chain for all interadministrative contracts of INVIAS
+a CSV with the contracting chain for all interadministrative contracts of the public entities in
+extraction.ENTITY_NAMES (all of them matched in the same pass, one download per mun/dept.)
 """
 
+# Local warehouse of SECOP I contracts, if an export was loaded (python contracts_warehouse.py SECOP_I.csv
+# secop.sqlite): no API queries. Otherwise, local cache of SECOP queries (refreshed incrementally after 24 hours)
+warehouse_path = 'secop.sqlite'
+if os.path.exists(warehouse_path):
+    cache = ContractWarehouse(warehouse_path, clean=True)
+else:
+    cache = ContractCache('secop_cache', ttl_hours=24)
+# Standardized names of mun/dept. of previous runs. The official names are only downloaded if the gazetteer is
+# missing or stale (other version or special cases, or names not checked for gaz.NAMES_MAX_AGE_DAYS)
+gazetteer_path = 'gazetteer.json'
+# Wall time and counters of each stage, written to run_report.json at the end
+instrumentation.enable()
+
 #Extraction
-df_entity_raw, df_names_raw = extraction.extracting_data()
+df_entity_raw, df_names_raw = extraction.extracting_data(cache=cache, names=not gaz.is_current(gazetteer_path),
+                                                     entity_names=extraction.ENTITY_NAMES)
 # Preprocessing
-df_entity_clean, names_mun_clean = preprocessing.preprocessing_data(df_entity_raw, df_names_raw)
+df_entity_clean, names_mun_clean = preprocessing.preprocessing_data(df_entity_raw, df_names_raw,
+                                                                    gazetteer_path=gazetteer_path)
 
 test_names = ["HUILA - ALCALDÍA MUNICIPIO DE NEIVA",
               "SANTANDER - ALCALDÍA MUNICIPIO DE BUCARAMANGA",
               "VALLE DEL CAUCA - ALCALDÍA MUNICIPIO DE PALMIRA"]
 # test_names = names_mun_clean
-# Chain construction
-chain = string_similarity.contracting_chain(test_names, 3, df_entity_clean)
 
-# Printing csv
-chain.to_csv('contracting_chain.csv')
+
+# The chain is written to contracting_chain.csv and to the compact extract read by the dashboard
+# (dashboard_extract/: dimensions, fact table of pairs and rollups)
+def open_outputs():
+    return chain_sinks.TeeSink(chain_sinks.open_sink('contracting_chain.csv'),
+                               dashboard_extract.DashboardSink('dashboard_extract'))
+
+
+# Nightly refresh: the chain and state of the previous run are kept in chain_state/ and only the contracts
+# uploaded since then are matched (the first run builds the whole chain). False for a full rebuild
+update = True
+if update:
+    with open_outputs() as sink:
+        incremental.update_chain(test_names, 3, df_entity_clean, 'chain_state', cache=cache, sink=sink)
+else:
+    # tf-idf encoder of the whole run (saved with the chain). An interrupted run reuses the encoder of the
+    # checkpoint, so every mun/dept. of the chain is scored with the same idf weights; after a completed run,
+    # it is fitted again with the new data
+    checkpoint_dir = 'chain_checkpoint'
+    encoder_path = 'trigram_encoder.npz'
+    if checkpoint.is_resumable(checkpoint_dir) and os.path.exists(encoder_path):
+        encoder = TrigramEncoder.load(encoder_path)
+    else:
+        encoder = string_similarity.fit_encoder(test_names, df_entity_clean, cache=cache)
+        encoder.save(encoder_path)
+    # Chain construction (an interrupted run restarts where it stopped), written one mun/dept. at a time
+    with open_outputs() as sink:
+        string_similarity.contracting_chain(test_names, 3, df_entity_clean, cache=cache, encoder=encoder,
+                                            checkpoint_dir=checkpoint_dir, sink=sink)
+
+# Per-stage and per mun/dept. figures of the run
+instrumentation.report('run_report.json')
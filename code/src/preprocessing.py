@@ -1,7 +1,9 @@
 import data_cleaning_functions as clean
+import gazetteer as gaz
+import instrumentation as instr
 import numpy as np
 
-def preprocessing_data(df_entity_raw, df_names_raw):
+def preprocessing_data(df_entity_raw, df_names_raw=None, gazetteer_path=None):
     """
     Preprocess raw data to remove unwanted rows
     Cleans columns with department/municipality names and description of the contracts
@@ -10,8 +12,10 @@ def preprocessing_data(df_entity_raw, df_names_raw):
     ----------
     df_entity_raw : dataframe
         contracts issued by the public entity
-    df_names_raw: int
-        official names of municipality/department
+    df_names_raw: dataframe
+        official names of municipality/department (optional if the gazetteer already exists)
+    gazetteer_path: str
+        file with the standardized names of previous runs (None to standardize every name)
 
     Returns
     -------
@@ -21,28 +25,34 @@ def preprocessing_data(df_entity_raw, df_names_raw):
         names of municipalities/departments with contracts with the entity
     """
     # Cleaning unused rows
-    df_entity_filter = clean.df_cleaning(df_entity_raw)
+    with instr.stage('df_cleaning', rows_in=len(df_entity_raw)) as stage:
+        df_entity_filter = clean.df_cleaning(df_entity_raw)
+        stage.add(rows_out=len(df_entity_filter))
     # Filter entity contracts: only contracts issued to a mun/dept.
     # Also gets list of names of mun/dept. with contracts with the entity
-    df_entity, names_mun_list = clean.df_filter_entity(df_entity_filter)
-
-    # Get list of departments and municipalities of Colombia
-    df_names = clean.df_cleaning_names(df_names_raw)
-
-    # First standardization: names of mun/dept. with contracts with the entity
-    names_mun_list = [clean.strip_accents(item) for item in names_mun_list]
-    names_mun_standard = []
-    for item in names_mun_list:
-        if 'MUNICIPIO' in item:
-            names_mun_standard.append(clean.standarize_mun(item))
-        else:
-            names_mun_standard.append(clean.standarize_depto(item))
-
-    # Second standardization: accent standardization without accents with official names
-    names_mun_standard = clean.standardize_accents_mun(df_names, names_mun_standard)
-
-    # Third standardization: format standardization to ensure a right joining
-    names_mun_standard = clean.standardize_format_mun(df_names, names_mun_standard)
+    with instr.stage('df_filter_entity', rows_in=len(df_entity_filter)) as stage:
+        df_entity, names_mun_list = clean.df_filter_entity(df_entity_filter)
+        stage.add(rows_out=len(df_entity))
+
+    if gazetteer_path is None:
+        # Get list of departments and municipalities of Colombia
+        with instr.stage('df_cleaning_names', rows_in=len(df_names_raw)) as stage:
+            df_names = clean.df_cleaning_names(df_names_raw)
+            stage.add(rows_out=len(df_names))
+        # Standardization of names of mun/dept. with contracts with the entity
+        with instr.stage('standardize_mun_names', rows_in=len(names_mun_list)) as stage:
+            names_mun_standard = clean.standardize_mun_names(names_mun_list, df_names)
+            stage.add(rows_out=len(names_mun_standard))
+    else:
+        # Only names not seen in previous runs are standardized (and added to the gazetteer)
+        with instr.stage('load_gazetteer'):
+            names_gazetteer = gaz.load_gazetteer(gazetteer_path, df_names_raw)
+        with instr.stage('standardize_names', rows_in=len(names_mun_list)) as stage:
+            names_mun_standard, n_new = gaz.standardize_names(names_gazetteer, names_mun_list)
+            stage.add(rows_out=len(names_mun_standard), new_names=n_new)
+        # Saved with the new names, or with the official names just checked
+        if n_new > 0 or df_names_raw is not None:
+            gaz.save_gazetteer(gazetteer_path, names_gazetteer)
 
     # Assign new column to entity dataframe
     df_entity = df_entity.assign(nom_raz_soc_stand=names_mun_standard)
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+import pandas as pd
+import unidecode
+
+"""
+Local on-disk cache of SECOP API responses
+Each query (dataset, entity name and query parameters) is stored in a Parquet file with a JSON metadata file.
+Stale entries are refreshed incrementally: only rows uploaded after the max. upload date in cache are requested.
+"""
+
+CACHE_VERSION = 1
+DATE_COLUMN = 'fecha_de_cargue_en_el_secop'
+ID_COLUMN = 'uid'
+# Query parameters that do not change the rows of the query
+PAGING_PARAMS = ['$limit', '$offset', '$order']
+
+
+class CacheMissError(LookupError):
+    """Query not available in cache and network not allowed (offline mode)"""
+
+
+class ContractCache:
+    """
+    Local cache of SECOP queries
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory with the cached queries
+    ttl_hours : float
+        Hours after which a cached query is stale and is refreshed
+    offline: bool
+        If True, never touches the network: returns cached queries even if stale, and raises CacheMissError
+        if a query is not cached
+    """
+
+    def __init__(self, cache_dir, ttl_hours=24, offline=False):
+        self.cache_dir = cache_dir
+        self.ttl_hours = ttl_hours
+        self.offline = offline
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, url, entity_name, params):
+        """Name of the files of a query: readable entity name + hash of the query"""
+        query = {'url': url,
+                 'entity_name': entity_name,
+                 'params': {k: str(v) for k, v in params.items() if k not in PAGING_PARAMS}}
+        digest = hashlib.sha1(json.dumps(query, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        slug = re.sub(r'\W+', '_', unidecode.unidecode(entity_name)).strip('_')[:60]
+        return slug + '-' + digest
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.parquet', base + '.json'
+
+    def load(self, key):
+        """
+        Reads a cached query
+
+        Returns
+        -------
+        dataframe
+            cached rows (None if not cached)
+        dict
+            metadata of the cached query (None if not cached)
+        """
+        data_path, meta_path = self._paths(key)
+        if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+            return None, None
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION:
+            return None, None
+        return pd.read_parquet(data_path), meta
+
+    def save(self, key, df, meta):
+        """Writes a query to cache (data first, metadata last, so a crash never leaves stale metadata)"""
+        data_path, meta_path = self._paths(key)
+        df.to_parquet(data_path + '.tmp', index=False)
+        os.replace(data_path + '.tmp', data_path)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=1)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def is_stale(self, meta):
+        """True if the cached query is older than ttl_hours"""
+        fetched_at = datetime.fromisoformat(meta['fetched_at'])
+        age_hours = (datetime.now(timezone.utc) - fetched_at).total_seconds() / 3600
+        return age_hours > self.ttl_hours
+
+    def get_contracts(self, url, entity_name, params, fetch):
+        """
+        Gets the rows of a SECOP query, from cache when possible
+
+        Parameters
+        ----------
+        url : str
+            url of the SECOP dataset
+        entity_name : str
+            name of the entity queried (used to name the cache files)
+        params : dict
+            SoQL parameters of the query
+        fetch : function
+            fetch(url, params) -> dataframe, makes the request to the API
+
+        Returns
+        -------
+        dataframe
+            rows of the query
+        """
+        key = self.key(url, entity_name, params)
+        df_cached, meta = self.load(key)
+
+        if df_cached is not None and (self.offline or not self.is_stale(meta)):
+            return df_cached
+        if self.offline:
+            raise CacheMissError('Query not in cache (offline mode): ' + entity_name)
+
+        fetched_at = datetime.now(timezone.utc).isoformat()
+        if df_cached is None or not meta.get('max_date'):
+            # Full download
+            df = fetch(url, params)
+        else:
+            # Incremental refresh: only rows uploaded after the last cached row
+            df_new = fetch(url, incremental_params(params, meta['max_date']))
+            df = merge_rows(df_cached, df_new)
+
+        meta = {'version': CACHE_VERSION,
+                'url': url,
+                'entity_name': entity_name,
+                'params': {k: str(v) for k, v in params.items()},
+                'fetched_at': fetched_at,
+                'max_date': max_date(df),
+                'n_rows': len(df)}
+        self.save(key, df, meta)
+        return df
+
+
+def incremental_params(params, last_date):
+    """Adds to the query a SoQL $where to get only rows uploaded after last_date"""
+    where = DATE_COLUMN + " > '" + last_date + "'"
+    params = dict(params)
+    if params.get('$where'):
+        where = '(' + params['$where'] + ') AND ' + where
+    params['$where'] = where
+    return params
+
+
+def max_date(df):
+    """Max. upload date of the rows (ISO strings, so max. string = max. date)"""
+    if df.empty or DATE_COLUMN not in df.columns:
+        return None
+    dates = df[DATE_COLUMN].dropna()
+    return str(dates.max()) if not dates.empty else None
+
+
+def merge_rows(df_cached, df_new):
+    """Appends new rows to the cached ones; a contract uploaded again replaces its cached version"""
+    if df_new.empty:
+        return df_cached
+    df = pd.concat([df_cached, df_new], ignore_index=True, sort=False)
+    if ID_COLUMN in df.columns:
+        df = df.drop_duplicates(subset=ID_COLUMN, keep='last').reset_index(drop=True)
+    return df
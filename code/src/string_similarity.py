@@ -1,13 +1,21 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
 
+import checkpoint
+import instrumentation as instr
 import string_similarity_functions as ss
 import data_extraction_functions as extract
 import data_cleaning_functions as clean
 
 
-def contracting_chain(list_mun, n_contracts, entity_contracts):
+def contracting_chain(list_mun, n_contracts, entity_contracts, cache=None, fetch_workers=4, columns=None,
+                      workers=1, n_rare=None, encoder=None, checkpoint_dir=None, sink=None, keep_invalid=False):
     """
-    Gets the contracting chain of a public entity until the third-party contractor(s)
+    Gets the contracting chain of one or more public entities until the third-party contractor(s)
+    Each mun/dept. is downloaded, cleaned and vectorized once, and matched against the contracts of all the
+    entities issued to it (the entity of each pair is in the column nombre_de_la_entidad)
 
     Parameters
     ----------
@@ -16,85 +24,419 @@ def contracting_chain(list_mun, n_contracts, entity_contracts):
     n_contracts: int
         Max. number of contracts for the chain
     entity_contracts: dataframe
-        Dataframe with issued contracts from a public entity
+        Dataframe with issued contracts from one or more public entities
+    cache: ContractCache
+        local cache of SECOP queries (None to always query the API)
+    fetch_workers: int
+        Max. number of mun/dept. downloaded concurrently
+    columns: list
+        columns of the mun/dept. contracts to download, e.g. extract.SECOP_COLUMNS (None for all the columns)
+    workers: int
+        Number of processes evaluating mun/dept. in parallel (1 to evaluate them in this process)
+    n_rare: int
+        If given, only mun/dept. contracts sharing one of the n_rare rarest ngrams of an entity contract
+        are scored (see ss.candidate_recall to choose it). None to score all of them
+    encoder: TrigramEncoder
+        tf-idf encoder fitted over the whole run (see fit_encoder), so scores are comparable across
+        mun/dept. None to fit one per mun/dept.
+    checkpoint_dir: str
+        If given, the chain of each mun/dept. is written there as soon as it is evaluated, errors of a
+        mun/dept. are recorded instead of stopping the run, and mun/dept. finished by an interrupted run
+        with the same directory and options (including the encoder) are not evaluated again. A run
+        completed without failures is not resumed: the next one starts over
+    sink: ChainSink
+        If given, the chain of each mun/dept. is written to it (see chain_sinks) instead of returned,
+        so the whole chain is never held in memory. The caller closes it
+    keep_invalid: bool
+        If True, pairs with score under the threshold are also kept (valid = False). By default they are
+        discarded when scored
 
     Returns
     -------
     dataframe
-        dataframe with the contracting chain for a public entity
+        dataframe with the contracting chain for a public entity (None if written to sink)
     """
 
     entity_contracts = clean.df_cleaning(entity_contracts)
-    chain_cont = 0
     threshold = 0.8
-    chain_df = pd.DataFrame()
+    chain_options = {'n_contracts': n_contracts, 'threshold': threshold, 'n_rare': n_rare, 'encoder': encoder,
+                     'keep_invalid': keep_invalid}
+    chain_list = []
 
-    for i, item in enumerate(list_mun):
+    if checkpoint_dir is not None:
+        # Only mun/dept. not completed/skipped in previous runs; the chain of each one is written when finished
+        options = checkpoint.run_options(n_contracts, threshold, n_rare, keep_invalid, entity_contracts, encoder)
+        manifest = checkpoint.resume_manifest(checkpoint_dir, options)
+        finished = checkpoint.finished_mun(manifest)
+        list_mun_run = [item for item in list_mun if item not in finished]
+    else:
+        list_mun_run = list_mun
+
+    chain_mun_iter = iter_chain_mun(list_mun_run, entity_contracts, chain_options, cache=cache,
+                                    fetch_workers=fetch_workers, columns=columns, workers=workers,
+                                    catch_errors=checkpoint_dir is not None)
+    for i, (item, chain_mun_df, error) in enumerate(chain_mun_iter):
         if i % 10 == 0:
             print("Iteration # " + str(i) + ";     Mun/Dept Name: " + str(item))
+        if checkpoint_dir is not None:
+            with instr.stage('write_chain', item):
+                checkpoint.record_mun(checkpoint_dir, manifest, item, chain_mun_df, error)
+        elif sink is not None:
+            with instr.stage('write_chain', item):
+                sink.write(chain_mun_df)
+        elif chain_mun_df is not None:
+            chain_list.append(chain_mun_df)
+
+    if checkpoint_dir is not None:
+        print("Checkpoint: " + str(checkpoint.summary(manifest)))
+        checkpoint.complete_run(checkpoint_dir, manifest)
+        # The chain is read back from the checkpoint, one mun/dept. at a time
+        chain_list = checkpoint.iter_chain(checkpoint_dir, manifest, list_mun)
+
+    if sink is not None:
+        for chain_mun_df in chain_list:
+            sink.write(chain_mun_df)
+        return None
+    chain_list = list(chain_list)
+    if not chain_list:
+        return pd.DataFrame()
+    return pd.concat(chain_list, ignore_index=True, sort=False)
+
+
+def iter_chain_mun(list_mun, entity_contracts, chain_options, cache=None, fetch_workers=4, columns=None,
+                   workers=1, catch_errors=False):
+    """
+    Evaluates the mun/dept. one by one (or in a pool of processes)
+
+    Parameters
+    ----------
+    list_mun : list
+        list with the names of municipalities/departments to evaluate
+    entity_contracts: dataframe
+        contracts issued by the public entities (cleaned)
+    chain_options: dict
+        arguments of chain_mun (n_contracts, threshold, n_rare, encoder, keep_invalid)
+    cache: ContractCache
+        local cache of SECOP queries (None to always query the API)
+    fetch_workers: int
+        Max. number of mun/dept. downloaded concurrently (if workers = 1)
+    columns: list
+        columns of the mun/dept. contracts to download (None for all the columns)
+    workers: int
+        Number of processes evaluating mun/dept. in parallel (1 to evaluate them in this process)
+    catch_errors: bool
+        If True, an error in a mun/dept. (download or evaluation) is yielded instead of raised
+
+    Yields
+    ------
+    str
+        name of the mun/dept. (same order as list_mun)
+    dataframe
+        pairs of contracts of the mun/dept. (result of chain_mun), None if there was nothing to evaluate
+    Exception
+        error raised by the mun/dept. (None if no error)
+    """
+    if workers > 1:
+        # Each worker downloads and evaluates whole mun/dept.; results are returned in the order of list_mun
+        # (with the counters of the instrumentation recorded by the worker)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_chain_worker,
+                                 initargs=(entity_contracts, chain_options, cache, columns, catch_errors,
+                                           instr.is_enabled())) as executor:
+            for item, (chain_mun_df, error, stats) in zip(list_mun, executor.map(_chain_mun_worker, list_mun)):
+                instr.merge(stats)
+                yield item, chain_mun_df, error
+        return
+
+    # Contracts of the next mun/dept. are downloaded while the current one is evaluated
+    entity_rows = entity_rows_by_mun(entity_contracts)
+    mun_contracts_iter = extract.iter_mun_contracts(list_mun, workers=fetch_workers, cache=cache,
+                                                    columns=columns, return_exceptions=catch_errors)
+    for item, mun_contracts in mun_contracts_iter:
+        if isinstance(mun_contracts, Exception):
+            yield item, None, mun_contracts
+            continue
+        try:
+            entity_contracts_mun = entity_contracts.take(entity_rows.get(item, []))
+            chain_mun_df = chain_mun(item, mun_contracts, entity_contracts_mun, **chain_options)
+        except Exception as error:
+            if not catch_errors:
+                raise
+            yield item, None, error
+            continue
+        yield item, chain_mun_df, None
+
+
+def entity_rows_by_mun(entity_contracts):
+    """Positions of the entity contracts issued to each mun/dept. (of all the entities), computed once per run"""
+    return entity_contracts.groupby('nom_raz_soc_stand', sort=False).indices
+
+
+def fit_encoder(list_mun, entity_contracts, cache=None, fetch_workers=4, columns=None):
+    """
+    Fits a tf-idf encoder over all the descriptions of a run: contracts of the public entity and of
+    every mun/dept. (mun/dept. that fail to download are skipped)
+
+    Parameters
+    ----------
+    list_mun : list
+        list with the names of municipalities/departments to evaluate
+    entity_contracts: dataframe
+        Dataframe with issued contracts from a public entity
+    cache: ContractCache
+        local cache of SECOP queries (None to always query the API)
+    fetch_workers: int
+        Max. number of mun/dept. downloaded concurrently
+    columns: list
+        columns of the mun/dept. contracts to download (None for all the columns)
+
+    Returns
+    -------
+    TrigramEncoder
+        fitted encoder, to pass to contracting_chain
+    """
+    normalizer = clean.get_obj_normalizer()
+    encoder = ss.TrigramEncoder()
+
+    entity_contracts = clean.df_cleaning(entity_contracts)
+    encoder.partial_fit(normalizer.normalize_series(entity_contracts['detalle_del_objeto_a_contratar']).tolist())
+    # A mun/dept. that fails to download is left out of the fit (contracting_chain records its error)
+    for _, mun_contracts in extract.iter_mun_contracts(list_mun, workers=fetch_workers, cache=cache,
+                                                       columns=columns, return_exceptions=True):
+        if isinstance(mun_contracts, Exception) or mun_contracts.empty:
+            continue
+        mun_contracts = clean.df_cleaning(mun_contracts)
+        encoder.partial_fit(normalizer.normalize_series(mun_contracts['detalle_del_objeto_a_contratar']).tolist())
+    return encoder
+
 
-        mun_name = list_mun[i]
+def chain_mun(mun_name, mun_contracts, entity_contracts, n_contracts, threshold, n_rare=None, encoder=None,
+              keep_invalid=False):
+    """
+    Gets the contracting chain of a public entity for one municipality/department
 
+    Parameters
+    ----------
+    mun_name : str
+        name of the municipality/department (standardized)
+    mun_contracts: dataframe
+        contracts issued by the mun/dept. (raw)
+    entity_contracts: dataframe
+        contracts issued by the public entity (cleaned)
+    n_contracts: int
+        Max. number of mun/dept. contracts matched to each entity contract
+    threshold: float
+        Min. score (exclusive) for a pair of contracts to be valid
+    n_rare: int
+        Number of rarest ngrams used to shortlist mun/dept. contracts (None to score all of them)
+    encoder: TrigramEncoder
+        tf-idf encoder fitted over the whole run (None to fit one for the mun/dept.)
+    keep_invalid: bool
+        If True, pairs with score under the threshold are also returned (otherwise discarded when scored)
+
+    Returns
+    -------
+    dataframe
+        pairs of contracts of the mun/dept. (result of build_chain_mun), None if there is nothing to evaluate
+    """
+    with instr.stage('chain_mun', mun_name, rows_in=len(mun_contracts)) as stage:
         # Subsets public entity df to contracts issued for the mun/dept.
-        entity_contracts_mun = entity_contracts.loc[entity_contracts['nom_raz_soc_stand'] == item]
+        entity_contracts_mun = entity_contracts.loc[entity_contracts['nom_raz_soc_stand'] == mun_name]
 
-        mun_contracts = extract.extract_mun_contracts(mun_name)
         # If there are no contracts for the mun/dept. in SECOP continue
         if mun_contracts.empty:
-            continue
+            return None
 
-        mun_contracts = clean.df_cleaning(mun_contracts)
+        with instr.stage('df_cleaning', rows_in=len(mun_contracts)) as cleaning_stage:
+            mun_contracts = clean.df_cleaning(mun_contracts)
+            cleaning_stage.add(rows_out=len(mun_contracts))
         # If there are no contracts for the mun/dept. in the states allowed, continue
         # States = 'Liquidado', 'Terminado Sin Liquidar', 'Celebrado', 'Adjudicado', 'Convocado'
         if mun_contracts.empty:
-            continue
+            return None
+
+        # Approximate string matching: all the entity contracts of the mun/dept. at once
+        lower_bound = 0 if keep_invalid else threshold
+        matches_sparse = match_mun_contracts(entity_contracts_mun, mun_contracts, n_contracts, n_rare, encoder,
+                                             lower_bound)
+
+        # Chain construction ----
+        chain_mun_df = build_chain_mun(entity_contracts_mun, mun_contracts, matches_sparse, threshold)
+        stage.add(rows_out=len(chain_mun_df))
+        return chain_mun_df
+
+
+# State of each process of the pool of contracting_chain: entity contracts are sent once per process
+_worker_state = {}
+
+
+def _init_chain_worker(entity_contracts, chain_options, cache, columns, catch_errors, instrumented):
+    _worker_state.update(entity_contracts=entity_contracts, entity_rows=entity_rows_by_mun(entity_contracts),
+                         chain_options=chain_options, cache=cache, columns=columns, catch_errors=catch_errors)
+    if instrumented:
+        instr.enable()
+
+
+def _chain_mun_worker(mun_name):
+    try:
+        mun_contracts = extract.extract_mun_contracts(mun_name, cache=_worker_state['cache'],
+                                                      columns=_worker_state['columns'])
+        entity_contracts_mun = _worker_state['entity_contracts'].take(_worker_state['entity_rows'].get(mun_name, []))
+        chain_mun_df = chain_mun(mun_name, mun_contracts, entity_contracts_mun, **_worker_state['chain_options'])
+        return chain_mun_df, None, instr.collect()
+    except Exception as error:
+        if not _worker_state['catch_errors']:
+            raise
+        return None, error, instr.collect()
+
+
+def match_mun_contracts(entity_contracts_mun, mun_contracts, n_contracts, n_rare=None, encoder=None,
+                        lower_bound=0):
+    """
+    Scores all the contracts issued by the public entity to a mun/dept. against the contracts
+    issued by the mun/dept.
+    Descriptions of the mun/dept. are cleaned and vectorized only once
+
+    Parameters
+    ----------
+    entity_contracts_mun : dataframe
+        contracts issued by the public entity to the mun/dept.
+    mun_contracts: dataframe
+        contracts issued by the mun/dept. (cleaned)
+    n_contracts: int
+        Max. number of mun/dept. contracts matched to each entity contract
+    n_rare: int
+        If given, only mun/dept. contracts sharing one of the n_rare rarest ngrams of an entity contract
+        are scored. None to score all of them
+    encoder: TrigramEncoder
+        tf-idf encoder fitted over the whole run (None to fit one with the descriptions of the mun/dept.
+        and the entity)
+    lower_bound: float
+        Min. score (exclusive) of the pairs kept
+
+    Returns
+    -------
+    csr matrix
+        (entity contracts x mun/dept. contracts) sparse matrix with the n_contracts highest scores
+        (above lower_bound) per entity contract, among the mun/dept. contracts issued on or after the year of the entity contract
+    """
+    normalizer = clean.get_obj_normalizer()
+    with instr.stage('normalization', rows_in=len(mun_contracts) + len(entity_contracts_mun)):
+        mun_description_list = normalizer.normalize_series(mun_contracts['detalle_del_objeto_a_contratar']).tolist()
+        entity_description_list = normalizer.normalize_series(
+            entity_contracts_mun['detalle_del_objeto_a_contratar']).tolist()
+
+    # String similarity algorithm -----
+    # 1. Transforms descriptions with tf-idf (fitted once with the descriptions of the mun/dept. and the entity,
+    # if there is no encoder of the whole run)
+    with instr.stage('tf_idf', rows_in=len(mun_description_list) + len(entity_description_list)):
+        if encoder is None:
+            encoder = ss.tf_idf_vectorizer(mun_description_list + entity_description_list)
+        mun_matrix = encoder.transform(mun_description_list)
+        entity_matrix = encoder.transform(entity_description_list)
+
+    # 2. Gets similarity scores entity rows x mun/dept. columns
+    entity_years = pd.to_numeric(entity_contracts_mun['anno_firma_del_contrato']).to_numpy(dtype=float)
+    mun_years = pd.to_numeric(mun_contracts['anno_firma_del_contrato']).to_numpy(dtype=float)
+    return score_contracts(entity_description_list, entity_matrix, entity_years, mun_description_list, mun_matrix,
+                           mun_years, n_contracts, n_rare, lower_bound)
+
+
+def score_contracts(entity_description_list, entity_matrix, entity_years, mun_description_list, mun_matrix,
+                    mun_years, n_contracts, n_rare=None, lower_bound=0):
+    """
+    Top-n scores of entity contracts against mun/dept. contracts already normalized and vectorized
+
+    Parameters
+    ----------
+    entity_description_list, mun_description_list : list
+        normalized descriptions of the contracts
+    entity_matrix, mun_matrix : sparse matrix
+        tf-idf representation of the descriptions (same encoder)
+    entity_years, mun_years : array
+        signing year of the contracts (float, NaN if unknown)
+    n_contracts: int
+        Max. number of mun/dept. contracts matched to each entity contract
+    n_rare: int
+        Number of rarest ngrams used to shortlist mun/dept. contracts (None to score all of them)
+    lower_bound: float
+        Min. score (exclusive) of the pairs kept
+
+    Returns
+    -------
+    csr matrix
+        (entity contracts x mun/dept. contracts) sparse matrix, as match_mun_contracts
+    """
+    from scipy.sparse import csr_matrix
+
+    # Only mun/dept contracts issued on or after year of the entity contract: the year filter is a mask
+    # over the mun/dept. columns, shared by all the entity contracts signed the same year
+    shape = (len(entity_description_list), len(mun_description_list))
+
+    with instr.stage('top_n', rows_in=shape[0]) as stage:
+        if n_rare is not None:
+            # Candidate generation: exact scores only for the shortlisted pairs
+            candidates = ss.rare_ngram_candidates(entity_description_list, mun_description_list, n_rare).tocoo()
+            rows, cols = candidates.row, candidates.col
+            eligible = (mun_years[cols] >= entity_years[rows]) | np.isnan(mun_years[cols])
+            rows, cols = rows[eligible], cols[eligible]
+            scores = ss.cossim_pairs(entity_matrix, mun_matrix, rows, cols)
+            matches_sparse = ss.top_n_pairs(rows, cols, scores, n_contracts, shape, lower_bound)
+            stage.add(candidates=len(rows), rows_out=matches_sparse.nnz)
+            return matches_sparse
+
+        rows, cols, scores = [], [], []
+        for year in np.unique(entity_years[~np.isnan(entity_years)]):
+            pos_entity = np.flatnonzero(entity_years == year)
+            pos_mun = np.flatnonzero((mun_years >= year) | np.isnan(mun_years))
+            if pos_mun.size == 0:
+                continue
+            matches_year = ss.awesome_cossim_top(entity_matrix[pos_entity], mun_matrix[pos_mun].transpose(),
+                                                 n_contracts, lower_bound).tocoo()
+            rows.append(pos_entity[matches_year.row])
+            cols.append(pos_mun[matches_year.col])
+            scores.append(matches_year.data)
+
+        if not rows:
+            return csr_matrix(shape)
+        matches_sparse = csr_matrix((np.concatenate(scores), (np.concatenate(rows), np.concatenate(cols))),
+                                    shape=shape)
+        stage.add(rows_out=matches_sparse.nnz)
+        return matches_sparse
+
+
+def build_chain_mun(entity_contracts_mun, mun_contracts, matches_sparse, threshold):
+    """
+    Pastes complete info of the entity and mun/dept. contracts matched
+
+    Parameters
+    ----------
+    entity_contracts_mun : dataframe
+        contracts issued by the public entity to the mun/dept.
+    mun_contracts: dataframe
+        contracts issued by the mun/dept. (cleaned)
+    matches_sparse: csr matrix
+        (entity contracts x mun/dept. contracts) similarity scores, result of match_mun_contracts
+    threshold: float
+        Min. score (exclusive) for a pair of contracts to be valid
+
+    Returns
+    -------
+    dataframe
+        one row per pair of contracts: entity columns, mun/dept. columns with suffix '_mun', score and valid
+    """
+    with instr.stage('chain_assembly', rows_in=matches_sparse.nnz):
+        return _build_chain_mun(entity_contracts_mun, mun_contracts, matches_sparse, threshold)
+
+
+def _build_chain_mun(entity_contracts_mun, mun_contracts, matches_sparse, threshold):
+    matches_sparse = matches_sparse.tocoo()
+    # Entity contract first, then highest score first
+    order = np.lexsort((-matches_sparse.data, matches_sparse.row))
+    scores = matches_sparse.data[order]
 
-        # Approximate string matching
-        for index, entity_row in entity_contracts_mun.iterrows():
-
-            # Only evaluate mun/dept contracts issued on or after year of the entity contract
-            mun_contracts_filter = mun_contracts[
-                (mun_contracts.anno_firma_del_contrato >= entity_row['anno_firma_del_contrato']) |
-                (mun_contracts['anno_firma_del_contrato'].isnull())]
-            mun_contracts_filter = mun_contracts_filter.reset_index(drop=True)
-
-            # Create list with description of each contract to evaluate
-            mun_description = mun_contracts_filter['detalle_del_objeto_a_contratar']
-            mun_description_list = list(map(str, list(map(clean.standarize_obj, mun_description))))
-            mun_description_list = pd.Series(mun_description_list)
-            entity_description_list = pd.Series(clean.standarize_obj(entity_row['detalle_del_objeto_a_contratar']))
-
-            # Paste descriptions mun/dept. and entity. Last row = entity contract
-            description_list = list(mun_description_list) + list(entity_description_list)
-
-            # String similarity algorithm -----
-            # 1. Transforms strings with tf-idf algorithm to a numeric matrix
-            tf_idf_matrix = ss.tf_idf(description_list)
-            # 2. Gets similarity scores in a sparse matrix
-            matches_sparse = ss.awesome_cossim_top(tf_idf_matrix, tf_idf_matrix.transpose(), n_contracts)
-            # 3. Converts similarity matrix to a readable df
-            matches_df = ss.get_matches_df(matches_sparse, description_list)
-
-            # Chain construction ----
-            # Pastes complete info of the contracts with high similitude
-            for index_chain, row_chain in matches_df.loc[matches_df['pos_left'] == (len(description_list)-1)].iterrows():
-                if row_chain['pos_left'] == row_chain['pos_right']: continue
-                score = row_chain['similarity']
-                # Joining info
-                chain_entity = entity_row.to_frame().T
-                if len(mun_contracts_filter) == row_chain['pos_right']: continue
-                chain_mun = mun_contracts_filter.iloc[row_chain['pos_right']].to_frame().T
-                chain_entity.index = [chain_cont]
-                chain_mun.index = [chain_cont]
-                chain_mun.columns = [str(col) + '_mun' for col in chain_mun.columns]
-                chain_result = pd.concat([chain_entity, chain_mun], axis=1, join='inner', sort=True)
-                chain_df = chain_df.append(chain_result, sort=False)
-                chain_df.at[chain_df.index[chain_cont], 'score'] = score
-                if score > threshold:
-                    chain_df.at[chain_df.index[chain_cont], 'valid'] = True
-                else:
-                    chain_df.at[chain_df.index[chain_cont], 'valid'] = False
-                chain_cont = chain_cont + 1
-
-    chain_df = chain_df.loc[chain_df["valid"]]
-    return chain_df
+    chain_entity = entity_contracts_mun.take(matches_sparse.row[order]).reset_index(drop=True)
+    chain_mun = mun_contracts.take(matches_sparse.col[order]).reset_index(drop=True).add_suffix('_mun')
+    chain_mun_df = pd.concat([chain_entity, chain_mun], axis=1)
+    chain_mun_df['score'] = scores
+    chain_mun_df['valid'] = scores > threshold
+    return chain_mun_df
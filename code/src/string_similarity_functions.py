@@ -1,10 +1,8 @@
+import hashlib
 import pandas as pd
 import numpy as np
 import re
-from sklearn.feature_extraction.text import TfidfVectorizer
-from scipy.sparse import csr_matrix
-# Source: https://github.com/ing-bank/sparse_dot_topn
-import sparse_dot_topn.sparse_dot_topn as ct
+import time
 
 
 def ngrams(name_string, n=3):
@@ -29,6 +27,148 @@ def ngrams(name_string, n=3):
     return [''.join(n_gram) for n_gram in n_grams]
 
 
+_ngrams_regex = re.compile(r'[,-./]|\sBD')
+_bits_per_char = 21  # Unicode code points fit in 21 bits
+
+
+def ngram_keys(name_vector, n=3):
+    """
+    Divides all the strings in groups of n characters at once (same ngrams as the function ngrams)
+    Each ngram is packed in an integer key: keys sort as the ngrams
+
+    Parameters
+    ----------
+    name_vector : list
+        strings to be divided
+    n : int
+        Size of the groups (max. 3)
+
+    Returns
+    -------
+    array
+        position in name_vector of the string of each ngram
+    array
+        key (uint64) of each ngram
+    """
+    strings = [_ngrams_regex.sub('', str(item)) for item in name_vector]
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    codes = np.frombuffer(''.join(strings).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    rows = np.repeat(np.arange(len(strings)), lengths)
+
+    # Window starting at i is an ngram if it does not cross the end of its string
+    n_windows = max(codes.size - n + 1, 0)
+    valid = rows[:n_windows] == rows[n - 1:n - 1 + n_windows]
+    keys = np.zeros(n_windows, dtype=np.uint64)
+    for i in range(n):
+        keys = (keys << np.uint64(_bits_per_char)) | codes[i:i + n_windows]
+    return rows[:n_windows][valid], keys[valid]
+
+
+class TrigramEncoder:
+    """
+    tf-idf representation of strings with ngrams of characters (same result as TfidfVectorizer with
+    the ngrams analyzer), with vectorized ngram extraction
+    The vocabulary and idf weights can be fitted once over a whole corpus (e.g. all the descriptions of a run),
+    by parts, and saved to disk, so scores are comparable across municipalities/departments
+
+    Parameters
+    ----------
+    n : int
+        Size of the ngrams (max. 3)
+    """
+
+    def __init__(self, n=3):
+        self.n = n
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.doc_freq = np.zeros(0, dtype=np.int64)
+        self.n_docs = 0
+        self.idf = np.zeros(0)
+
+    def partial_fit(self, name_vector):
+        """Adds the strings to the vocabulary and document frequencies"""
+        rows, keys = ngram_keys(name_vector, self.n)
+        # Distinct ngrams of each string
+        order = np.lexsort((keys, rows))
+        rows, keys = rows[order], keys[order]
+        first = np.ones(keys.size, dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (keys[1:] != keys[:-1])
+        new_keys, new_freq = np.unique(keys[first], return_counts=True)
+
+        all_keys, inverse = np.unique(np.concatenate([self.keys, new_keys]), return_inverse=True)
+        self.doc_freq = np.bincount(inverse, weights=np.concatenate([self.doc_freq, new_freq]),
+                                    minlength=all_keys.size).astype(np.int64)
+        self.keys = all_keys
+        self.n_docs = self.n_docs + len(name_vector)
+        # Smooth idf, as TfidfVectorizer
+        self.idf = np.log((1 + self.n_docs) / (1 + self.doc_freq)) + 1
+        return self
+
+    def fit(self, name_vector):
+        """Fits the vocabulary and idf weights with the strings"""
+        self.__init__(self.n)
+        return self.partial_fit(name_vector)
+
+    def transform(self, name_vector):
+        """
+        Transforms list of strings to a tf-idf representation (ngrams out of the vocabulary are ignored)
+
+        Parameters
+        ----------
+        name_vector : list
+            List of strings to convert
+
+        Returns
+        -------
+        sparse matrix
+            (strings x vocabulary) l2-normalized tf-idf representation of each string
+        """
+        from scipy.sparse import csr_matrix
+
+        rows, keys = ngram_keys(name_vector, self.n)
+        cols = np.searchsorted(self.keys, keys)
+        found = cols < self.keys.size
+        found[found] = self.keys[cols[found]] == keys[found]
+        tf_idf_matrix = csr_matrix((np.ones(found.sum()), (rows[found], cols[found])),
+                                   shape=(len(name_vector), self.keys.size))
+        tf_idf_matrix.data *= self.idf[tf_idf_matrix.indices]
+        return l2_normalize(tf_idf_matrix)
+
+    def fit_transform(self, name_vector):
+        return self.fit(name_vector).transform(name_vector)
+
+    def save(self, path):
+        """Writes the vocabulary and idf weights (.npz)"""
+        np.savez_compressed(path, n=self.n, keys=self.keys, doc_freq=self.doc_freq, n_docs=self.n_docs)
+
+    def fingerprint(self):
+        """Hash of the vocabulary and document frequencies (equal for encoders giving the same scores)"""
+        digest = hashlib.sha1(str((self.n, self.n_docs)).encode('utf-8'))
+        digest.update(np.ascontiguousarray(self.keys, dtype=np.uint64).tobytes())
+        digest.update(np.ascontiguousarray(self.doc_freq, dtype=np.int64).tobytes())
+        return digest.hexdigest()[:16]
+
+    @classmethod
+    def load(cls, path):
+        """Reads an encoder written with save"""
+        with np.load(path) as f:
+            encoder = cls(int(f['n']))
+            encoder.keys = f['keys']
+            encoder.doc_freq = f['doc_freq']
+            encoder.n_docs = int(f['n_docs'])
+        encoder.idf = np.log((1 + encoder.n_docs) / (1 + encoder.doc_freq)) + 1
+        return encoder
+
+
+def l2_normalize(matrix):
+    """Scales each row of a csr matrix to unit l2 norm (rows of zeros are kept), as sklearn normalize"""
+    row_nnz = np.diff(matrix.indptr)
+    norms = np.sqrt(np.bincount(np.repeat(np.arange(matrix.shape[0]), row_nnz), weights=matrix.data ** 2,
+                                minlength=matrix.shape[0]))
+    norms[norms == 0] = 1
+    matrix.data /= np.repeat(norms, row_nnz)
+    return matrix
+
+
 def tf_idf(name_vector):
     """
     Transforms list of strings to a tf-idf representation with ngrams analizer
@@ -43,17 +183,39 @@ def tf_idf(name_vector):
     sparse matrix
         sparse matrix with tf-idf representation for each string in the list
     """
-    name_series = pd.Series(list(map(str, name_vector)))
-
-    vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams)
-    tf_idf_matrix = vectorizer.fit_transform(name_series)
+    name_vector = list(map(str, name_vector))
+    tf_idf_matrix = TrigramEncoder().fit_transform(name_vector)
     return tf_idf_matrix
 
 
-def awesome_cossim_top(A, B, ntop, lower_bound=0):
+def tf_idf_vectorizer(name_vector):
+    """
+    Fits a tf-idf vectorizer with ngrams analizer, to transform several groups of strings
+    with the same vocabulary
+
+    Parameters
+    ----------
+    name_vector : list
+        List of strings used to fit the vocabulary and idf weights
+
+    Returns
+    -------
+    TrigramEncoder
+        fitted vectorizer
+    """
+    return TrigramEncoder().fit(list(map(str, name_vector)))
+
+
+# Rows of A per call to the top-n kernel: the outputs of a call (block_rows * ntop) bound the memory
+BLOCK_ROWS = 100000
+_INT32_MAX = np.iinfo(np.int32).max
+
+
+def awesome_cossim_top(A, B, ntop, lower_bound=0, workers=1, block_rows=BLOCK_ROWS):
     """
     Evaluates similarity score between two groups of strings (as matrix) with cosine similarity and
     prints ntop highest values per string
+    Rows of A are evaluated by blocks of block_rows, each block with workers threads of the native kernel
 
     Parameters
     ----------
@@ -61,83 +223,309 @@ def awesome_cossim_top(A, B, ntop, lower_bound=0):
         matrix representation of strings to compare
     ntop : int
         Number of coincidences wanted printed in results
+    lower_bound : float
+        Min. score (exclusive) kept, pairs below it are discarded by the kernel
+    workers : int
+        Number of threads of the kernel
+    block_rows : int
+        Max. number of rows of A per call to the kernel
 
     Returns
     -------
     csr matrix
-        a sparse matrix with the ntop highest coincidences
+        a sparse matrix with the ntop highest coincidences (64-bit indices if they do not fit in 32 bits)
     """
+    from scipy.sparse import csr_matrix
 
     # force A and B as a CSR matrix.
     A = A.tocsr()
     B = B.tocsr()
     M, _ = A.shape
     _, N = B.shape
+    # No common ngram: nothing to score (the Cython kernel of sparse_dot_topn < 1.0 fails on empty matrices)
+    if M == 0 or A.nnz == 0 or B.nnz == 0:
+        return csr_matrix((M, N), dtype=A.dtype)
+    kernel = _topn_kernel(B, ntop, lower_bound, workers)
+
+    # Blocks are merged at the end: one concatenation of their (trimmed) outputs
+    indptr_list, indices_list, data_list = [np.zeros(1, dtype=np.int64)], [], []
+    nnz = 0
+    for start in range(0, M, block_rows):
+        block = A[start:start + block_rows]
+        if block.nnz == 0:
+            indptr = np.zeros(block.shape[0] + 1, dtype=np.int64)
+            indices, data = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=A.dtype)
+        else:
+            indptr, indices, data = kernel(block)
+        indptr_list.append(indptr[1:].astype(np.int64) + nnz)
+        indices_list.append(indices)
+        data_list.append(data)
+        nnz += int(indptr[-1])
+
+    indptr = np.concatenate(indptr_list)
+    if nnz <= _INT32_MAX:
+        indptr = indptr.astype(np.int32)
+    return csr_matrix((np.concatenate(data_list), np.concatenate(indices_list), indptr), shape=(M, N))
+
+
+def _topn_kernel(B, ntop, lower_bound, workers):
+    """
+    Top-n product by B of a block of rows: function block -> (indptr, indices, data) in CSR format
+    Uses sparse_dot_topn (imported on first use): sp_matmul_topn if version >= 1.0 (32 or 64-bit indices),
+    the Cython kernel of previous versions otherwise (32-bit indices only)
+    """
+    # Source: https://github.com/ing-bank/sparse_dot_topn
+    import sparse_dot_topn
+
+    if hasattr(sparse_dot_topn, 'sp_matmul_topn'):
+        idx_dtype = np.int64 if max(B.nnz, *B.shape) > _INT32_MAX else np.int32
+
+        def kernel(block):
+            C = sparse_dot_topn.sp_matmul_topn(block, B, ntop, threshold=lower_bound, sort=True,
+                                               n_threads=workers if workers > 1 else None, idx_dtype=idx_dtype)
+            return C.indptr, C.indices, C.data
+        return kernel
+
+    if max(B.nnz, *B.shape) > _INT32_MAX:
+        raise ValueError('Matrix too large for 32-bit indices: sparse_dot_topn >= 1.0 is required')
+    if workers > 1:
+        import sparse_dot_topn.sparse_dot_topn_threaded as ct
+    else:
+        import sparse_dot_topn.sparse_dot_topn as ct
+    # Index arrays of B are cast once, not once per block
+    N = B.shape[1]
+    b_indptr = B.indptr.astype(np.int32, copy=False)
+    b_indices = B.indices.astype(np.int32, copy=False)
+
+    def kernel(block):
+        rows = block.shape[0]
+        if max(block.nnz, rows * ntop) > _INT32_MAX:
+            raise ValueError('Block too large for 32-bit indices: use a smaller block_rows')
+        indptr = np.zeros(rows + 1, dtype=np.int32)
+        indices = np.zeros(rows * ntop, dtype=np.int32)
+        data = np.zeros(rows * ntop, dtype=block.dtype)
+        args = [rows, N, block.indptr.astype(np.int32, copy=False), block.indices.astype(np.int32, copy=False),
+                block.data, b_indptr, b_indices, B.data, ntop, lower_bound, indptr, indices, data]
+        if workers > 1:
+            ct.sparse_dot_topn_threaded(*args, workers)
+        else:
+            ct.sparse_dot_topn(*args)
+        # Only the values written are kept, so the buffers of the block are released
+        nnz = indptr[-1]
+        return indptr, indices[:nnz].copy(), data[:nnz].copy()
+    return kernel
+
+
+def rare_ngram_candidates(query_vector, index_vector, n_rare=10):
+    """
+    Shortlists, for each query string, the index strings sharing at least one of its rarest ngrams
+    (inverted index over the ngrams of the index strings)
 
-    idx_dtype = np.int32
-
-    nnz_max = M * ntop
+    Parameters
+    ----------
+    query_vector : list
+        strings to match (e.g. entity descriptions)
+    index_vector : list
+        strings matched against (e.g. mun/dept. descriptions)
+    n_rare : int
+        Number of rarest ngrams (lowest document frequency in index_vector) of each query string used
 
-    indptr = np.zeros(M + 1, dtype=idx_dtype)
-    indices = np.zeros(nnz_max, dtype=idx_dtype)
-    data = np.zeros(nnz_max, dtype=A.dtype)
+    Returns
+    -------
+    csr matrix
+        (query x index) sparse matrix, non zero for candidate pairs
+    """
+    from scipy.sparse import csr_matrix
+
+    # Binary (strings x ngrams) matrices over the vocabulary of index_vector
+    index_rows, index_keys = ngram_keys(index_vector)
+    vocabulary, index_cols = np.unique(index_keys, return_inverse=True)
+    index_ngrams = csr_matrix((np.ones(index_keys.size, dtype=np.int32), (index_rows, index_cols)),
+                              shape=(len(index_vector), vocabulary.size))
+    index_ngrams.data[:] = 1
+    index_ngrams = index_ngrams.tocsc()
+    query_rows, query_keys = ngram_keys(query_vector)
+    query_cols = np.searchsorted(vocabulary, query_keys)
+    found = query_cols < vocabulary.size
+    found[found] = vocabulary[query_cols[found]] == query_keys[found]
+    query_ngrams = csr_matrix((np.ones(found.sum(), dtype=np.int32), (query_rows[found], query_cols[found])),
+                              shape=(len(query_vector), vocabulary.size))
+    query_ngrams.sort_indices()
+
+    # Keeps the n_rare ngrams with the lowest document frequency of each query string
+    doc_freq = np.diff(index_ngrams.indptr)
+    rows = np.repeat(np.arange(query_ngrams.shape[0]), np.diff(query_ngrams.indptr))
+    order = np.lexsort((doc_freq[query_ngrams.indices], rows))
+    rank = np.arange(order.size) - np.repeat(query_ngrams.indptr[:-1], np.diff(query_ngrams.indptr))
+    rare = np.zeros(order.size, dtype=bool)
+    rare[order[rank < n_rare]] = True
+    query_rare = csr_matrix((rare.astype(np.int32), query_ngrams.indices, query_ngrams.indptr),
+                            shape=query_ngrams.shape)
+    query_rare.eliminate_zeros()
+
+    # Postings of the rare ngrams
+    return (query_rare @ index_ngrams.T).tocsr()
+
+
+def cossim_pairs(A, B, rows, cols):
+    """
+    Evaluates similarity score (cosine) only for the pairs given
 
-    ct.sparse_dot_topn(
-        M, N, np.asarray(A.indptr, dtype=idx_dtype),
-        np.asarray(A.indices, dtype=idx_dtype),
-        A.data,
-        np.asarray(B.indptr, dtype=idx_dtype),
-        np.asarray(B.indices, dtype=idx_dtype),
-        B.data,
-        ntop,
-        lower_bound,
-        indptr, indices, data)
+    Parameters
+    ----------
+    A,B : matrix
+        l2-normalized matrix representation of strings to compare (A rows vs B rows)
+    rows, cols : array
+        positions in A and B of each pair
 
-    return csr_matrix((data, indices, indptr), shape=(M, N))
+    Returns
+    -------
+    array
+        similarity score of each pair
+    """
+    A = A.tocsr()
+    B = B.tocsr()
+    scores = np.zeros(len(rows), dtype=A.dtype)
+    # By blocks, to bound the size of the intermediate products
+    block = 100000
+    for start in range(0, len(rows), block):
+        end = start + block
+        scores[start:end] = np.asarray(A[rows[start:end]].multiply(B[cols[start:end]]).sum(axis=1)).ravel()
+    return scores
 
 
-def get_matches_df(sparse_matrix, name_vector):
+def top_n_pairs(rows, cols, scores, ntop, shape, lower_bound=0):
     """
-    Converts the sparse matrix result of similarity to a readable format (dataframe)
+    Keeps the ntop highest scores per row, among the scores above lower_bound
 
     Parameters
     ----------
-    sparse_matrix : csr matrix
-        sparse matrix representation of similarity score between two groups of strings
-    name_vector : list
-        list with name of the strings compared
+    rows, cols : array
+        positions of each pair
+    scores : array
+        similarity score of each pair
+    ntop : int
+        Number of coincidences kept per row
+    shape : tuple
+        shape of the result
+    lower_bound : float
+        Min. score (exclusive) kept
 
     Returns
     -------
-    dataframe
-        a dataframe with the scores and string coincidences with the highest similarity for each string
+    csr matrix
+        a sparse matrix with the ntop highest coincidences
     """
+    from scipy.sparse import csr_matrix
 
-    name_vector_list = pd.Series(list(map(str, name_vector)))
+    order = np.lexsort((-scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    counts = np.bincount(rows, minlength=shape[0])
+    rank = np.arange(rows.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    keep = (rank < ntop) & (scores > lower_bound)
+    return csr_matrix((scores[keep], (rows[keep], cols[keep])), shape=shape)
 
-    non_zeros = sparse_matrix.nonzero()
 
-    sparserows = non_zeros[0]
-    sparsecols = non_zeros[1]
+def candidate_recall(query_vector, index_vector, ntop, n_rare_list=(2, 5, 10, 20, 40), threshold=0.8):
+    """
+    Compares the candidate generation (rare ngrams) with the exhaustive top-n, to choose n_rare
 
-    nr_matches = sparsecols.size
+    Parameters
+    ----------
+    query_vector : list
+        strings to match (e.g. entity descriptions)
+    index_vector : list
+        strings matched against (e.g. mun/dept. descriptions)
+    ntop : int
+        Number of coincidences per query string
+    n_rare_list : list
+        values of n_rare to evaluate
+    threshold : float
+        Min. score of the pairs counted in recall_valid
 
-    left_side = np.empty([nr_matches], dtype=object)
-    right_side = np.empty([nr_matches], dtype=object)
-    similarity = np.zeros(nr_matches)
-    pos_left = np.zeros(nr_matches, dtype=np.int)
-    pos_right = np.zeros(nr_matches, dtype=np.int)
+    Returns
+    -------
+    dataframe
+        per n_rare: candidates per query string, recall of the exhaustive top-n pairs, recall of the pairs
+        above threshold and seconds spent (exhaustive path in the row with n_rare = None)
+    """
+    query_vector = list(map(str, query_vector))
+    index_vector = list(map(str, index_vector))
+    vectorizer = tf_idf_vectorizer(index_vector + query_vector)
+    A = vectorizer.transform(query_vector)
+    B = vectorizer.transform(index_vector)
+
+    start = time.perf_counter()
+    exhaustive = awesome_cossim_top(A, B.transpose(), ntop).tocoo()
+    report = [{'n_rare': None,
+               'candidates_per_query': B.shape[0],
+               'recall': 1.0,
+               'recall_valid': 1.0,
+               'seconds': time.perf_counter() - start}]
+    pairs = set(zip(exhaustive.row, exhaustive.col))
+    pairs_valid = set(zip(exhaustive.row[exhaustive.data > threshold], exhaustive.col[exhaustive.data > threshold]))
+
+    for n_rare in n_rare_list:
+        start = time.perf_counter()
+        candidates = rare_ngram_candidates(query_vector, index_vector, n_rare).tocoo()
+        scores = cossim_pairs(A, B, candidates.row, candidates.col)
+        matches = top_n_pairs(candidates.row, candidates.col, scores, ntop, (A.shape[0], B.shape[0])).tocoo()
+        seconds = time.perf_counter() - start
+        found = set(zip(matches.row, matches.col))
+        report.append({'n_rare': n_rare,
+                       'candidates_per_query': candidates.nnz / max(A.shape[0], 1),
+                       'recall': len(pairs & found) / max(len(pairs), 1),
+                       'recall_valid': len(pairs_valid & found) / max(len(pairs_valid), 1),
+                       'seconds': seconds})
+    return pd.DataFrame(report)
+
+
+def get_matches_df(sparse_matrix, name_vector, rows=None, name_vector_right=None):
+    """
+    Converts the sparse matrix result of similarity to a readable format (dataframe)
 
-    for index in range(0, nr_matches):
-        left_side[index] = name_vector_list[sparserows[index]]
-        right_side[index] = name_vector_list[sparsecols[index]]
-        similarity[index] = sparse_matrix.data[index]
-        pos_left[index] = sparserows[index]
-        pos_right[index] = sparsecols[index]
+    Parameters
+    ----------
+    sparse_matrix : csr matrix
+        sparse matrix representation of similarity score between two groups of strings
+    name_vector : list
+        list with name of the strings compared (rows of the matrix)
+    rows : list
+        positions of the rows to convert (None for all the rows)
+    name_vector_right : list
+        list with name of the strings of the columns of the matrix (None if they are name_vector)
 
-    return pd.DataFrame({'left_side': left_side,
-                         'right_side': right_side,
+    Returns
+    -------
+    dataframe
+        a dataframe with the scores and string coincidences with the highest similarity for each string
+    """
+    sparse_matrix = sparse_matrix.tocsr()
+    name_left = np.asarray(list(map(str, name_vector)), dtype=object)
+    name_right = name_left if name_vector_right is None else np.asarray(list(map(str, name_vector_right)),
+                                                                        dtype=object)
+
+    # Positions in data/indices of the values of the rows selected, straight from indptr
+    if rows is None:
+        rows = np.arange(sparse_matrix.shape[0])
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = sparse_matrix.indptr[rows].astype(np.int64)
+    counts = sparse_matrix.indptr[rows + 1] - starts
+    offsets = np.cumsum(counts) - counts
+    positions = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+
+    pos_left = np.repeat(rows, counts)
+    pos_right = sparse_matrix.indices[positions].astype(np.int64)
+    similarity = sparse_matrix.data[positions]
+
+    # Only non zeros
+    non_zeros = similarity != 0
+    pos_left = pos_left[non_zeros]
+    pos_right = pos_right[non_zeros]
+    similarity = similarity[non_zeros]
+
+    return pd.DataFrame({'left_side': name_left[pos_left],
+                         'right_side': name_right[pos_right],
                          'similarity': similarity,
                          'pos_left': pos_left,
                          'pos_right': pos_right})
-
@@ -0,0 +1,250 @@
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import data_cleaning_functions as clean
+import data_extraction_functions as extract
+import secop_cache
+
+"""
+Synthetic SECOP data, to run and benchmark the pipeline without datos.gov.co
+Frames have the shape of the API answers: contracts of a public entity (issued to mun/dept. and to other
+contractors), contracts of each mun/dept. (some of them derived from an entity contract, so they are matched)
+and the official names of mun/dept. (DIVIPOLA). Columns and descriptions are taken from the samples in
+code/results, so every column of SECOP is present.
+"""
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'results')
+ENTITY_NAME = 'INSTITUTO NACIONAL DE VÍAS (INVIAS)'
+ENTITY_CAUSAL = 'Contratos Interadministrativos (Literal C)'
+# States of the process: the first ones are kept by df_cleaning, the last one is filtered out
+STATES = ['Liquidado', 'Terminado Sin Liquidar', 'Celebrado', 'Adjudicado', 'Convocado', 'Borrador']
+STATES_P = [0.5, 0.15, 0.15, 0.05, 0.05, 0.1]
+# Syllables of the synthetic mun/dept. names (some with accents, to exercise the accent standardization)
+SYLLABLES = ['SAN', 'TA', 'MA', 'RÍ', 'LO', 'PE', 'CA', 'JÓ', 'NA', 'VE', 'RA', 'GUA', 'CHI', 'QUI', 'TO', 'BA',
+             'RRAN', 'CO', 'LÍ', 'MO', 'NI', 'PA', 'TÁ', 'DU', 'SO', 'GA', 'ME', 'HUI', 'TI', 'ZA']
+
+
+def load_seed(results_dir=RESULTS_DIR):
+    """
+    Reads the samples of code/results used as seed of the synthetic data
+
+    Parameters
+    ----------
+    results_dir : str
+        directory with contracting_chain_sample.csv and test_entity_df.csv
+
+    Returns
+    -------
+    dict
+        entity_template and mun_template (one row with all the SECOP columns of each dataset, as strings),
+        words (vocabulary of the descriptions) and n_words (number of words of each description)
+    """
+    df_sample = pd.read_csv(os.path.join(results_dir, 'contracting_chain_sample.csv'), index_col=0, dtype=str)
+    df_entity = pd.read_csv(os.path.join(results_dir, 'test_entity_df.csv'), index_col=0, dtype=str)
+
+    entity_template = df_entity.drop(columns=['nom_raz_soc_stand']).iloc[:1].reset_index(drop=True)
+    mun_cols = [col for col in df_sample.columns if col.endswith('_mun')]
+    mun_template = df_sample[mun_cols].iloc[:1].reset_index(drop=True)
+    mun_template.columns = [col[:-len('_mun')] for col in mun_cols]
+
+    descriptions = pd.concat([df_entity['detalle_del_objeto_a_contratar'],
+                              df_sample['detalle_del_objeto_a_contratar'],
+                              df_sample['detalle_del_objeto_a_contratar_mun']], ignore_index=True).dropna()
+    words = sorted({word for item in descriptions for word in item.upper().split() if word.isalpha()})
+    n_words = descriptions.str.split().str.len().to_numpy()
+    return {'entity_template': entity_template, 'mun_template': mun_template, 'words': words,
+            'n_words': n_words}
+
+
+def generate_names(n_mun, n_dept=32, seed=0):
+    """
+    Generates official names of municipalities and departments, as returned by extract_mun_names
+
+    Parameters
+    ----------
+    n_mun : int
+        Number of municipalities
+    n_dept : int
+        Number of departments (municipalities are spread among them)
+    seed : int
+        seed of the random generator
+
+    Returns
+    -------
+    dataframe
+        one row per municipality: codes and names (title case, with accents) of department and municipality
+    """
+    rng = np.random.default_rng(seed)
+    names = _unique_names(rng, n_dept + n_mun)
+    depts, muns = names[:n_dept], names[n_dept:]
+    dept_idx = rng.integers(0, n_dept, n_mun)
+    return pd.DataFrame({'region': 'Región ' + pd.Series(dept_idx % 6).astype(str),
+                         'c_digo_dane_del_departamento': pd.Series(dept_idx + 5).astype(str).str.zfill(2),
+                         'departamento': [depts[i].title() for i in dept_idx],
+                         'c_digo_dane_del_municipio': [str(i + 5001).zfill(5) for i in range(n_mun)],
+                         'municipio': [name.title() for name in muns]})
+
+
+def _unique_names(rng, n):
+    """Names of 1 or 2 words, unique without accents, no name being a word of another one"""
+    names, seen = [], set()
+    while len(names) < n:
+        words = [''.join(rng.choice(SYLLABLES, rng.integers(2, 5))) for _ in range(rng.integers(1, 3))]
+        name = ' '.join(words)
+        words_plain = {clean.strip_accents(word) for word in words}
+        if clean.strip_accents(name) in seen or words_plain & seen:
+            continue
+        seen.add(clean.strip_accents(name))
+        seen.update(words_plain)
+        names.append(name)
+    return names
+
+
+def official_name(dept, mun):
+    """Standardized name of a municipality: name of the mun. contracts in SECOP"""
+    return dept.upper() + ' - ALCALDÍA MUNICIPIO DE ' + mun.upper()
+
+
+def generate_data(n_mun=50, contracts_per_mun=200, entity_per_mun=3, match_rate=0.7, description_length=None,
+                  other_contractors=0.2, n_entities=1, seed=0, seed_data=None):
+    """
+    Generates a synthetic run of the pipeline: entity contracts, mun/dept. contracts and official names
+
+    Parameters
+    ----------
+    n_mun : int
+        Number of municipalities with contracts with the entity
+    contracts_per_mun : int
+        Number of contracts issued by each municipality
+    entity_per_mun : int
+        Number of contracts issued by each entity to each municipality
+    match_rate : float
+        Share of the entity contracts with a derived contract of the municipality (a match of the chain)
+    description_length : tuple
+        (min, max) number of words of the descriptions. None to sample the lengths of the seed descriptions
+    other_contractors : float
+        Share of the entity contracts issued to contractors that are not a mun/dept. (filtered out)
+    n_entities : int
+        Number of public entities (all of them contracting every municipality)
+    seed : int
+        seed of the random generator
+    seed_data : dict
+        result of load_seed (read from code/results if None)
+
+    Returns
+    -------
+    dict
+        entity (dataframe), mun (dict standardized name -> dataframe), names (dataframe, DIVIPOLA),
+        entity_names (list) and expected (dict contractor name -> standardized name)
+    """
+    if seed_data is None:
+        seed_data = load_seed()
+    rng = np.random.default_rng(seed)
+    words = np.array(seed_data['words'])
+
+    def descriptions(n):
+        if description_length is None:
+            lengths = rng.choice(seed_data['n_words'], n)
+        else:
+            lengths = rng.integers(description_length[0], description_length[1] + 1, n)
+        return [' '.join(rng.choice(words, length)) for length in lengths]
+
+    df_names = generate_names(n_mun, seed=seed)
+    depts, muns = df_names['departamento'].tolist(), df_names['municipio'].tolist()
+    mun_names = [official_name(dept, mun) for dept, mun in zip(depts, muns)]
+    # Contractor names as they appear in SECOP: without accents, some with the department
+    contractors = [clean.strip_accents('MUNICIPIO DE ' + mun.upper() + (' - ' + dept.upper() if i % 2 else ''))
+                   for i, (dept, mun) in enumerate(zip(depts, muns))]
+
+    # Entity contracts
+    entity_names = [ENTITY_NAME] + ['ENTIDAD NACIONAL ' + str(k) for k in range(1, n_entities)]
+    n_entity = n_mun * entity_per_mun * n_entities
+    mun_idx = np.tile(np.repeat(np.arange(n_mun), entity_per_mun), n_entities)
+    entity_years = rng.integers(2012, 2018, n_entity)
+    df_entity = _contracts(seed_data['entity_template'], rng, n_entity, 'e', descriptions(n_entity),
+                           entity_years)
+    df_entity['nombre_de_la_entidad'] = np.repeat(entity_names, n_mun * entity_per_mun)
+    df_entity['causal_de_otras_formas_de'] = ENTITY_CAUSAL
+    df_entity['nom_raz_social_contratista'] = [contractors[i] for i in mun_idx]
+    n_other = int(round(n_entity * other_contractors))
+    df_other = _contracts(seed_data['entity_template'], rng, n_other, 'o', descriptions(n_other),
+                          rng.integers(2012, 2018, n_other))
+    df_other['nombre_de_la_entidad'] = rng.choice(entity_names, n_other)
+    df_other['causal_de_otras_formas_de'] = ENTITY_CAUSAL
+    df_other['nom_raz_social_contratista'] = 'UNIVERSIDAD ' + pd.Series(rng.choice(SYLLABLES, n_other))
+    df_entity = pd.concat([df_entity, df_other], ignore_index=True)
+
+    # Mun. contracts: random ones plus the ones derived from an entity contract (same description with
+    # some words changed, signed the same year or later)
+    mun_frames = {}
+    for i, mun_name in enumerate(mun_names):
+        entity_rows = np.flatnonzero(mun_idx == i)
+        derived = entity_rows[rng.random(entity_rows.size) < match_rate][:contracts_per_mun]
+        n_random = contracts_per_mun - derived.size
+        derived_desc = [_perturb(df_entity['detalle_del_objeto_a_contratar'].iat[row], rng, words)
+                        for row in derived]
+        years = np.concatenate([entity_years[derived] + rng.integers(0, 2, derived.size),
+                                rng.integers(2011, 2019, n_random)])
+        df_mun = _contracts(seed_data['mun_template'], rng, contracts_per_mun, 'm' + str(i) + '-',
+                            derived_desc + descriptions(n_random), years)
+        df_mun['nombre_de_la_entidad'] = mun_name
+        mun_frames[mun_name] = extract.typed_chunk(df_mun)
+
+    return {'entity': extract.typed_chunk(df_entity),
+            'mun': mun_frames,
+            'names': df_names,
+            'entity_names': entity_names,
+            'expected': dict(zip(contractors, mun_names))}
+
+
+def _contracts(template, rng, n, uid_prefix, descriptions, years):
+    """n contracts with the columns of the template and random values of the columns used by the pipeline"""
+    df = template.loc[np.zeros(n, dtype=int)].reset_index(drop=True)
+    df['uid'] = [uid_prefix + str(i) for i in range(n)]
+    df['numero_del_contrato'] = df['uid']
+    df['detalle_del_objeto_a_contratar'] = descriptions
+    df['anno_firma_del_contrato'] = pd.Series(years).astype(str)
+    df['estado_del_proceso'] = rng.choice(STATES, n, p=STATES_P)
+    df['cuantia_proceso'] = pd.Series(rng.integers(1, 5000, n) * 1000000).astype(str)
+    df['fecha_de_cargue_en_el_secop'] = pd.Series(years).astype(str) + '-06-01T00:00:00.000'
+    return df
+
+
+def _perturb(description, rng, words):
+    """Description with about 1 word in 10 replaced by a random one"""
+    tokens = description.split()
+    for pos in np.flatnonzero(rng.random(len(tokens)) < 0.1):
+        tokens[pos] = rng.choice(words)
+    return ' '.join(tokens)
+
+
+def fill_cache(cache, mun_frames, columns=None):
+    """
+    Writes the mun/dept. contracts to a cache of SECOP queries, as extract_mun_contracts would have cached them
+    With the cache in offline mode, contracting_chain runs without network
+
+    Parameters
+    ----------
+    cache : ContractCache
+        cache of SECOP queries
+    mun_frames : dict
+        standardized name of the mun/dept. -> contracts (result of generate_data)
+    columns : list
+        columns passed to extract_mun_contracts (None for all the columns)
+    """
+    fetched_at = datetime.now(timezone.utc).isoformat()
+    for mun_name, df_mun in mun_frames.items():
+        params = extract.query_params({'nombre_de_la_entidad': mun_name}, columns)
+        if columns is not None:
+            df_mun = df_mun[[col for col in columns if col in df_mun.columns]]
+        meta = {'version': secop_cache.CACHE_VERSION,
+                'url': extract.SECOP_URL,
+                'entity_name': mun_name,
+                'params': {k: str(v) for k, v in params.items()},
+                'fetched_at': fetched_at,
+                'max_date': secop_cache.max_date(df_mun),
+                'n_rows': len(df_mun)}
+        cache.save(cache.key(extract.SECOP_URL, mun_name, params), df_mun, meta)